@@ -42,11 +42,27 @@
 
 
 from __future__ import unicode_literals
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+import multiprocessing
+import threading
+import weakref
+import codecs
+import importlib
+import keyword
+import hashlib
+import math
 import sys
+import re
+import io
+import os
 try:
     from html import entities
+    from html.parser import HTMLParser as _HTMLParser
 except ImportError:
     import htmlentitydefs as entities
+    from HTMLParser import HTMLParser as _HTMLParser
 
 
 __version__ = '0.0.1'
@@ -54,6 +70,8 @@ __version__ = '0.0.1'
 
 __all__ = [
     'Element',
+    'Attrib',
+    'ClassList',
     'Comment',
     'Text',
     'RawText',
@@ -62,6 +80,35 @@ __all__ = [
     'is_text',
     'is_raw_text',
     'is_comment',
+    'intern_tree',
+    'weaken_parents',
+    'stats',
+    'deep_sizeof',
+    'tree_equal',
+    'tree_diff',
+    'is_ancestor',
+    'document_position',
+    'sort_document_order',
+    'unique',
+    'to_wire',
+    'from_wire',
+    'instrument',
+    'Parser',
+    'from_string',
+    'parse',
+    'Filter',
+    'StreamWriter',
+    'Slot',
+    'template_source',
+    'compile_template',
+    'FragmentCache',
+    'CacheInfo',
+    'process_files',
+    'ProcessResult',
+    'XPath',
+    'XPathError',
+    'Policy',
+    'sanitize',
     'to_string',
     'to_bytes'
 ]
@@ -69,6 +116,7 @@ __all__ = [
 
 if sys.version_info[0] == 3:  # pragma: no cover
     text_type = str
+    unichr = chr
 else:                         # pragma: no cover
     text_type = unicode       # noqa
 
@@ -78,10 +126,13 @@ else:                         # pragma: no cover
 
 
 HTML_EMPTY = set([
-    'area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
-    'img', 'input', 'isindex', 'link', 'meta' 'param'
+    'area', 'base', 'basefont', 'br', 'col', 'embed', 'frame', 'hr',
+    'img', 'input', 'isindex', 'link', 'meta', 'param', 'source', 'track',
+    'wbr'
 ])
 
+HTML_PRESERVE_SPACE = set(['pre', 'textarea'])
+
 HTML_BLOCK = set([
     'p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote',
     'pre', 'table', 'dl', 'ol', 'ul', 'script', 'noscript', 'form',
@@ -142,6 +193,20 @@ def is_entity(node):
 # --------------------------------------------------------------------
 # Nodes
 
+class _WeakParent(object):
+    # The `parent` attribute of nodes. A strong reference to the parent is
+    # stored in the instance dictionary, which takes precedence over this
+    # (non-data) descriptor, so normal access costs nothing extra. This is
+    # only called for nodes with no parent or whose parent reference has been
+    # made weak by `weaken_parents`.
+
+    def __get__(self, node, cls=None):
+        if node is None:
+            return self
+        ref = node._parent_ref
+        return None if ref is None else ref()
+
+
 class Node(object):
     """
     Base class for nodes.
@@ -149,7 +214,9 @@ class Node(object):
     All nodes inherit from this class. Do not use this class directly.
 
     """
-    parent = None
+    parent = _WeakParent()
+    _parent_ref = None
+    _order = None  # See `_order_of`.
 
     def __repr__(self):
         return '<{0}() at {1:#x}>'.format(self.__class__.__name__, id(self))
@@ -207,34 +274,142 @@ class Node(object):
 
     def iter_ancestors(self):
         """
-        Return a tree iterator of all ancestors in document order.
+        Return a tree iterator of all ancestors, starting with the parent.
 
         """
-        if self.parent is not None:
-            yield self.parent
-            for p in self.parent.iter_ancestors():
-                yield p
+        node = self.parent
+        while node is not None:
+            yield node
+            node = node.parent
+
+    @property
+    def depth(self):
+        """
+        The number of ancestors of the node.
+
+        Taken from the document order index of the tree (see `is_ancestor`)
+        if it is current, otherwise counted.
 
-    def to_string(self, format='html'):
+        """
+        order = self._order
+        if order is not None and not order[0].stale:
+            return order[3]
+        depth = 0
+        node = self.parent
+        while node is not None:
+            depth += 1
+            node = node.parent
+        return depth
+
+    def to_string(self, format='html', minify=False, indent=None, sort_attributes=True, encode_entities=False):
         """
         Return a serialized unicode string of a node and its children.
 
         `format` may be one of "html" or "xhtml".
+
+        Set `minify` to `True` to drop newlines between elements, collapse
+        whitespace in text outside of "pre" and "textarea" elements and strip
+        comments. When `format` is "html", optional attribute quotes and
+        optional end tags are omitted as well. RawText and Entity nodes are
+        never altered.
+
+        Set `indent` to a number of spaces or a string to indent the children
+        of block level elements by that amount for each level of nesting.
+        The content of "pre" and "textarea" elements and of RawText nodes is
+        left unaltered. `indent` and `minify` may not be used together.
+
+        Attributes are written in lexical order. Set `sort_attributes` to
+        `False` to write them in the order they were added, which is faster.
+        On Python 2, unsorted attributes are written in an arbitrary order.
+
+        Set `encode_entities` to `True` to write every character outside of
+        ASCII as a named entity or, if it has no name, a numeric reference.
+        RawText nodes are not altered.
         """
         data = []
-        write = data.append
-        _serialize_node(write, self, format)
+        self._serialize(data.append, format, minify, indent, sort_attributes)
+        if encode_entities:
+            data = _encode_entities(data)
         return "".join(data)
 
-    def to_bytes(self, format='html', encoding='utf-8'):
+    def to_bytes(self, format='html', encoding='utf-8', minify=False, indent=None, sort_attributes=True,
+                 encode_entities=False):
         """
         Return a serialized byte string of a node and its children.
 
         `format` may be one of "html" or "xhtml".
 
         `encoding` defaults to utf-8.
+
+        Characters which `encoding` cannot represent are written as numeric
+        references. See `to_string` for the other arguments.
+
+        The output is encoded in batches as it is produced, so the document
+        is never held as a single unicode string.
         """
-        return self.to_string(format).encode(encoding, "xmlcharrefreplace")
+        out = io.BytesIO()
+        collect, flush = _batch_encoder(out.write, encoding, encode_entities)
+        self._serialize(collect, format, minify, indent, sort_attributes)
+        flush(final=True)
+        # Returns the buffer itself rather than a copy of it.
+        return out.getvalue()
+
+    def _serialize(self, write, format, minify, indent, sort_attributes):
+        # Pass the serialized node to `write` in pieces.
+        if indent is not None:
+            if minify:
+                raise ValueError('minify and indent cannot be used together')
+            if not isinstance(indent, text_type):
+                indent = ' ' * indent
+            _serialize_node_indented(write, self, format, indent, 0, [True], sort_attributes)
+        elif minify:
+            _serialize_node_minified(write, self, format, sort=sort_attributes)
+        else:
+            _serialize_node(write, self, format, sort_attributes)
+
+    def __reduce_ex__(self, protocol):
+        # Pickle and deep copy trees of the built-in node types using the
+        # compact wire format. This avoids recursion on deep trees and does
+        # not drag ancestors along. Trees which contain a subclass (such as
+        # a Slot) are reduced as usual so that they are reproduced exactly.
+        buf = _to_wire(self, exact=True)
+        if buf is not None:
+            return from_wire, (buf,)
+        if isinstance(self, Element):
+            self.attrib  # Write any pending changes of the ClassList.
+        reduced = super(Node, self).__reduce_ex__(max(protocol, 2))
+        state = reduced[2]
+        if state:
+            # The copy is not part of the indexed tree and, as with the wire
+            # format, has no parent. `Element.__setstate__` links children
+            # (which may have been rebuilt from the wire format) to it. The
+            # ClassList is recreated on demand. Weak references cannot be
+            # pickled, so children with a weak parent are noted instead.
+            state = dict(state)
+            state.pop('_order', None)
+            state.pop('parent', None)
+            state.pop('_parent_ref', None)
+            state.pop('_classes', None)
+            children = state.get('_children')
+            if children and all('parent' not in child.__dict__ for child in children):
+                state['_weak_children'] = True
+            reduced = reduced[:2] + (state,) + reduced[3:]
+        return reduced
+
+    def __copy__(self):
+        # A shallow copy shares its children, parent and attribute values with
+        # the original, but has its own list of children and attributes.
+        cls = self.__class__
+        node = text_type.__new__(cls, self) if isinstance(self, text_type) else cls.__new__(cls)
+        state = dict(self.__dict__)
+        state.pop('_order', None)
+        state.pop('_classes', None)
+        if '_children' in state:
+            state['_children'] = list(state['_children'])
+        if '_attrib' in state:
+            state['_attrib'] = Attrib(self.attrib)
+        node.__dict__.update(state)
+        return node
 
 
 class BaseTextNode(Node, text_type):
@@ -276,30 +451,307 @@ class RawText(Text):
 
     """
 
+def _build_entity_tables():
+    # Return maps of entity name (without "&" and ";") to characters and of
+    # character to entity name. Where a character has more than one name,
+    # the HTML 4 name is preferred, then the shortest.
+    names = {}
+    for name, chars in getattr(entities, 'html5', {}).items():
+        if name.endswith(';'):
+            names[name[:-1]] = chars
+    for name, codepoint in entities.name2codepoint.items():
+        names.setdefault(name, unichr(codepoint))
+    chars = {}
+    for name in sorted(names, key=lambda name: (len(name), name)):
+        if len(names[name]) == 1:
+            chars.setdefault(names[name], name)
+    for codepoint, name in entities.codepoint2name.items():
+        chars[unichr(codepoint)] = name
+    return names, chars
+
+
+_entity_name_to_chars, _entity_char_to_name = _build_entity_tables()
+
+_numeric_entity_match = re.compile('#(?:[xX]([0-9a-fA-F]+)|([0-9]+))$').match
+
+# Maps the type and value of each argument passed to Entity to the resulting
+# entity text. Equal arguments of different types (such as 233 and 233.0) do
+# not share an entry.
+_entity_cache = {}
+_ENTITY_CACHE_SIZE = 1000
+
+
+def _resolve_entity(obj):
+    # Return the entity text for an argument to Entity or raise TypeError.
+    codepoint = None
+    if isinstance(obj, int):
+        codepoint = obj
+    elif isinstance(obj, text_type):
+        if len(obj) == 1:
+            codepoint = ord(obj)
+        else:
+            name = obj[:-1] if obj.endswith(';') else obj
+            if name in _entity_name_to_chars:
+                return '&' + name + ';'
+            m = _numeric_entity_match(name)
+            if m:
+                codepoint = int(m.group(1), 16) if m.group(1) else int(m.group(2))
+    if codepoint is not None and 0 <= codepoint <= sys.maxunicode:
+        name = _entity_char_to_name.get(unichr(codepoint))
+        return '&{0};'.format(name) if name else '&#x{0:x};'.format(codepoint)
+    raise TypeError('{0} is not a valid HTML Entity.'.format(repr(obj)))
+
+
 class Entity(BaseTextNode):
     """
     Entity Node.
 
     Contains a single HTML Entity. Accepts a single Unicode character, a
-    Unicode code point, or an HTML entity name. Renders as an HTML5 entity.
+    Unicode code point, an HTML5 entity name or a numeric character
+    reference ("#233" or "#xe9"). Other than names, each renders as a named
+    entity if the character has a name, otherwise as a hexadecimal numeric
+    reference. On Python 2, only the HTML 4 entity names are known.
 
     """
     def __new__(cls, obj):
-        original = obj
-        if isinstance(obj, text_type) and len(obj) == 1:
-            # Convert Unicode char to code point
-            obj = ord(obj)
-        if obj in entities.codepoint2name:
-            # Get name of code point
-            obj = entities.codepoint2name[obj]
-        # Ensure name ends with semicolon
-        name =  obj if obj.endswith(';') else obj + ';'
-        # PY2 does not include semicolon in entitydef names so we also check obj
-        if name in entities.entitydefs or obj in entities.entitydefs:
-            # Unicode objects are imuttable, so return a new object
-            return super(Entity, cls).__new__(cls, '&'+name)
+        key = (obj.__class__, obj)
+        try:
+            value = _entity_cache[key]
+        except KeyError:
+            value = _resolve_entity(obj)
+            if len(_entity_cache) >= _ENTITY_CACHE_SIZE:
+                _entity_cache.clear()
+            _entity_cache[key] = value
+        # Unicode objects are imuttable, so return a new object
+        return super(Entity, cls).__new__(cls, value)
+
+
+def _entity_char(entity):
+    # Return the character(s) an Entity node represents.
+    name = entity[1:-1]
+    if name.startswith('#'):
+        m = _numeric_entity_match(name)
+        return unichr(int(m.group(1), 16) if m.group(1) else int(m.group(2)))
+    return _entity_name_to_chars[name]
+
+
+class _EntityEncoder(dict):
+    # Maps a character to its named entity or, if it has no name, a numeric
+    # reference. Entries are added the first time each character is seen.
+
+    def __missing__(self, char):
+        name = _entity_char_to_name.get(char)
+        value = self[char] = '&{0};'.format(name) if name else '&#x{0:x};'.format(ord(char))
+        return value
+
+
+_entity_encoder = _EntityEncoder()
+
+_non_ascii_sub = re.compile('[^\x00-\x7f]').sub
+
+
+def _encode_match(match):
+    return _entity_encoder[match.group()]
+
+
+def _encode_entities(chunks):
+    # Return `chunks` with all characters outside of ASCII replaced by
+    # entities, except in RawText chunks. Chunks between RawText chunks are
+    # joined so that the output is scanned in a single regular expression
+    # pass, which is faster than `str.translate` with a mapping.
+    result = []
+    run = []
+    for chunk in chunks:
+        if chunk.__class__ is RawText:
+            if run:
+                result.append(_non_ascii_sub(_encode_match, ''.join(run)))
+                run = []
+            result.append(chunk)
+        else:
+            run.append(chunk)
+    if run:
+        result.append(_non_ascii_sub(_encode_match, ''.join(run)))
+    return result
+
+
+def _merge_text(run, parent, result):
+    # Append a single node for a run of adjacent text nodes of one type to
+    # `result`, unless they are all empty. Nodes merged away are detached.
+    if len(run) == 1:
+        node = run[0]
+        if node:
+            result.append(node)
+        else:
+            node.parent = None
+        return
+    for node in run:
+        node.parent = None
+    text = ''.join(run)
+    if text:
+        node = run[0].__class__(text)
+        node.parent = parent
+        result.append(node)
+
+
+class Attrib(dict):
+    """
+    Dictionary of an element's attributes.
+
+    Behaves as a regular `dict`, but also caches the items sorted by name
+    and the attributes as last rendered by the serializer. The caches are
+    cleared whenever the attributes are changed.
+
+    """
+    __slots__ = ('_sorted', '_rendered', '_rendered_key')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._sorted = self._rendered = self._rendered_key = None
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def sorted_items(self):
+        """
+        Return a tuple of (name, value) pairs sorted by name.
+
+        """
+        items = self._sorted
+        if items is None:
+            items = self._sorted = tuple(sorted(dict.items(self)))
+        return items
+
+    def __setitem__(self, key, value):
+        self._sorted = self._rendered = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._sorted = self._rendered = None
+        dict.__delitem__(self, key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        self._sorted = self._rendered = None
+        dict.clear(self)
+
+    def pop(self, *args):
+        self._sorted = self._rendered = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._sorted = self._rendered = None
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._sorted = self._rendered = None
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._sorted = self._rendered = None
+        dict.update(self, *args, **kwargs)
+
+    def copy(self):
+        return self.__class__(self)
+
+
+class ClassList(object):
+    """
+    The class names of an element as an ordered set.
+
+    Returned by `Element.classes`. Changes are written back to the "class"
+    attribute lazily, the next time the element's `attrib` is accessed (as
+    it is by `get`, `items` and the serializer). If the "class" attribute is
+    changed directly, the class names are read from it again. The element is
+    only weakly referenced, so a ClassList does not keep it alive.
+
+    """
+    __slots__ = ('_element', '_tokens', '_value', '_dirty')
+
+    def __init__(self, element):
+        # A weak reference avoids a cycle with `Element._classes`.
+        self._element = weakref.ref(element)
+        self._tokens = None
+        self._value = None
+        self._dirty = False
+
+    def _get_tokens(self):
+        # Return the tokens, (re)reading them if the attribute has changed.
+        if not self._dirty:
+            value = dict.get(self._element()._attrib, 'class')
+            if self._tokens is None or value != self._value:
+                self._tokens = OrderedDict.fromkeys(value.split() if value else ())
+                self._value = value
+        return self._tokens
+
+    def _flush(self):
+        # Write the tokens to the "class" attribute.
+        attrib = self._element()._attrib
+        if self._tokens:
+            self._value = attrib['class'] = ' '.join(self._tokens)
+        else:
+            self._value = None
+            attrib.pop('class', None)
+        self._dirty = False
+
+    def add(self, *tokens):
+        """
+        Add each of `tokens` which is not already present.
+
+        """
+        current = self._get_tokens()
+        for token in tokens:
+            if token not in current:
+                current[token] = None
+                self._dirty = True
+
+    def remove(self, *tokens):
+        """
+        Remove each of `tokens` which is present.
+
+        """
+        current = self._get_tokens()
+        for token in tokens:
+            if token in current:
+                del current[token]
+                self._dirty = True
+
+    def toggle(self, token, force=None):
+        """
+        Remove `token` if present, otherwise add it. Return `True` if it is now present.
+
+        If `force` is `True` the token is only added and if `False` it is only
+        removed.
+
+        """
+        present = token in self._get_tokens()
+        if force is None:
+            force = not present
+        if force:
+            self.add(token)
         else:
-            raise TypeError('{0} is not a valid HTML Entity.'.format(repr(original)))
+            self.remove(token)
+        return bool(force)
+
+    def contains(self, token):
+        """
+        Return `True` if `token` is present.
+
+        """
+        return token in self._get_tokens()
+
+    __contains__ = contains
+
+    def __iter__(self):
+        return iter(list(self._get_tokens()))
+
+    def __len__(self):
+        return len(self._get_tokens())
+
+    def __repr__(self):
+        return '<{0}({1!r}) at {2:#x}>'.format(self.__class__.__name__, list(self), id(self))
 
 
 class Element(Node):
@@ -314,8 +766,10 @@ class Element(Node):
     as a reference to the parent instance. When a child is removed,
     the child's `parent` attribute is set to `None`.
 
-    `tag` is the element name. All additional keyword arguments are element
-    attributes. If tag is `None`, only its children will be serialized.
+    `tag` is the element name. If tag is `None`, only its children will be
+    serialized. Attributes may be passed as a mapping or a sequence of
+    (name, value) pairs in `attrib`, as keyword arguments, or both. An
+    `Attrib` instance passed alone is used as is rather than copied.
 
     All text is contained in child Text or RawText nodes. The content of
     RawText nodes will not be escaped when serialized. Therefore, use RawText
@@ -329,17 +783,59 @@ class Element(Node):
     tag = None
     """The element's name."""
 
-    attrib = None
-    """Dictionary of the element's attributes."""
+    _classes = None
 
-    def __init__(self, tag=None, **attrib):
+    def __init__(self, tag=None, attrib=None, **extra):
         self.tag = tag
-        self.attrib = attrib
+        if attrib is None:
+            attrib = Attrib(extra)
+        elif attrib.__class__ is not Attrib or extra:
+            attrib = Attrib(attrib, **extra)
+        self._attrib = attrib
         self._children = []
 
+    @property
+    def attrib(self):
+        """Dictionary (an `Attrib` instance) of the element's attributes."""
+        classes = self._classes
+        if classes is not None and classes._dirty:
+            classes._flush()
+        return self._attrib
+
+    @attrib.setter
+    def attrib(self, value):
+        classes = self._classes
+        if classes is not None:
+            # Keep the ClassList, which rereads the class names from `value`.
+            if classes._dirty:
+                classes._flush()
+            classes._tokens = None
+        self._attrib = value
+
+    @property
+    def classes(self):
+        """The class names of the element as a `ClassList`."""
+        if self._classes is None:
+            self._classes = ClassList(self)
+        return self._classes
+
     def __repr__(self):
         return '<{0}("{1}") at {2:#x}>'.format(self.__class__.__name__, self.tag, id(self))
 
+    def __setstate__(self, state):
+        # Restore an element reduced by `Node.__reduce_ex__`.
+        state = dict(state)
+        weak = state.pop('_weak_children', False)
+        self.__dict__.update(state)
+        if weak:
+            ref = weakref.ref(self)
+            for child in self._children:
+                child.__dict__.pop('parent', None)
+                child._parent_ref = ref
+        else:
+            for child in self._children:
+                child.parent = self
+
     def copy(self):
         """
         Return a shallow copy of current element.
@@ -360,17 +856,21 @@ class Element(Node):
         return self._children[index]
 
     def __setitem__(self, index, node):
+        _invalidate_order(self)
         self._assert_can_contain_children()
         if isinstance(index, slice):
             for n in node:
                 self._assert_is_node(n)
+                _invalidate_order(n)
                 n.parent = self
         else:
             self._assert_is_node(node)
+            _invalidate_order(node)
             node.parent = self
         self._children[index] = node
 
     def __delitem__(self, index):
+        _invalidate_order(self)
         if hasattr(self._children[index], 'parent'):
             self._children[index].parent = None
         del self._children[index]
@@ -403,8 +903,10 @@ class Element(Node):
         Add child node to the end of this node's children.
 
         """
+        _invalidate_order(self)
         self._assert_can_contain_children()
         self._assert_is_node(node)
+        _invalidate_order(node)
         node.parent = self
         self._children.append(node)
 
@@ -413,9 +915,11 @@ class Element(Node):
         Append child nodes from a sequence to end of this node's children.
 
         """
+        _invalidate_order(self)
         self._assert_can_contain_children()
         for node in nodes:
             self._assert_is_node(node)
+            _invalidate_order(node)
             node.parent = self
         self._children.extend(nodes)
 
@@ -424,31 +928,232 @@ class Element(Node):
         Insert child node at index.
 
         """
+        _invalidate_order(self)
         self._assert_can_contain_children()
         self._assert_is_node(node)
+        _invalidate_order(node)
         node.parent = self
         self._children.insert(index, node)
 
     def remove(self, node):
         """
-        Remove matching child node.
+        Remove child node.
 
-        ValueError is raised if a matching node could not be found.
+        The node itself is removed, not a node which is merely equal to it.
+        ValueError is raised if the node is not a child of this node.
 
         """
-        if hasattr(node, 'parent'):
-            node.parent = None
-        self._children.remove(node)
+        _invalidate_order(self)
+        children = self._children
+        for i in range(len(children)):
+            if children[i] is node:
+                del children[i]
+                node.parent = None
+                return
+        raise ValueError('{0!r} is not a child of {1!r}'.format(node, self))
 
     def clear(self):
         """
         Reset Node. Remove all children and clear all attributes.
 
         """
+        _invalidate_order(self)
         self.attrib.clear()
         # Detach parent from each child
         for child in self._children:
-            self.remove(child)
+            child.parent = None
+        del self._children[:]
+
+    def _filter_children(self, predicate, keep):
+        # Rebuild the children in one pass, keeping those for which
+        # `predicate` returns `keep`. Return the removed children.
+        _invalidate_order(self)
+        kept = []
+        removed = []
+        for child in self._children:
+            if bool(predicate(child)) is keep:
+                kept.append(child)
+            else:
+                child.parent = None
+                removed.append(child)
+        self._children[:] = kept
+        return removed
+
+    def remove_all(self, predicate):
+        """
+        Remove all child nodes for which `predicate(node)` is true.
+
+        Return a list of the removed nodes.
+
+        """
+        return self._filter_children(predicate, False)
+
+    def retain(self, predicate):
+        """
+        Remove all child nodes except those for which `predicate(node)` is true.
+
+        Return a list of the removed nodes.
+
+        """
+        return self._filter_children(predicate, True)
+
+    def detach_range(self, start, stop=None):
+        """
+        Remove the child nodes from index `start` up to, but not including, `stop`.
+
+        Indexes are interpreted as in a slice. If `stop` is `None`, all child
+        nodes from `start` on are removed. Return a list of the removed nodes.
+
+        """
+        _invalidate_order(self)
+        removed = self._children[start:stop]
+        del self._children[start:stop]
+        for child in removed:
+            child.parent = None
+        return removed
+
+    def replace_children(self, nodes):
+        """
+        Replace all child nodes with the nodes from a sequence or iterable.
+
+        Return a list of the nodes which were removed. If any of the new nodes
+        is not a Node, TypeError is raised and the children are unchanged.
+
+        """
+        nodes = list(nodes)
+        if nodes:
+            self._assert_can_contain_children()
+        for node in nodes:
+            self._assert_is_node(node)
+        _invalidate_order(self)
+        removed = self._children[:]
+        for child in removed:
+            child.parent = None
+        for node in nodes:
+            _invalidate_order(node)
+            node.parent = self
+        self._children[:] = nodes
+        return removed
+
+    def decompose(self):
+        """
+        Remove this element from its parent and take apart its tree.
+
+        Every decendent element is emptied and every decendent node is left
+        without a parent. The nodes then no longer refer to each other, so
+        each is freed by reference counting as soon as it is otherwise unused,
+        rather than waiting for the cyclic garbage collector. Works iteratively,
+        so trees of any depth can be decomposed. The element's attributes are
+        kept.
+
+        """
+        if self.parent is not None:
+            self.parent.remove(self)
+        _invalidate_order(self)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._classes is not None:
+                node._classes = None
+            children = node._children
+            for child in children:
+                child.parent = None
+                if isinstance(child, Element):
+                    stack.append(child)
+            del children[:]
+
+    def serialize_range(self, start=0, stop=None, format='html', minify=False, indent=None, sort_attributes=True,
+                        encode_entities=False):
+        """
+        Return a serialized unicode string of the child nodes from index `start` up to, but not including, `stop`.
+
+        Indexes are interpreted as in a slice. The element's start tag is
+        included when `start` is 0 and its end tag when the range reaches the
+        last child. An empty range returns an empty string, unless the element
+        has no children, in which case both tags are returned. Therefore, the
+        output of consecutive ranges which cover all of the children, joined
+        together, is identical to the output of `to_string`, so large elements
+        may be rendered in parts, in any order or by separate workers. See `to_string` for the other arguments.
+
+        """
+        count = self._range_length()
+        start, stop, _ = slice(start, stop).indices(count)
+        if count and start >= stop:
+            return ''
+        return self._render_range(start, max(start, stop), format, minify, indent, sort_attributes,
+                                  encode_entities)
+
+    def iter_rendered_children(self, batch=1000, format='html', minify=False, indent=None, sort_attributes=True,
+                               encode_entities=False):
+        """
+        Return an iterator of serialized unicode strings of the element, each of `batch` child nodes.
+
+        The first string includes the start tag and the last the end tag. Joined
+        together, they are identical to the output of `to_string`. Each string
+        is rendered when it is requested, so the output of large elements can
+        be sent as it is produced. See `to_string` for the other arguments.
+
+        """
+        if batch < 1:
+            raise ValueError('batch must be at least 1')
+        count = self._range_length()
+        state = [True]
+        for start in range(0, max(count, 1), batch):
+            yield self._render_range(start, min(start + batch, count), format, minify, indent, sort_attributes,
+                                     encode_entities, state)
+
+    def _range_length(self):
+        # The number of children serialized by `_serialize_range`.
+        if self.tag is not None and self.tag.lower() in HTML_EMPTY:
+            return 0
+        return len(self._children)
+
+    def _render_range(self, start, stop, format, minify, indent, sort_attributes, encode_entities, state=None):
+        if indent is not None:
+            if minify:
+                raise ValueError('minify and indent cannot be used together')
+            if not isinstance(indent, text_type):
+                indent = ' ' * indent
+        data = []
+        _serialize_range(data.append, self, start, stop, format, minify, indent, sort_attributes, state)
+        if encode_entities:
+            data = _encode_entities(data)
+        return ''.join(data)
+
+    def normalize(self, recursive=True):
+        """
+        Merge adjacent Text nodes and remove empty ones.
+
+        Adjacent RawText nodes are merged with each other, but never with
+        Text nodes. Comment and Entity nodes are left unchanged. Merged and
+        removed nodes are detached from the tree. If `recursive` is `True`,
+        all decendent elements are normalized as well.
+
+        """
+        _invalidate_order(self)
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            children = element._children
+            result = []
+            run = []  # adjacent text nodes of the same type
+            for child in children:
+                if child.__class__ is Text or child.__class__ is RawText:
+                    if run and run[0].__class__ is not child.__class__:
+                        _merge_text(run, element, result)
+                        run = []
+                    run.append(child)
+                    continue
+                if run:
+                    _merge_text(run, element, result)
+                    run = []
+                result.append(child)
+                if recursive and isinstance(child, Element) and child._children:
+                    stack.append(child)
+            if run:
+                _merge_text(run, element, result)
+            if len(result) != len(children):
+                children[:] = result
 
     def get(self, key, default=None):
         """
@@ -480,21 +1185,17 @@ class Element(Node):
 
     def add_class(self, value):
         """
-        Add a class name to the `class` attribute.
+        Add a class name to the `class` attribute, unless already present.
 
         """
-        value = ' '.join([self.get('class', ''), value]).strip()
-        self.set('class', value)
+        self.classes.add(*value.split())
 
     def remove_class(self, value):
         """
         Remove a class name from the `class` attribute.
 
         """
-        classes = self.get('class', '').split()
-        if value in classes:
-            classes.remove(value)
-            self.set('class', ' '.join(classes).strip())
+        self.classes.remove(*value.split())
 
     def iter_decendents(self, tags=None):
         """
@@ -525,9 +1226,101 @@ class Element(Node):
             if is_text(child) or (is_entity(child) and entities):
                 yield child
             elif is_element(child):
-                for gc in child.iter_text():
+                for gc in child.iter_text(entities, raw):
                     yield gc
 
+    def text_content(self, entities=True, raw=False, normalize_whitespace=False, block_separator='\n'):
+        """
+        Return the text of all decedent text nodes as a single string.
+
+        Entity nodes are included as the characters they represent. Set
+        `entities` to `False` to exclude them. Set `raw` to `True` to include
+        RawText nodes. Comments are never included.
+
+        The text of each block level element (see `HTML_BLOCK`) is separated
+        from surrounding text by `block_separator`. Set `block_separator` to
+        `None` to join all text without separators.
+
+        Set `normalize_whitespace` to `True` to collapse each run of whitespace
+        to a single space and strip whitespace from the start and end of each
+        block. Blocks which are then empty are dropped.
+
+        """
+        blocks = []
+        parts = []
+        split = block_separator is not None
+        stack = [(iter(self._children), False)]
+        while stack:
+            children, block = stack[-1]
+            for child in children:
+                if isinstance(child, Element):
+                    if split and child.tag is not None and child.tag.lower() in HTML_BLOCK:
+                        if parts:
+                            blocks.append(''.join(parts))
+                            parts = []
+                        stack.append((iter(child._children), True))
+                    else:
+                        stack.append((iter(child._children), False))
+                    break
+                elif isinstance(child, Text):
+                    if raw or child.__class__ is not RawText:
+                        parts.append(child)
+                elif isinstance(child, Entity):
+                    if entities:
+                        parts.append(_entity_char(child))
+            else:
+                stack.pop()
+                if block and parts:
+                    blocks.append(''.join(parts))
+                    parts = []
+        if parts:
+            blocks.append(''.join(parts))
+        if normalize_whitespace:
+            blocks = [b for b in (' '.join(b.split()) for b in blocks) if b]
+        return (block_separator or '').join(blocks)
+
+    def xpath(self, expr):
+        """
+        Evaluate an XPath expression with this element as the context node.
+
+        See `XPath` for the supported subset of XPath 1.0. Compiled expressions
+        are cached, so repeating the same expression is cheap.
+
+        """
+        return _compile_xpath(expr)(self)
+
+
+def weaken_parents(root):
+    """
+    Replace the `parent` reference of each decendent of `root` with a weak reference.
+
+    Afterwards the tree contains no reference cycles, so once the last
+    reference to `root` is dropped the whole tree is freed by reference
+    counting rather than by the cyclic garbage collector. As a consequence,
+    a reference to `root` (or the relevant ancestor) must be kept for as long
+    as the `parent` of a decendent is needed. Accessing `parent` is otherwise
+    unchanged, but nodes added to the tree later hold normal references to
+    their parents until this is called again.
+
+    Returns `root`.
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        children = node._children
+        if not children:
+            continue
+        ref = weakref.ref(node)
+        for child in children:
+            try:
+                del child.parent
+            except AttributeError:
+                pass  # Already weak.
+            child._parent_ref = ref
+            if isinstance(child, Element):
+                stack.append(child)
+    return root
+
 
 # --------------------------------------------------------------------
 # Serialization
@@ -594,7 +1387,71 @@ def _escape_attrib(text):
         _raise_serialization_error(text)
 
 
-def _serialize_node(write, node, format):
+def _render_attrib(attrib, format, sort, minify=False):
+    # Return the attributes of a start tag. The result is cached on an Attrib
+    # until the attributes are changed or are rendered with other options.
+    key = format if sort else format + ' unsorted'
+    if minify:
+        key += ' minified'
+    rendered = getattr(attrib, '_rendered', False)  # False if not an Attrib
+    if rendered and attrib._rendered_key == key:
+        return rendered
+    html = format == 'html'
+    text = ''
+    if not sort:
+        items = attrib.items()
+    elif rendered is False:
+        items = sorted(attrib.items())
+    else:
+        items = attrib.sorted_items()
+    for k, v in items:
+        v = _escape_attrib(v)
+        if html and (k == v or (minify and not v)):
+            # handle boolean (and when minifying, empty) attributes
+            text += ' ' + k
+        elif minify and html and _unquoted_attrib_match(v):
+            text += ' {0}={1}'.format(k, v)
+        else:
+            text += ' {0}="{1}"'.format(k, v)
+    if rendered is not False:
+        attrib._rendered = text
+        attrib._rendered_key = key
+    return text
+
+
+def _batch_encoder(write, encoding, encode_entities=False, size=2048):
+    # Return a pair of functions: one which collects pieces of serialized
+    # output and one which passes any collected pieces to `write`, encoded.
+    # Encoding one joined batch is much faster than encoding each small
+    # piece, while memory use stays bounded by the batch size. An
+    # incremental encoder writes any byte order mark only once.
+    encode = codecs.getincrementalencoder(encoding)('xmlcharrefreplace').encode
+    chunks = []
+
+    def flush(final=False):
+        if chunks:
+            write(encode(''.join(_encode_entities(chunks) if encode_entities else chunks)))
+            del chunks[:]
+        if final:
+            write(encode('', True))
+
+    def collect(chunk):
+        chunks.append(chunk)
+        if len(chunks) >= size:
+            flush()
+
+    return collect, flush
+
+
+def _start_tag(node, format, sort=True):
+    # Return the start tag of `node` without the closing bracket.
+    attrib = node.attrib
+    if attrib:
+        return '<' + node.tag + _render_attrib(attrib, format, sort)
+    return '<' + node.tag
+
+
+def _serialize_node(write, node, format, sort=True):
     if is_comment(node):
         write('<!-- {0} -->'.format(_escape_cdata(node)))
     elif is_raw_text(node) or is_entity(node):
@@ -605,105 +1462,2788 @@ def _serialize_node(write, node, format):
         tag = node.tag
         if tag is None:
             for n in node:
-                _serialize_node(write, n, format)
+                _serialize_node(write, n, format, sort)
         else:
-            write('<{0}'.format(tag))
-            attribs = sorted(node.items())  # lexical order
-            for k, v in attribs:
-                v = _escape_attrib(v)
-                if k == v and format == 'html':
-                    # handle boolean attributes
-                    write(' {0}'.format(v))
-                else:
-                    write(' {0}="{1}"'.format(k, v))
-            if format == 'xhtml' and tag.lower() in HTML_EMPTY:
-                write(' />')
+            # Each tag is written along with any following newline in one
+            # piece, as fewer pieces are faster to join or encode.
+            end = '\n' if _newline_required(node) else ''
+            if tag.lower() in HTML_EMPTY:
+                write(_start_tag(node, format, sort) + (' />' if format == 'xhtml' else '>') + end)
+            else:
+                start = '>\n' if _newline_required(node, start=True) else '>'
+                write(_start_tag(node, format, sort) + start)
+                for n in node:
+                    _serialize_node(write, n, format, sort)
+                write('</' + tag + '>' + end)
+    else:
+        _raise_serialization_error(node)
+
+
+def _serialize_node_indented(write, node, format, indent, level, state, sort=True):
+    # `state[0]` is True when the output is at the start of a line. Leaf
+    # children are written inline (rather than recursively) as this is a
+    # hot path.
+    if not isinstance(node, Element):
+        # Serialize a lone leaf node as the only child of a detached fragment.
+        fragment = Element(None)
+        fragment._children.append(node)
+        node = fragment
+    tag = node.tag
+    children = node._children
+    pad = indent * level
+    broken = False
+    if tag is not None:
+        name = tag.lower()
+        if state[0]:
+            write(pad)
+        if name in HTML_PRESERVE_SPACE:
+            # Whitespace is significant. Serialize the element unaltered.
+            _serialize_node(write, node, format, sort)
+            state[0] = _newline_required(node)
+            return
+        state[0] = False
+        if name in HTML_EMPTY:
+            write(_start_tag(node, format, sort) + (' />' if format == 'xhtml' else '>'))
+            children = ()
+        else:
+            write(_start_tag(node, format, sort) + '>')
+            if _newline_required(node, start=True):
+                # Only break the content onto indented lines if it contains
+                # block level elements. Inline content stays on one line.
+                for n in children:
+                    if isinstance(n, Element) and n.tag is not None and n.tag.lower() in HTML_BLOCK:
+                        write('\n')
+                        state[0] = broken = True
+                        level += 1
+                        break
+    inner = indent * level
+    for n in children:
+        if isinstance(n, Element):
+            _serialize_node_indented(write, n, format, indent, level, state, sort)
+            continue
+        if isinstance(n, RawText):
+            write(n)
+            state[0] = n.endswith('\n')
+        elif isinstance(n, Text):
+            if state[0]:
+                # Drop whitespace which would only follow the indentation.
+                n = n.lstrip(' \t\n\r\f')
+                if not n:
+                    continue
+                write(inner)
+            write(_escape_cdata(n))
+            state[0] = n.endswith('\n')
+        else:
+            if state[0]:
+                write(inner)
+            if isinstance(n, Comment):
+                write('<!-- {0} -->'.format(_escape_cdata(n)))
+            elif isinstance(n, Entity):
+                write(n)
+            else:
+                _raise_serialization_error(n)
+            state[0] = False
+    if tag is None:
+        return
+    if children:
+        if broken:
+            if not state[0] and not isinstance(children[-1], RawText):
+                # Place the end tag on its own line.
+                write('\n')
+                state[0] = True
+            if state[0]:
+                write(pad)
+        write('</' + tag + '>')
+    elif name not in HTML_EMPTY:
+        write('</' + tag + '>')
+    state[0] = False
+    if _newline_required(node):
+        write('\n')
+        state[0] = True
+
+
+# Maps each element whose end tag is optional to the set of elements which
+# may immediately follow it without an end tag, and whether the end tag may
+# also be omitted when the element is the last content in its parent.
+_OPTIONAL_END_TAGS = {
+    'p': (set([
+        'address', 'article', 'aside', 'blockquote', 'details', 'div', 'dl',
+        'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+        'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'main', 'menu',
+        'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul'
+    ]), True),
+    'li': (set(['li']), True),
+    'dt': (set(['dt', 'dd']), False),
+    'dd': (set(['dt', 'dd']), True),
+    'rt': (set(['rt', 'rp']), True),
+    'rp': (set(['rt', 'rp']), True),
+    'optgroup': (set(['optgroup']), True),
+    'option': (set(['option', 'optgroup']), True),
+    'thead': (set(['tbody', 'tfoot']), False),
+    'tbody': (set(['tbody', 'tfoot']), True),
+    'tfoot': (set(), True),
+    'tr': (set(['tr']), True),
+    'td': (set(['td', 'th']), True),
+    'th': (set(['td', 'th']), True),
+}
+
+# A "p" end tag is required when it is the last content of these elements.
+_P_END_REQUIRED = set(['a', 'audio', 'del', 'ins', 'map', 'noscript', 'video'])
+
+_collapse_space = re.compile('[ \t\n\r\f]{2,}|[\t\n\r\f]').sub
+
+_unquoted_attrib_match = re.compile('[^ \t\n\r\f"\'=<>`]+$').match
+
+
+def _end_tag_optional(node, rule, siblings, index):
+    # Return True if the end tag of `node`, found at `index` in `siblings`,
+    # may be omitted according to `rule`. Skips siblings which minify to
+    # nothing.
+    followers, at_end = rule
+    for i in range(index + 1, len(siblings)):
+        sibling = siblings[i]
+        if isinstance(sibling, Element):
+            return sibling.tag is not None and sibling.tag.lower() in followers
+        if not (isinstance(sibling, Comment) or (isinstance(sibling, Text) and not sibling)):
+            return False
+    parent = node.parent
+    if not at_end or parent is None or parent.tag is None:
+        return False
+    return node.tag.lower() != 'p' or parent.tag.lower() not in _P_END_REQUIRED
+
+
+def _serialize_node_minified(write, node, format, preserve=False, omit_end=False, sort=True):
+    # Checks are made with isinstance directly and leaf children are written
+    # inline (rather than recursively) as this is a hot path.
+    if not isinstance(node, Element):
+        if isinstance(node, (RawText, Entity)):
+            write(node)
+        elif isinstance(node, Text):
+            write(_escape_cdata(node if preserve else _collapse_space(' ', node)))
+        elif not isinstance(node, Comment):
+            _raise_serialization_error(node)
+        return
+    tag = node.tag
+    html = format == 'html'
+    if tag is not None:
+        start = '<' + tag
+        attrib = node.attrib
+        if attrib:
+            start += _render_attrib(attrib, format, sort, True)
+        name = tag.lower()
+        if name in HTML_EMPTY:
+            write(start + ('>' if html else ' />'))
+            return
+        write(start + '>')
+        preserve = preserve or name in HTML_PRESERVE_SPACE
+    children = node._children
+    for i, n in enumerate(children):
+        if isinstance(n, Element):
+            omit = False
+            if html and n.tag is not None:
+                rule = _OPTIONAL_END_TAGS.get(n.tag.lower())
+                if rule is not None:
+                    omit = _end_tag_optional(n, rule, children, i)
+            _serialize_node_minified(write, n, format, preserve, omit, sort)
+        elif isinstance(n, (RawText, Entity)):
+            write(n)
+        elif isinstance(n, Text):
+            write(_escape_cdata(n if preserve else _collapse_space(' ', n)))
+        elif not isinstance(n, Comment):
+            _raise_serialization_error(n)
+    if tag is not None and not omit_end:
+        write('</' + tag + '>')
+
+
+def _indented_state(children, stop, state):
+    # Return `state[0]` as `_serialize_node_indented` would leave it after
+    # writing `children[:stop]`, starting from `state`, without writing them.
+    for i in range(stop):
+        n = children[i]
+        if isinstance(n, Element):
+            if n.tag is None:
+                state = _indented_state(n._children, len(n._children), state)
             else:
-                write('>')
-                if _newline_required(node, start=True):
-                    write('\n')
-                if tag.lower() not in HTML_EMPTY:
-                    for n in node:
-                        _serialize_node(write, n, format)
-                    write('</{0}>'.format(tag))
+                state = _newline_required(n)
+        elif not isinstance(n, Text):
+            state = False
+        elif isinstance(n, RawText) or not state or n.strip(' \t\n\r\f'):
+            state = n.endswith('\n')
+    return state
+
+
+def _serialize_range(write, node, start, stop, format, minify, indent, sort=True, state=None):
+    # Write the children of element `node` from `start` up to `stop`, which
+    # must be within range. The start tag is written first if `start` is 0
+    # and the end tag last if `stop` is the number of children, so that the
+    # output of consecutive ranges matches that of the whole element. For
+    # indented output, `state` is the list passed between calls. If `None`,
+    # it is worked out from the children before `start`.
+    tag = node.tag
+    name = tag.lower() if tag is not None else None
+    children = () if name in HTML_EMPTY else node._children
+    end = stop == len(children)
+    if indent is not None and name not in HTML_PRESERVE_SPACE:
+        broken = False
+        if children and tag is not None and _newline_required(node, start=True):
+            broken = any(isinstance(n, Element) and n.tag is not None and n.tag.lower() in HTML_BLOCK
+                         for n in children)
+        if state is None:
+            state = [True]
+            if start:
+                state[0] = _indented_state(children, start, broken or tag is None)
+        if start == 0 and tag is not None:
+            write(_start_tag(node, format, sort) + (' />' if format == 'xhtml' and name in HTML_EMPTY else '>'))
+            state[0] = broken
+            if broken:
+                write('\n')
+        # A tagless view of the range serializes it at the given level.
+        fragment = Element(None)
+        fragment._children = children[start:stop]
+        _serialize_node_indented(write, fragment, format, indent, 1 if broken else 0, state, sort)
+        if end and tag is not None:
+            if children and broken and not state[0] and not isinstance(children[-1], RawText):
+                write('\n')
+            if name not in HTML_EMPTY:
+                write('</' + tag + '>')
+            state[0] = False
             if _newline_required(node):
                 write('\n')
+                state[0] = True
+    elif minify:
+        html = format == 'html'
+        if start == 0 and tag is not None:
+            start_tag = '<' + tag
+            if node.attrib:
+                start_tag += _render_attrib(node.attrib, format, sort, True)
+            write(start_tag + (' />' if name in HTML_EMPTY and not html else '>'))
+        preserve = name in HTML_PRESERVE_SPACE
+        for i in range(start, stop):
+            n = children[i]
+            omit = False
+            if html and isinstance(n, Element) and n.tag is not None:
+                rule = _OPTIONAL_END_TAGS.get(n.tag.lower())
+                if rule is not None:
+                    omit = _end_tag_optional(n, rule, children, i)
+            _serialize_node_minified(write, n, format, preserve, omit, sort)
+        if end and tag is not None and name not in HTML_EMPTY:
+            write('</' + tag + '>')
     else:
-        _raise_serialization_error(node)
+        newline = '\n' if tag is not None and _newline_required(node) else ''
+        if start == 0 and tag is not None:
+            if name in HTML_EMPTY:
+                write(_start_tag(node, format, sort) + (' />' if format == 'xhtml' else '>') + newline)
+            else:
+                write(_start_tag(node, format, sort) + ('>\n' if _newline_required(node, start=True) else '>'))
+        for i in range(start, stop):
+            _serialize_node(write, children[i], format, sort)
+        if end and tag is not None and name not in HTML_EMPTY:
+            write('</' + tag + '>' + newline)
 
 
 # --------------------------------------------------------------------
-# Parser
+# Wire Format
+#
+# A serialized tree is the magic bytes, followed by a string table and a
+# preorder stream of node tokens. All integers are unsigned varints.
+#
+#   magic   b'HTW1'
+#   table   count, then for each string: utf-8 byte length, utf-8 bytes
+#   nodes   count, then for each node in preorder:
+#             Element: 0, tag (0 for None, else table index + 1),
+#                      attribute count, (name index, value index) pairs,
+#                      child count
+#             Text: 1, RawText: 2, Comment: 3, Entity: 4; each followed
+#                      by the table index of its content
+
+
+_WIRE_MAGIC = b'HTW1'
+
+_WIRE_ELEMENT, _WIRE_TEXT, _WIRE_RAW_TEXT, _WIRE_COMMENT, _WIRE_ENTITY = range(5)
+
+# The classes whose instances the encoding reproduces exactly.
+_WIRE_CLASSES = {
+    Element: _WIRE_ELEMENT,
+    Text: _WIRE_TEXT,
+    RawText: _WIRE_RAW_TEXT,
+    Comment: _WIRE_COMMENT,
+    Entity: _WIRE_ENTITY,
+}
+
+
+def _wire_code(node):
+    # Return the wire code of `node`, which may be an instance of a subclass.
+    # Order matters as RawText is a subclass of Text.
+    if is_element(node):
+        return _WIRE_ELEMENT
+    if is_raw_text(node):
+        return _WIRE_RAW_TEXT
+    if is_text(node):
+        return _WIRE_TEXT
+    if is_comment(node):
+        return _WIRE_COMMENT
+    if is_entity(node):
+        return _WIRE_ENTITY
+    _raise_serialization_error(node)
 
 
-class TreeBuilderError(Exception):
-    pass
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
 
 
-class TreeBuilder(object):
+def to_wire(node):
     """
-    Generic node structure builder.
+    Return a compact byte string encoding `node` and all of its decendents.
 
-    Converts a sequance of `TreeBuilder.start`, `TreeBuilder.data` and
-    `TreeBuilder.end` method calls to a well-formed node structure.
-    Use this class to build a node structure using an HTML parser or
-    to convert from another HTML like format.
+    The encoding is the inverse of `from_wire`. The node's parent (if any) is
+    not included. Node subclasses are encoded as the built-in node type they
+    derive from. Tags, attribute names and attribute values must be unicode
+    strings (or, on Python 2, native strings encoded as UTF-8).
 
-    Note that a single root element is required. If a document fragment
-    is being built, then you may need to create a root Element with a
-    tag of `None` first. All other nodes can then be created as children
-    of that root (None) Element.
+    Trees of the built-in node types are pickled and deep copied through this
+    encoding. Therefore, each node is copied along with its own subtree and
+    identity shared between nodes is not kept. For example, deep copying a
+    list of a node and one of its decendents returns two separate trees.
+    """
+    return _to_wire(node)
+
+
+def _to_wire(node, exact=False):
+    # Return the wire encoding of `node`. If `exact` is True, return `None`
+    # if the tree contains a node whose class is a subclass or a tag or
+    # attribute which is not a string, rather than raising an error.
+    table = {}
+    strings = []
+    out = bytearray()
+    append = out.append
+    count = 0
+
+    def index(s):
+        # Return the table index of string `s`, adding it if needed.
+        if not isinstance(s, text_type):
+            if not isinstance(s, str):
+                _raise_serialization_error(s)
+            s = s.decode('utf-8')  # A native string on Python 2.
+        i = table.get(s)
+        if i is None:
+            i = table[s] = len(strings)
+            strings.append(s)
+        return i
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if exact:
+            code = _WIRE_CLASSES.get(node.__class__)
+            if code is None:
+                return None
+        else:
+            code = _wire_code(node)
+        append(code)
+        if code == _WIRE_ELEMENT:
+            attrib = node.attrib
+            try:
+                values = [0 if node.tag is None else index(node.tag) + 1, len(attrib)]
+                for k, v in attrib.items():
+                    values.append(index(k))
+                    values.append(index(v))
+            except TypeError:
+                if exact:
+                    return None
+                raise
+            values.append(len(node._children))
+            for n in values:
+                if n < 0x80:
+                    append(n)
+                else:
+                    _write_varint(out, n)
+            stack.extend(reversed(node._children))
+        else:
+            n = index(node)
+            if n < 0x80:
+                append(n)
+            else:
+                _write_varint(out, n)
+
+    head = bytearray(_WIRE_MAGIC)
+    _write_varint(head, len(strings))
+    for s in strings:
+        s = s.encode('utf-8')
+        _write_varint(head, len(s))
+        head.extend(s)
+    _write_varint(head, count)
+    head.extend(out)
+    return bytes(head)
+
+
+def _read_varint(data, pos):
+    # Return the varint at `pos` in `data` and the position following it.
+    n = shift = 0
+    for pos in range(pos, len(data)):
+        b = data[pos]
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos + 1
+        shift += 7
+    raise ValueError('truncated HTMLTree wire encoding')
+
+
+def _read_varints(data, pos):
+    # Return a list of all varints in `data` from `pos` to the end.
+    region = data[pos:]
+    if max(region or b'\0') < 0x80:
+        # Fast path: every value fits in a single byte.
+        return list(region)
+    values = []
+    append = values.append
+    n = shift = 0
+    for b in region:
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            append(n)
+            n = shift = 0
+        else:
+            shift += 7
+    if shift:
+        raise ValueError('truncated HTMLTree wire encoding')
+    return values
 
-    Empty tags must be explicitly closed. A call to `TreeBuilder.end` must
-    be made immediatly after the call to `TreeBuilder.start`. Otherwise,
-    an attempt will be made to append children to an empty tag, which will
-    generate an error.
+
+def from_wire(buf):
     """
+    Return a node tree from a byte string created by `to_wire`.
 
-    def __init__(self):
-        self._nodes = []  # node stack
-        self._last = None  # Last node
+    A `ValueError` is raised if `buf` is not a valid encoding.
+    """
+    data = bytearray(buf)
+    if data[:4] != _WIRE_MAGIC:
+        raise ValueError('not an HTMLTree wire encoding')
+
+    strings = []
+    count, pos = _read_varint(data, 4)
+    for _ in range(count):
+        length, pos = _read_varint(data, pos)
+        end = pos + length
+        if end > len(data):
+            raise ValueError('truncated HTMLTree wire encoding')
+        strings.append(data[pos:end].decode('utf-8'))
+        pos = end
+
+    values = _read_varints(data, pos)
+    stream = iter(values)
+    read = stream.__next__ if sys.version_info[0] == 3 else stream.next
+    root = None
+    stack = []  # [element, number of children still to read]
+    try:
+        for _ in range(read()):
+            code = read()
+            if code == _WIRE_ELEMENT:
+                tag = read()
+                node = Element(None if tag == 0 else strings[tag - 1])
+                attrib = node.attrib
+                for _ in range(read()):
+                    k = strings[read()]
+                    attrib[k] = strings[read()]
+                remaining = read()
+            elif code == _WIRE_TEXT:
+                node = Text(strings[read()])
+            elif code == _WIRE_RAW_TEXT:
+                node = RawText(strings[read()])
+            elif code == _WIRE_COMMENT:
+                node = Comment(strings[read()])
+            elif code == _WIRE_ENTITY:
+                # Bypass validation. The content is already a valid entity.
+                node = text_type.__new__(Entity, strings[read()])
+            else:
+                raise ValueError('unknown node type {0} in HTMLTree wire encoding'.format(code))
+            if stack:
+                top = stack[-1]
+                parent = top[0]
+                node.parent = parent
+                parent._children.append(node)
+                top[1] -= 1
+                if top[1] == 0:
+                    stack.pop()
+            elif root is None:
+                root = node
+            else:
+                raise ValueError('multiple root nodes in HTMLTree wire encoding')
+            if code == _WIRE_ELEMENT and remaining:
+                stack.append([node, remaining])
+    except StopIteration:
+        raise ValueError('truncated HTMLTree wire encoding')
+    except IndexError:
+        raise ValueError('invalid string index in HTMLTree wire encoding')
+    if root is None or stack or next(stream, None) is not None:
+        raise ValueError('invalid HTMLTree wire encoding')
+    return root
 
-    def close(self):
-        """
-        Returns the toplevel node.
-        """
-        if len(self._nodes) != 0:
-            raise TreeBuilderError('Missing end tags.')
-        if self._last is None:
-            raise TreeBuilderError('Missing toplevel element.')
-        return self._last
 
-    def start(self, tag, **attrs):
-        """
-        Open a new Element Node.
-        """
-        self._last = elem = Element(tag, **attrs)
-        if self._nodes:
-            self._nodes[-1].append(elem)
-        self._nodes.append(elem)
+# --------------------------------------------------------------------
+# Interning
 
-    def end(self, tag):
-        """
-        Close the current Element node.
-        """
-        if self._nodes and self._nodes[-1].tag == tag:
-            self._last = self._nodes.pop()
-        elif self._nodes:
-            expected = self._nodes[-1].tag
-            raise TreeBuilderError('End tag mismatch (expected {0}, got {1})'.format(expected, tag))
-        else:
-            raise TreeBuilderError('No nodes to close.')
 
-    def data(self, data, node_type=None):
-        """
-        Add a non-element node to the current Element node.
+def _intern_attrs(pool, tag, attrs):
+    intern = pool.setdefault
+    if tag is not None:
+        tag = intern(tag, tag)
+    return tag, Attrib((intern(k, k), intern(v, v)) for k, v in attrs.items())
 
-        `node_type` should be the class of the desired node type. Defaults to `Text`.
-        """
-        node_type = node_type or Text
-        node = node_type(data)
-        if self._nodes:
-            self._nodes[-1].append(node)
-        else:
-            raise TreeBuilderError('Missing toplevel element.')
+
+def intern_tree(node, pool=None):
+    """
+    Intern the tag and attribute strings of `node` and all of its decendents.
+
+    Identical strings are replaced by a single shared instance from `pool`,
+    which is a dictionary mapping each string to itself. If `pool` is `None`,
+    a new dictionary is used. Returns the pool so that it may be reused for
+    other trees or passed to a `TreeBuilder`.
+
+    Text nodes are not interned as each node holds a reference to its parent.
+    """
+    if pool is None:
+        pool = {}
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if is_element(node):
+            node.tag, node.attrib = _intern_attrs(pool, node.tag, node.attrib)
+            stack.extend(node._children)
+    return pool
+
+
+# --------------------------------------------------------------------
+# Statistics
+
+
+def _utf8_len(text):
+    # Return the length of `text` encoded as UTF-8.
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        return len(text.encode('utf-8', 'surrogatepass'))
+    return len(text)
+
+
+def stats(root):
+    """
+    Return a dictionary of statistics about `root` and its decendents.
+
+    The dictionary contains:
+
+    * `nodes`: the total number of nodes.
+    * The number of nodes of each type, keyed by class name (such as
+      `Element` and `Text`). Types with no nodes are included for the
+      built in node types.
+    * `max_depth`: the greatest number of levels below `root`.
+    * `max_fanout`: the greatest number of children of any one element.
+    * `text_bytes`: the size of all text in Text, RawText, Comment and
+      Entity nodes when encoded as UTF-8.
+    """
+    result = dict.fromkeys(['Element', 'Text', 'RawText', 'Comment', 'Entity'], 0)
+    nodes = max_depth = max_fanout = text_bytes = 0
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        nodes += 1
+        name = node.__class__.__name__
+        result[name] = result.get(name, 0) + 1
+        if depth > max_depth:
+            max_depth = depth
+        if isinstance(node, Element):
+            children = node._children
+            if len(children) > max_fanout:
+                max_fanout = len(children)
+            depth += 1
+            stack.extend((child, depth) for child in children)
+        else:
+            text_bytes += _utf8_len(node)
+    result['nodes'] = nodes
+    result['max_depth'] = max_depth
+    result['max_fanout'] = max_fanout
+    result['text_bytes'] = text_bytes
+    return result
+
+
+# Maps an Element class to the size of the instance dictionary of an
+# element. All elements of a class share the dictionary keys, so one is
+# measured rather than each, which would force Python 3.11+ to create
+# dictionaries it otherwise avoids.
+_element_dict_sizes = {}
+
+
+def _element_dict_size(cls):
+    size = _element_dict_sizes.get(cls)
+    if size is None:
+        probe = cls.__new__(cls)
+        probe.tag = probe._attrib = probe._children = probe.parent = None
+        size = _element_dict_sizes[cls] = sys.getsizeof(probe.__dict__)
+    return size
+
+
+def deep_sizeof(root, seen=None):
+    """
+    Return an estimate in bytes of the memory retained by `root` and its decendents.
+
+    Includes each node and its instance dictionary, and for elements, the
+    list of children, the attribute dictionary and any `ClassList`. Strings
+    used as tags, attribute names and attribute values are counted once
+    each, no matter how many elements share them.
+
+    `seen` is an optional set of the ids of objects already counted. Objects
+    in it are not counted again and those counted are added to it. Pass the
+    same set when sizing several trees to count the strings they share (such
+    as interned tag names) only once.
+    """
+    if seen is None:
+        seen = set()
+    getsizeof = sys.getsizeof
+    total = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        total += getsizeof(node)
+        if not isinstance(node, Element):
+            # Text nodes have a dictionary from the time their parent is set.
+            total += getsizeof(node.__dict__)
+            continue
+        total += _element_dict_size(node.__class__) + getsizeof(node._children)
+        attrib = node._attrib
+        strings = [node.tag]
+        if id(attrib) not in seen:
+            seen.add(id(attrib))
+            total += getsizeof(attrib)
+            for k, v in dict.items(attrib):
+                strings.append(k)
+                strings.append(v)
+        classes = node._classes
+        if classes is not None:
+            total += getsizeof(classes)
+            if classes._tokens is not None:
+                total += getsizeof(classes._tokens)
+                strings.extend(classes._tokens)
+        for s in strings:
+            if s is not None and id(s) not in seen:
+                seen.add(id(s))
+                total += getsizeof(s)
+        stack.extend(node._children)
+    return total
+
+
+# --------------------------------------------------------------------
+# Comparison
+
+
+def _is_blank(node):
+    # Return True if `node` is a Text node of only whitespace.
+    return node.__class__ is Text and not node.split()
+
+
+def _node_path(link):
+    # Return a path such as "/div/p[2]/#text[0]" from a chain of
+    # (parent link, index, node) tuples.
+    parts = []
+    while link is not None:
+        link, index, node = link
+        if isinstance(node, Element):
+            name = node.tag if node.tag is not None else '#fragment'
+        else:
+            name = '#' + node.__class__.__name__.lower()
+        parts.append(name if index is None else '{0}[{1}]'.format(name, index))
+    return '/' + '/'.join(reversed(parts))
+
+
+def tree_diff(a, b, ignore_whitespace=False, ignore_attr_order=True):
+    """
+    Return a description of the first difference between two trees or `None` if they are equal.
+
+    The description starts with the path to the differing node in `a`, such
+    as "/div/p[2]/#text[0]", where each number is the index of a node among
+    its siblings. See `tree_equal` for the arguments.
+    """
+    # Each item is a pair of nodes, the link (see `_node_path`) of their
+    # parent and their index. An item of `None`, the child counts and the
+    # link of an element reports that the elements' children differ in
+    # number once the children both have are found to be equal.
+    stack = [(a, b, None, None)]
+    while stack:
+        a, b, parent, index = stack.pop()
+        if a is None:
+            reason = '{0} children != {1}'.format(*b)
+        elif a is b:
+            continue  # A shared subtree.
+        elif a.__class__ is not b.__class__:
+            reason = '{0} != {1}'.format(a.__class__.__name__, b.__class__.__name__)
+        elif not isinstance(a, Element):
+            if a == b or (ignore_whitespace and a.__class__ is Text and a.split() == b.split()):
+                continue
+            reason = '{0!r} != {1!r}'.format(text_type(a), text_type(b))
+        elif a.tag != b.tag:
+            reason = 'tag {0!r} != {1!r}'.format(a.tag, b.tag)
+        elif a.attrib != b.attrib or not (ignore_attr_order or list(a.attrib) == list(b.attrib)):
+            reason = 'attributes {0!r} != {1!r}'.format(list(a.attrib.items()), list(b.attrib.items()))
+        else:
+            link = (parent, index, a)
+            achildren = a._children
+            bchildren = b._children
+            indexes = None
+            if ignore_whitespace:
+                indexes = [i for i, n in enumerate(achildren) if not _is_blank(n)]
+                achildren = [achildren[i] for i in indexes]
+                bchildren = [n for n in bchildren if not _is_blank(n)]
+            if len(achildren) != len(bchildren):
+                stack.append((None, (len(achildren), len(bchildren)), link, None))
+            for j in range(min(len(achildren), len(bchildren)) - 1, -1, -1):
+                child = achildren[j]
+                other = bchildren[j]
+                if child.__class__ is other.__class__ and not isinstance(child, Element) and child == other:
+                    continue  # Equal leaves are skipped without a stack item.
+                stack.append((child, other, link, j if indexes is None else indexes[j]))
+            continue
+        return '{0}: {1}'.format(_node_path(parent if a is None else (parent, index, a)), reason)
+    return None
+
+
+def tree_equal(a, b, ignore_whitespace=False, ignore_attr_order=True):
+    """
+    Return True if the trees `a` and `b` have the same structure and content.
+
+    Nodes are equal if they are of the same class and have equal content or,
+    for elements, equal tags and attributes and equal children. Parents are
+    not compared. The trees are walked together without recursion and the
+    walk stops at the first difference. Use `tree_diff` to find out what it
+    is. Subtrees shared by both trees are not walked.
+
+    If `ignore_whitespace` is True, Text nodes (but not RawText nodes) which
+    contain only whitespace are skipped and the text of other Text nodes is
+    compared with runs of whitespace collapsed and leading and trailing
+    whitespace removed. If `ignore_attr_order` is False, attributes must have
+    been added in the same order. On Python 2, where attribute order is not
+    kept, attributes may then compare unequal even if added in the same order.
+
+    Adjacent Text nodes are not merged. Call `Element.normalize` on both
+    trees first to compare them regardless of how their text is split.
+    """
+    return tree_diff(a, b, ignore_whitespace, ignore_attr_order) is None
+
+
+# --------------------------------------------------------------------
+# Document Order
+
+class _OrderIndex(object):
+    # Shared by the nodes of one tree. Marked stale by any change to the
+    # structure of the tree (by the methods of `Element`, `TreeBuilder` and
+    # `sanitize`, through `_invalidate_order`).
+    __slots__ = ('stale',)
+
+    def __init__(self):
+        self.stale = False
+
+
+def _invalidate_order(node):
+    # Mark the document order index of the tree containing `node` (if it has
+    # one) as out of date.
+    order = node._order
+    if order is not None:
+        order[0].stale = True
+
+
+def _order_of(node):
+    # Return the `_order` of `node`, first numbering all nodes in its tree if
+    # the index is missing or out of date. It is a tuple of the tree's
+    # `_OrderIndex`, the node's position in preorder, the position of its
+    # last decendent (or its own position) and its depth.
+    order = node._order
+    if order is not None and not order[0].stale:
+        return order
+    root = target = node
+    while root.parent is not None:
+        root = root.parent
+    index = _OrderIndex()
+    count = 0
+    stack = [(root, 0)]
+    while stack:
+        item = stack.pop()
+        node = item[0]
+        if len(item) == 3:
+            # All decendents of `node` have been numbered.
+            node._order = (index, item[1], count - 1, item[2])
+            continue
+        depth = item[1]
+        if isinstance(node, Element) and node._children:
+            stack.append((node, count, depth))
+            depth += 1
+            stack.extend([(child, depth) for child in reversed(node._children)])
+        else:
+            node._order = (index, count, count, depth)
+        count += 1
+    return target._order
+
+
+def is_ancestor(ancestor, node):
+    """
+    Return True if `ancestor` is an ancestor (parent, grandparent and so on) of `node`.
+
+    The first call numbers the nodes of the tree in a single walk. Later
+    calls take constant time, until the structure of the tree is changed.
+    The same numbering is used by `document_position` and `Node.depth`.
+    """
+    a = _order_of(ancestor)
+    b = _order_of(node)
+    return a[0] is b[0] and a[1] < b[1] <= a[2]
+
+
+def document_position(node):
+    """
+    Return the position of `node` in document order (preorder) in its tree.
+
+    The root of the tree is at position 0. Nodes of one tree can be sorted
+    into document order with `sorted(nodes, key=document_position)`. Like
+    `is_ancestor`, this takes constant time while the tree is unchanged.
+    """
+    return _order_of(node)[1]
+
+
+def _order_key(node, trees):
+    # Return a sort key for `node`, numbering its tree in `trees`, which maps
+    # each `_OrderIndex` to the order in which its tree was first seen.
+    order = _order_of(node)
+    rank = trees.get(order[0])
+    if rank is None:
+        rank = trees[order[0]] = len(trees)
+    return rank, order[1]
+
+
+def sort_document_order(nodes):
+    """
+    Return a list of the nodes from the sequence or iterable `nodes` in document order.
+
+    Nodes from different trees are grouped by tree, in the order in which
+    each tree is first seen in `nodes`. Duplicates are kept. Positions are
+    taken from the index used by `document_position`, so sorting k nodes
+    takes O(k log k) time once the index is built.
+    """
+    trees = {}
+    return sorted(nodes, key=lambda node: _order_key(node, trees))
+
+
+def unique(nodes):
+    """
+    Return a list of the distinct nodes from the sequence or iterable `nodes` in document order.
+
+    Nodes are distinct if they are not the same object. Equal Text nodes
+    found in different places in a tree are all kept. See
+    `sort_document_order`.
+    """
+    seen = set()
+    result = []
+    for node in nodes:
+        if id(node) not in seen:
+            seen.add(id(node))
+            result.append(node)
+    return sort_document_order(result)
+
+
+# --------------------------------------------------------------------
+# XPath
+
+
+class XPathError(Exception):
+    pass
+
+
+_xpath_token_re = re.compile(r"""
+    \s*(?:
+        (?P<string>"[^"]*"|'[^']*') |
+        (?P<number>\d+(?:\.\d*)?|\.\d+) |
+        (?P<op>//|::|\.\.|!=|<=|>=|[/.@()\[\],|*=<>+-]) |
+        (?P<name>[A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?)
+    )""", re.X)
+
+_XPATH_NODE_TYPES = set(['node', 'text', 'comment'])
+
+_XPATH_NUMERIC_FUNCTIONS = set(['position', 'last', 'count', 'string-length', 'number'])
+
+_XPATH_REVERSE_AXES = set(['parent', 'ancestor', 'ancestor-or-self', 'preceding-sibling'])
+
+_xpath_cache = {}
+_XPATH_MAXCACHE = 100
+
+
+class _XPathAttribute(object):
+    # An attribute "node". Attributes are not nodes in an HTMLTree tree, but
+    # XPath requires them to be during evaluation.
+    __slots__ = ['parent', 'name', 'value']
+
+    def __init__(self, parent, name, value):
+        self.parent = parent
+        self.name = name
+        self.value = value
+
+
+def _xpath_tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = _xpath_token_re.match(expr, pos)
+        if m is None or m.end() == pos:
+            raise XPathError('invalid XPath expression {0!r} at position {1}'.format(expr, pos))
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'string':
+            value = value[1:-1]
+        elif kind == 'number':
+            value = float(value)
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+# Axes. Each returns the nodes of the axis in proximity order.
+
+def _child_index(parent, node):
+    for i, child in enumerate(parent._children):
+        if child is node:
+            return i
+
+
+def _axis_child(node):
+    return node._children if isinstance(node, Element) else ()
+
+
+def _axis_descendant(node):
+    result = []
+    if isinstance(node, Element):
+        stack = list(reversed(node._children))
+        while stack:
+            node = stack.pop()
+            result.append(node)
+            if isinstance(node, Element) and node._children:
+                stack.extend(reversed(node._children))
+    return result
+
+
+def _axis_descendant_or_self(node):
+    return [node] + _axis_descendant(node)
+
+
+def _axis_parent(node):
+    return (node.parent,) if node.parent is not None else ()
+
+
+def _axis_ancestor(node):
+    result = []
+    node = node.parent
+    while node is not None:
+        result.append(node)
+        node = node.parent
+    return result
+
+
+def _axis_ancestor_or_self(node):
+    return [node] + _axis_ancestor(node)
+
+
+def _axis_following_sibling(node):
+    parent = node.parent
+    if parent is None or isinstance(node, _XPathAttribute):
+        return ()
+    return parent._children[_child_index(parent, node) + 1:]
+
+
+def _axis_preceding_sibling(node):
+    parent = node.parent
+    if parent is None or isinstance(node, _XPathAttribute):
+        return ()
+    return parent._children[_child_index(parent, node) - 1::-1] if parent._children[0] is not node else ()
+
+
+def _axis_self(node):
+    return (node,)
+
+
+def _axis_attribute(node):
+    if not isinstance(node, Element):
+        return ()
+    return [_XPathAttribute(node, k, v) for k, v in node.attrib.items()]
+
+
+_XPATH_AXES = {
+    'child': _axis_child,
+    'descendant': _axis_descendant,
+    'descendant-or-self': _axis_descendant_or_self,
+    'parent': _axis_parent,
+    'ancestor': _axis_ancestor,
+    'ancestor-or-self': _axis_ancestor_or_self,
+    'following-sibling': _axis_following_sibling,
+    'preceding-sibling': _axis_preceding_sibling,
+    'self': _axis_self,
+    'attribute': _axis_attribute,
+}
+
+
+def _node_test(axis, test):
+    # Return a function which returns True if a node passes `test`.
+    if test == 'node()':
+        return lambda node: True
+    if test == 'text()':
+        return lambda node: isinstance(node, BaseTextNode) and not isinstance(node, Comment)
+    if test == 'comment()':
+        return lambda node: isinstance(node, Comment)
+    if axis == 'attribute':
+        if test == '*':
+            return lambda node: True
+        name = test.lower()
+        return lambda node: node.name.lower() == name
+    if test == '*':
+        return lambda node: isinstance(node, Element) and node.tag is not None
+    name = test.lower()
+    return lambda node: isinstance(node, Element) and node.tag is not None and node.tag.lower() == name
+
+
+# Data model. Values are node-sets (lists), strings, floats or booleans.
+
+def _string_value(node):
+    if isinstance(node, _XPathAttribute):
+        return node.value
+    if isinstance(node, Element):
+        return ''.join(_entity_char(n) if isinstance(n, Entity) else n
+                       for n in _axis_descendant(node) if isinstance(n, (Text, Entity)))
+    if isinstance(node, Entity):
+        return _entity_char(node)
+    return text_type(node)
+
+
+def _to_string(value):
+    if isinstance(value, list):
+        return _string_value(value[0]) if value else ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return text_type(int(value)) if value == int(value) else text_type(value)
+    return value
+
+
+def _to_number(value):
+    if isinstance(value, float):
+        return value
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    try:
+        return float(_to_string(value).strip(' \t\n\r'))
+    except ValueError:
+        return float('nan')
+
+
+def _to_boolean(value):
+    if isinstance(value, float):
+        return value == value and value != 0
+    return bool(value)
+
+
+def _compare(op, a, b):
+    # Compare two values with XPath 1.0 semantics.
+    if isinstance(a, list) or isinstance(b, list):
+        if isinstance(a, bool) or isinstance(b, bool):
+            return _compare(op, _to_boolean(a), _to_boolean(b))
+        left = [_string_value(n) for n in a] if isinstance(a, list) else [a]
+        right = [_string_value(n) for n in b] if isinstance(b, list) else [b]
+        return any(_compare(op, x, y) for x in left for y in right)
+    if op in ('=', '!='):
+        if isinstance(a, bool) or isinstance(b, bool):
+            a, b = _to_boolean(a), _to_boolean(b)
+        elif isinstance(a, float) or isinstance(b, float):
+            a, b = _to_number(a), _to_number(b)
+        return (a == b) if op == '=' else (a != b)
+    a, b = _to_number(a), _to_number(b)
+    if op == '<':
+        return a < b
+    if op == '>':
+        return a > b
+    if op == '<=':
+        return a <= b
+    return a >= b
+
+
+def _document_order(nodes, env):
+    # Return `nodes` with duplicates removed in document order. Positions are
+    # taken from the tree's document order index (see `document_position`),
+    # except for an implied document node, which is not part of the tree.
+    document = env['document']
+    seen = set()
+    keyed = []
+    for node in nodes:
+        if isinstance(node, _XPathAttribute):
+            key = (_order_of(node.parent)[1], 1, node.name)
+        else:
+            key = (-1 if node is document else _order_of(node)[1], 0, '')
+        dedupe = (id(node.parent), node.name) if key[1] else id(node)
+        if dedupe not in seen:
+            seen.add(dedupe)
+            keyed.append((key, node))
+    keyed.sort(key=lambda item: item[0])
+    return [node for key, node in keyed]
+
+
+# Functions. Each is called with the context node, position and size and a
+# list of evaluated arguments.
+
+def _fn_name(node, pos, size, args):
+    if args:
+        node = args[0][0] if args[0] else None
+    if isinstance(node, _XPathAttribute):
+        return node.name
+    return node.tag if isinstance(node, Element) and node.tag is not None else ''
+
+
+def _fn_string(node, pos, size, args):
+    return _to_string(args[0]) if args else _string_value(node)
+
+
+def _fn_normalize_space(node, pos, size, args):
+    return ' '.join(_fn_string(node, pos, size, args).split())
+
+
+_XPATH_FUNCTIONS = {
+    'position': (0, 0, lambda node, pos, size, args: float(pos)),
+    'last': (0, 0, lambda node, pos, size, args: float(size)),
+    'count': (1, 1, lambda node, pos, size, args: float(len(args[0]))),
+    'name': (0, 1, _fn_name),
+    'local-name': (0, 1, _fn_name),
+    'string': (0, 1, _fn_string),
+    'string-length': (0, 1, lambda node, pos, size, args: float(len(_fn_string(node, pos, size, args)))),
+    'normalize-space': (0, 1, _fn_normalize_space),
+    'concat': (2, None, lambda node, pos, size, args: ''.join(_to_string(a) for a in args)),
+    'contains': (2, 2, lambda node, pos, size, args: _to_string(args[1]) in _to_string(args[0])),
+    'starts-with': (2, 2, lambda node, pos, size, args: _to_string(args[0]).startswith(_to_string(args[1]))),
+    'not': (1, 1, lambda node, pos, size, args: not _to_boolean(args[0])),
+    'true': (0, 0, lambda node, pos, size, args: True),
+    'false': (0, 0, lambda node, pos, size, args: False),
+    'boolean': (1, 1, lambda node, pos, size, args: _to_boolean(args[0])),
+    'number': (0, 1, lambda node, pos, size, args: _to_number(args[0] if args else [node])),
+}
+
+
+class _XPathParser(object):
+    # A recursive descent parser which compiles an expression into nested
+    # closures. Each expression closure is called with the context node,
+    # position, size and a per evaluation environment dictionary.
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = _xpath_tokenize(expr)
+        self.index = 0
+        self.positional = 0  # count of calls to position() or last()
+
+    def error(self, message):
+        raise XPathError('{0} in XPath expression {1!r}'.format(message, self.expr))
+
+    def peek(self, offset=0):
+        i = self.index + offset
+        return self.tokens[i] if i < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.index += 1
+        return token
+
+    def accept(self, kind, *values):
+        token = self.peek()
+        if token[0] == kind and (not values or token[1] in values):
+            self.index += 1
+            return token[1]
+        return None
+
+    def expect(self, kind, value):
+        if self.accept(kind, value) is None:
+            self.error('expected {0!r}'.format(value))
+
+    def parse(self):
+        if not self.tokens:
+            self.error('empty expression')
+        expr = self.parse_or()
+        if self.index != len(self.tokens):
+            self.error('unexpected {0!r}'.format(self.peek()[1]))
+        return expr
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.accept('name', 'or'):
+            right = self.parse_and()
+            left = (lambda a, b: lambda *c: _to_boolean(a(*c)) or _to_boolean(b(*c)))(left, right)
+        return left
+
+    def parse_and(self):
+        left = self.parse_equality()
+        while self.accept('name', 'and'):
+            right = self.parse_equality()
+            left = (lambda a, b: lambda *c: _to_boolean(a(*c)) and _to_boolean(b(*c)))(left, right)
+        return left
+
+    def parse_comparison(self, operators, parse_operand):
+        left = parse_operand()
+        op = self.accept('op', *operators)
+        while op:
+            right = parse_operand()
+            left = (lambda op, a, b: lambda *c: _compare(op, a(*c), b(*c)))(op, left, right)
+            op = self.accept('op', *operators)
+        return left
+
+    def parse_equality(self):
+        return self.parse_comparison(('=', '!='), self.parse_relational)
+
+    def parse_relational(self):
+        return self.parse_comparison(('<', '>', '<=', '>='), self.parse_additive)
+
+    def parse_additive(self):
+        left = self.parse_multiplicative()
+        op = self.accept('op', '+', '-')
+        while op:
+            right = self.parse_multiplicative()
+            if op == '+':
+                left = (lambda a, b: lambda *c: _to_number(a(*c)) + _to_number(b(*c)))(left, right)
+            else:
+                left = (lambda a, b: lambda *c: _to_number(a(*c)) - _to_number(b(*c)))(left, right)
+            left.numeric = True
+            op = self.accept('op', '+', '-')
+        return left
+
+    def parse_multiplicative(self):
+        left = self.parse_unary()
+        op = self.accept('op', '*') or self.accept('name', 'div', 'mod')
+        while op:
+            right = self.parse_unary()
+            left = (lambda op, a, b: lambda *c: _arithmetic(op, _to_number(a(*c)), _to_number(b(*c))))(op, left, right)
+            left.numeric = True
+            op = self.accept('op', '*') or self.accept('name', 'div', 'mod')
+        return left
+
+    def parse_unary(self):
+        if self.accept('op', '-'):
+            operand = self.parse_unary()
+            negate = lambda *c: -_to_number(operand(*c))  # noqa
+            negate.numeric = True
+            return negate
+        return self.parse_union()
+
+    def parse_union(self):
+        left = self.parse_path()
+        while self.accept('op', '|'):
+            right = self.parse_path()
+            left = (lambda a, b: lambda node, pos, size, env: _union(a(node, pos, size, env),
+                                                                     b(node, pos, size, env), env))(left, right)
+        return left
+
+    def parse_path(self):
+        kind, value = self.peek()
+        if kind == 'op' and value in ('/', '//'):
+            self.next()
+            steps = []
+            if value == '//':
+                steps.append(('descendant-or-self', 'node()', []))
+                steps.extend(self.parse_relative_path())
+            elif self.starts_step():
+                steps.extend(self.parse_relative_path())
+            return _compile_path(None, steps)
+        if kind in ('string', 'number') or (kind == 'op' and value == '(') or (
+                kind == 'name' and self.peek(1) == ('op', '(') and value not in _XPATH_NODE_TYPES):
+            primary = self.parse_primary()
+            predicates = self.parse_predicates()
+            steps = []
+            separator = self.accept('op', '/', '//')
+            if separator == '//':
+                steps.append(('descendant-or-self', 'node()', []))
+            if separator:
+                steps.extend(self.parse_relative_path())
+            if not predicates and not steps:
+                return primary
+            return _compile_path(primary, steps, predicates)
+        return _compile_path(False, self.parse_relative_path())
+
+    def starts_step(self):
+        kind, value = self.peek()
+        return kind == 'name' or (kind == 'op' and value in ('*', '@', '.', '..'))
+
+    def parse_relative_path(self):
+        steps = [self.parse_step()]
+        separator = self.accept('op', '/', '//')
+        while separator:
+            if separator == '//':
+                steps.append(('descendant-or-self', 'node()', []))
+            steps.append(self.parse_step())
+            separator = self.accept('op', '/', '//')
+        return steps
+
+    def parse_step(self):
+        if self.accept('op', '.'):
+            return ('self', 'node()', [])
+        if self.accept('op', '..'):
+            return ('parent', 'node()', [])
+        axis = 'child'
+        if self.accept('op', '@'):
+            axis = 'attribute'
+        elif self.peek(1) == ('op', '::'):
+            axis = self.next()[1]
+            if axis not in _XPATH_AXES:
+                self.error('unsupported axis {0!r}'.format(axis))
+            self.next()
+        if self.accept('op', '*'):
+            test = '*'
+        else:
+            test = self.accept('name')
+            if test is None:
+                self.error('expected a node test')
+            if test in _XPATH_NODE_TYPES and self.accept('op', '('):
+                self.expect('op', ')')
+                test += '()'
+        return (axis, test, self.parse_predicates())
+
+    def parse_predicates(self):
+        predicates = []
+        while self.accept('op', '['):
+            positional = self.positional
+            predicate = self.parse_or()
+            # A predicate is positional if its result depends on the
+            # position of the node in the node-set.
+            predicate.positional = self.positional > positional or getattr(predicate, 'numeric', False)
+            predicates.append(predicate)
+            self.expect('op', ']')
+        return predicates
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind in ('string', 'number'):
+            literal = lambda *c: value  # noqa
+            literal.constant = value
+            literal.numeric = kind == 'number'
+            return literal
+        if kind == 'op':
+            expr = self.parse_or()
+            self.expect('op', ')')
+            return expr
+        if value not in _XPATH_FUNCTIONS:
+            self.error('unsupported function {0!r}'.format(value))
+        minimum, maximum, function = _XPATH_FUNCTIONS[value]
+        self.next()
+        args = []
+        if not self.accept('op', ')'):
+            args.append(self.parse_or())
+            while self.accept('op', ','):
+                args.append(self.parse_or())
+            self.expect('op', ')')
+        if len(args) < minimum or (maximum is not None and len(args) > maximum):
+            self.error('wrong number of arguments to {0}()'.format(value))
+        if value in ('position', 'last'):
+            self.positional += 1
+
+        def call(node, pos, size, env):
+            return function(node, pos, size, [arg(node, pos, size, env) for arg in args])
+        call.numeric = value in _XPATH_NUMERIC_FUNCTIONS
+        return call
+
+
+def _arithmetic(op, a, b):
+    if op == '*':
+        return a * b
+    if op == 'mod':
+        return math.fmod(a, b) if b else float('nan')
+    if b:
+        return a / b
+    if a == 0 or a != a:
+        return float('nan')
+    return float('inf') if a > 0 else float('-inf')
+
+
+def _union(a, b, env):
+    if not isinstance(a, list) or not isinstance(b, list):
+        raise XPathError('the operands of "|" must be node-sets')
+    return _document_order(a + b, env)
+
+
+def _filter(nodes, predicates, env):
+    # Filter `nodes` (in proximity order) by each predicate in turn.
+    for predicate in predicates:
+        size = len(nodes)
+        constant = getattr(predicate, 'constant', None)
+        if isinstance(constant, float):
+            # A literal position such as "[2]".
+            index = int(constant) - 1
+            nodes = [nodes[index]] if constant == index + 1 and 0 <= index < size else []
+            continue
+        result = []
+        for pos, node in enumerate(nodes, 1):
+            value = predicate(node, pos, size, env)
+            if isinstance(value, float):
+                if value == pos:
+                    result.append(node)
+            elif _to_boolean(value):
+                result.append(node)
+        nodes = result
+    return nodes
+
+
+def _in_document_order(axis, nodes):
+    # Return True if the results of applying `axis` to each of `nodes` in
+    # turn are in document order without duplicates (or only need duplicates
+    # removed in the case of the descendant axes).
+    if axis.startswith('descendant') or axis == 'self':
+        return True
+    if axis in ('child', 'attribute'):
+        # Only out of order if one context node contains another.
+        contexts = set(map(id, nodes))
+        for node in nodes:
+            node = node.parent
+            while node is not None:
+                if id(node) in contexts:
+                    return False
+                node = node.parent
+        return True
+    return False
+
+
+def _compile_step(axis, test, predicates):
+    axis_function = _XPATH_AXES[axis]
+    node_test = _node_test(axis, test)
+    reverse = axis in _XPATH_REVERSE_AXES
+
+    def step(nodes, env):
+        # `nodes` is always in document order without duplicates.
+        result = []
+        for node in nodes:
+            matches = [n for n in axis_function(node) if node_test(n)]
+            if predicates:
+                matches = _filter(matches, predicates, env)
+            result.extend(matches)
+        if reverse or (len(nodes) > 1 and not _in_document_order(axis, nodes)):
+            result = _document_order(result, env)
+        elif len(nodes) > 1 and axis.startswith('descendant'):
+            # Nested context nodes produce duplicates but no reordering.
+            seen = set()
+            result = [n for n in result if id(n) not in seen and not seen.add(id(n))]
+        return result
+    return step
+
+
+def _compile_path(start, steps, predicates=None):
+    # `start` is None for an absolute path, False for a relative path or
+    # else a compiled expression which returns the initial node-set.
+    optimized = []
+    for step in steps:
+        # "//name[predicate]" is equivalent to "descendant::name[predicate]"
+        # unless a predicate depends on the position of the node.
+        if (optimized and optimized[-1] == ('descendant-or-self', 'node()', []) and
+                step[0] == 'child' and not any(p.positional for p in step[2])):
+            optimized[-1] = ('descendant', step[1], step[2])
+        else:
+            optimized.append(step)
+    steps = [_compile_step(*step) for step in optimized]
+
+    def path(node, pos, size, env):
+        if start is None:
+            nodes = [env['document']]
+        elif start is False:
+            nodes = [node]
+        else:
+            nodes = start(node, pos, size, env)
+            if not isinstance(nodes, list):
+                raise XPathError('expected a node-set')
+            if predicates:
+                nodes = _filter(_document_order(nodes, env), predicates, env)
+        for step in steps:
+            nodes = step(nodes, env)
+        return nodes
+    return path
+
+
+class XPath(object):
+    """
+    A compiled XPath expression.
+
+    Supports location paths with the child, descendant, descendant-or-self,
+    parent, ancestor, ancestor-or-self, following-sibling, preceding-sibling,
+    self and attribute axes (and their abbreviations), the `*`, `node()`,
+    `text()` and `comment()` node tests, predicates, the usual operators and
+    the core functions most useful with HTML: `position`, `last`, `count`,
+    `name`, `local-name`, `string`, `string-length`, `normalize-space`,
+    `concat`, `contains`, `starts-with`, `not`, `true`, `false`, `boolean`
+    and `number`.
+
+    Tag and attribute names are matched case-insensitively. The document
+    node is the root of the tree if its tag is `None`, otherwise it is an
+    implied parent of the root.
+
+    `XPathError` is raised for invalid or unsupported expressions.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self._evaluate = _XPathParser(expr).parse()
+
+    def __repr__(self):
+        return '<{0}({1!r}) at {2:#x}>'.format(self.__class__.__name__, self.expr, id(self))
+
+    def __call__(self, node):
+        """
+        Evaluate the expression with `node` as the context node.
+
+        Returns a list for node-sets (attributes are returned as their string
+        values), otherwise a string, float or boolean.
+        """
+        root = node
+        while root.parent is not None:
+            root = root.parent
+        if not isinstance(root, Element) or root.tag is not None:
+            # Imply a document node. Do not use `append` as that would make
+            # it the parent of the root.
+            document = Element(None)
+            document._children.append(root)
+            root = document
+        result = self._evaluate(node, 1, 1, {'document': root})
+        if isinstance(result, list):
+            return [n.value if isinstance(n, _XPathAttribute) else n for n in result]
+        return result
+
+
+def _compile_xpath(expr):
+    try:
+        return _xpath_cache[expr]
+    except KeyError:
+        if len(_xpath_cache) >= _XPATH_MAXCACHE:
+            _xpath_cache.clear()
+        compiled = _xpath_cache[expr] = XPath(expr)
+        return compiled
+
+
+# --------------------------------------------------------------------
+# Sanitizing
+
+# Attributes whose values are URLs and are checked against a policy's
+# protocols.
+_URL_ATTRIBUTES = set([
+    'href', 'src', 'action', 'cite', 'formaction', 'poster', 'background',
+    'longdesc', 'lowsrc', 'dynsrc', 'usemap', 'codebase', 'data'
+])
+
+# Characters browsers ignore when reading a URL scheme.
+_url_ignore = re.compile('[\x00-\x20\x7f]+')
+
+
+class Policy(object):
+    """
+    The rules which `sanitize` applies to a tree.
+
+    `tags` is the set of allowed element tags. Elements with any other tag
+    are replaced by their (sanitized) children, except for those with a tag
+    in `drop`, which are removed along with their content.
+
+    `attributes` maps a tag to the set of attributes allowed on that tag. The
+    attributes mapped to `'*'` are allowed on every tag. All other
+    attributes are removed.
+
+    `protocols` is the set of URL schemes allowed in the value of attributes
+    which contain a URL (such as "href" and "src"). Relative URLs are always
+    allowed. An attribute with any other scheme is removed.
+
+    Comment nodes are removed unless `comments` is `True`. RawText nodes are
+    never escaped when serialized and are always removed.
+
+    """
+
+    def __init__(self, tags=None, attributes=None, protocols=None, drop=None, comments=False):
+        self.tags = set(tags if tags is not None else [
+            'a', 'abbr', 'acronym', 'b', 'blockquote', 'br', 'code', 'dd', 'del',
+            'dl', 'dt', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i',
+            'img', 'ins', 'kbd', 'li', 'ol', 'p', 'pre', 'q', 's', 'samp',
+            'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th',
+            'thead', 'tr', 'u', 'ul'
+        ])
+        if attributes is None:
+            attributes = {
+                '*': ['title'],
+                'a': ['href'],
+                'abbr': ['title'],
+                'img': ['src', 'alt', 'width', 'height'],
+                'td': ['colspan', 'rowspan'],
+                'th': ['colspan', 'rowspan']
+            }
+        self.attributes = dict((tag, set(attrs)) for tag, attrs in attributes.items())
+        self.protocols = set(protocols if protocols is not None else ['http', 'https', 'mailto'])
+        self.drop = set(drop if drop is not None else ['script', 'style', 'iframe', 'object', 'embed', 'template'])
+        self.comments = comments
+
+    def allowed_attributes(self, tag):
+        """
+        Return the set of attributes allowed on elements with `tag`.
+        """
+        return self.attributes.get(tag, set()) | self.attributes.get('*', set())
+
+    def allowed_url(self, value):
+        """
+        Return `True` if the URL `value` has no scheme or an allowed scheme.
+        """
+        value = _url_ignore.sub('', value)
+        scheme, sep, rest = value.partition(':')
+        if not sep or '/' in scheme or '?' in scheme or '#' in scheme:
+            # No scheme; a relative URL.
+            return True
+        return scheme.lower() in self.protocols
+
+
+def sanitize(root, policy=None):
+    """
+    Remove everything from the children of `root` which `policy` does not allow.
+
+    `policy` is a `Policy` and defaults to `Policy()`. The tag and attributes
+    of `root` itself are left unchanged. The tree is modified in place and
+    `root` is returned.
+
+    The tree is walked once. The child list of each element is rebuilt in a
+    single pass, so removing or unwrapping any number of nodes is linear in
+    the size of the tree.
+
+    """
+    _invalidate_order(root)
+    if policy is None:
+        policy = Policy()
+    tags = policy.tags
+    drop = policy.drop
+    comments = policy.comments
+    attr_cache = {}
+    pending = [root]
+    while pending:
+        parent = pending.pop()
+        children = []
+        # Children of unwrapped elements are spliced in place of the element,
+        # so a stack of iterators is used to walk them in order.
+        stack = [iter(parent._children)]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, Element):
+                    tag = child.tag
+                    if tag in tags:
+                        allowed = attr_cache.get(tag)
+                        if allowed is None:
+                            allowed = attr_cache[tag] = policy.allowed_attributes(tag)
+                        attrib = child.attrib
+                        for key in list(attrib):
+                            if key not in allowed or (key in _URL_ATTRIBUTES and not policy.allowed_url(attrib[key])):
+                                del attrib[key]
+                        child.parent = parent
+                        children.append(child)
+                        if child._children:
+                            pending.append(child)
+                    else:
+                        child.parent = None
+                        grandchildren = child._children
+                        child._children = []
+                        if tag not in drop:
+                            stack.append(iter(grandchildren))
+                            break
+                        for node in grandchildren:
+                            node.parent = None
+                elif isinstance(child, RawText) or (isinstance(child, Comment) and not comments):
+                    child.parent = None
+                else:
+                    child.parent = parent
+                    children.append(child)
+            else:
+                stack.pop()
+        parent._children = children
+    return root
+
+
+# --------------------------------------------------------------------
+# Parser
+
+
+class TreeBuilderError(Exception):
+    pass
+
+
+class TreeBuilder(object):
+    """
+    Generic node structure builder.
+
+    Converts a sequance of `TreeBuilder.start`, `TreeBuilder.data` and
+    `TreeBuilder.end` method calls to a well-formed node structure.
+    Use this class to build a node structure using an HTML parser or
+    to convert from another HTML like format.
+
+    Note that a single root element is required. If a document fragment
+    is being built, then you may need to create a root Element with a
+    tag of `None` first. All other nodes can then be created as children
+    of that root (None) Element.
+
+    Empty tags must be explicitly closed. A call to `TreeBuilder.end` must
+    be made immediatly after the call to `TreeBuilder.start`. Otherwise,
+    an attempt will be made to append children to an empty tag, which will
+    generate an error.
+
+    Set `intern` to `True` to intern tag names and attribute names and values
+    so that identical strings are shared by all Elements built. A dictionary
+    may be passed instead to share a single string pool between builders
+    (see `intern_tree`). Note that a shared pool grows with every distinct
+    string it is given.
+
+    Set `coalesce` to `True` to merge consecutive `data` calls which create
+    Text (or RawText) nodes into a single node, as a parser may deliver the
+    text of a single run in many pieces.
+    """
+
+    def __init__(self, intern=False, coalesce=False):
+        self._nodes = []  # node stack
+        self._last = None  # Last node
+        if intern is True:
+            intern = {}
+        self._pool = None if intern is False else intern
+        self._coalesce = coalesce
+        self._data = []  # pending data
+        self._data_type = None  # node type of pending data
+
+    def _flush(self):
+        # Add a node for the pending data.
+        node = self._data_type(''.join(self._data))
+        parent = self._nodes[-1]
+        _invalidate_order(parent)
+        node.parent = parent
+        parent._children.append(node)
+        self._data = []
+        self._data_type = None
+
+    def close(self):
+        """
+        Returns the toplevel node.
+        """
+        if len(self._nodes) != 0:
+            raise TreeBuilderError('Missing end tags.')
+        if self._last is None:
+            raise TreeBuilderError('Missing toplevel element.')
+        return self._last
+
+    def start(self, tag, attrs=None, **kwattrs):
+        """
+        Open a new Element Node.
+
+        Attributes may be passed as a mapping or a sequence of (name, value)
+        pairs in `attrs`, as keyword arguments, or both.
+        """
+        if self._data:
+            self._flush()
+        if attrs is None:
+            attrs = kwattrs
+        elif kwattrs or not hasattr(attrs, 'items'):
+            attrs = Attrib(attrs, **kwattrs)
+        if self._pool is not None:
+            tag, attrs = _intern_attrs(self._pool, tag, attrs)
+        self._last = elem = Element(tag, attrs)
+        if self._nodes:
+            # The node was built here, so only the parent needs checking.
+            parent = self._nodes[-1]
+            parent._assert_can_contain_children()
+            _invalidate_order(parent)
+            elem.parent = parent
+            parent._children.append(elem)
+        self._nodes.append(elem)
+
+    def end(self, tag):
+        """
+        Close the current Element node.
+        """
+        if self._data:
+            self._flush()
+        if self._nodes and self._nodes[-1].tag == tag:
+            self._last = self._nodes.pop()
+        elif self._nodes:
+            expected = self._nodes[-1].tag
+            raise TreeBuilderError('End tag mismatch (expected {0}, got {1})'.format(expected, tag))
+        else:
+            raise TreeBuilderError('No nodes to close.')
+
+    def data(self, data, node_type=None):
+        """
+        Add a non-element node to the current Element node.
+
+        `node_type` should be the class of the desired node type. Defaults to `Text`.
+        """
+        node_type = node_type or Text
+        if not self._nodes:
+            raise TreeBuilderError('Missing toplevel element.')
+        if self._data:
+            if node_type is self._data_type:
+                self._data.append(data)
+                return
+            self._flush()
+        if self._coalesce and (node_type is Text or node_type is RawText):
+            self._nodes[-1]._assert_can_contain_children()
+            self._data.append(data)
+            self._data_type = node_type
+            return
+        node = node_type(data)
+        parent = self._nodes[-1]
+        parent._assert_can_contain_children()
+        _invalidate_order(parent)
+        node.parent = parent
+        parent._children.append(node)
+
+
+# Maps table tags to the set of open tags which they close (along with any
+# tags opened since) and the set of tags beyond which no tag is closed.
+_IMPLIED_END_SCOPES = {
+    'td': (set(['td', 'th']), set(['tr', 'table'])),
+    'th': (set(['td', 'th']), set(['tr', 'table'])),
+    'tr': (set(['tr']), set(['thead', 'tbody', 'tfoot', 'table'])),
+    'thead': (set(['thead', 'tbody', 'tfoot']), set(['table'])),
+    'tbody': (set(['thead', 'tbody', 'tfoot']), set(['table'])),
+    'tfoot': (set(['thead', 'tbody', 'tfoot']), set(['table'])),
+}
+
+
+class Parser(_HTMLParser):
+    """
+    An HTML parser which builds a node tree.
+
+    Parses HTML with the standard library's `HTMLParser` and passes the
+    result to `target` as a sequence of `start`, `end` and `data` calls. The
+    attributes of each element are passed to `start` as a dictionary.
+    `target` defaults to a new `TreeBuilder` which merges adjacent text. The
+    result of `target.close()` is returned by `close`.
+
+    The document is always wrapped in a root Element with a tag of `None`.
+    The parser is lenient: empty elements need not be closed, end tags which
+    HTML allows to be omitted are implied, stray end tags are ignored and
+    any elements left open are closed by `close`.
+
+    The content of "script" and "style" elements is passed on as RawText,
+    comments as Comment nodes and declarations (such as a doctype) as
+    RawText. Character references are converted to characters.
+    """
+
+    def __init__(self, target=None):
+        if sys.version_info[0] == 3:  # pragma: no cover
+            _HTMLParser.__init__(self, convert_charrefs=True)
+        else:                         # pragma: no cover
+            _HTMLParser.__init__(self)
+        self.target = target if target is not None else TreeBuilder(coalesce=True)
+        self._open = []  # stack of open tags
+        self.target.start(None)
+
+    def _end(self):
+        self.target.end(self._open.pop())
+
+    def handle_starttag(self, tag, attrs):
+        # Imply any end tags which this tag makes optional.
+        while self._open:
+            rule = _OPTIONAL_END_TAGS.get(self._open[-1])
+            if rule is None or tag not in rule[0]:
+                break
+            self._end()
+        scope = _IMPLIED_END_SCOPES.get(tag)
+        if scope is not None:
+            # Close an open cell, row or section, and anything in it.
+            closes, bounds = scope
+            for i in range(len(self._open) - 1, -1, -1):
+                name = self._open[i]
+                if name in closes:
+                    while len(self._open) > i:
+                        self._end()
+                    break
+                if name in bounds:
+                    break
+        attrib = {}
+        for k, v in attrs:
+            if k not in attrib:
+                # An attribute without a value is a boolean attribute.
+                attrib[k] = k if v is None else v
+        self.target.start(tag, attrib)
+        if tag in HTML_EMPTY:
+            self.target.end(tag)
+        else:
+            self._open.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._open:
+            while self._open[-1] != tag:
+                self._end()
+            self._end()
+
+    def handle_data(self, data):
+        if self._open and self._open[-1] in ('script', 'style'):
+            self.target.data(data, RawText)
+        else:
+            self.target.data(data)
+
+    def handle_entityref(self, name):  # pragma: no cover
+        # Only called when `convert_charrefs` is not supported (Python 2).
+        self.handle_data(self.unescape('&{0};'.format(name)))
+
+    def handle_charref(self, name):  # pragma: no cover
+        # Only called when `convert_charrefs` is not supported (Python 2).
+        self.handle_data(self.unescape('&#{0};'.format(name)))
+
+    def handle_comment(self, data):
+        # The serializer adds a space on each side of a comment.
+        self.target.data(data.strip(), Comment)
+
+    def handle_decl(self, decl):
+        self.target.data('<!{0}>'.format(decl), RawText)
+
+    def unknown_decl(self, data):
+        self.target.data('<![{0}]>'.format(data), RawText)
+
+    def close(self):
+        """
+        Finish parsing and return the result of `target.close()`.
+        """
+        _HTMLParser.close(self)
+        while self._open:
+            self._end()
+        self.target.end(None)
+        return self.target.close()
+
+
+def from_string(text, target=None):
+    """
+    Parse a string of HTML and return the root node.
+
+    See `Parser` for details of the tree returned and for `target`.
+    """
+    parser = Parser(target)
+    parser.feed(text)
+    return parser.close()
+
+
+def parse(source, encoding='utf-8', target=None):
+    """
+    Parse an HTML file and return the root node.
+
+    `source` is a filename or a file object. If a file object returns bytes,
+    or `source` is a filename, the content is decoded with `encoding`.
+
+    See `Parser` for details of the tree returned and for `target`.
+    """
+    if not hasattr(source, 'read'):
+        with io.open(source, encoding=encoding) as f:
+            return parse(f, encoding, target)
+    parser = Parser(target)
+    while True:
+        data = source.read(65536)
+        if not data:
+            break
+        if isinstance(data, bytes):
+            data = data.decode(encoding)
+        parser.feed(data)
+    return parser.close()
+
+
+# --------------------------------------------------------------------
+# Streaming
+
+
+class Filter(object):
+    """
+    A stage of a streaming pipeline.
+
+    Receives the same `start`, `end`, `data` and `close` calls as a
+    `TreeBuilder` and passes them on to `target`, which may be another
+    Filter, a `TreeBuilder` or a `StreamWriter`. Attributes are passed on to
+    the `start` method of `target` as a mapping (or `None`), never as keyword
+    arguments, so that any attribute name is allowed. Subclasses override the
+    methods for the events they change. For example, a filter which drops
+    "script" elements and everything in them::
+
+        class DropScripts(Filter):
+            depth = 0
+
+            def start(self, tag, attrs=None):
+                if self.depth or tag == 'script':
+                    self.depth += 1
+                else:
+                    Filter.start(self, tag, attrs)
+
+            def end(self, tag):
+                if self.depth:
+                    self.depth -= 1
+                else:
+                    Filter.end(self, tag)
+
+            def data(self, data, node_type=None):
+                if not self.depth:
+                    Filter.data(self, data, node_type)
+
+    A pipeline is built from the end backwards and driven by a `Parser`::
+
+        parser = Parser(DropScripts(StreamWriter(sys.stdout)))
+
+    """
+
+    def __init__(self, target):
+        self.target = target
+
+    def start(self, tag, attrs=None, **kwattrs):
+        if kwattrs:
+            attrs = Attrib(attrs or (), **kwattrs)
+        self.target.start(tag, attrs)
+
+    def end(self, tag):
+        self.target.end(tag)
+
+    def data(self, data, node_type=None):
+        self.target.data(data, node_type)
+
+    def close(self):
+        return self.target.close()
+
+
+class StreamWriter(object):
+    """
+    Serialize `start`, `end` and `data` calls as they are received.
+
+    The output is identical to that of `to_string` for the tree a
+    `TreeBuilder` would build from the same calls, but no tree is built:
+    only the tags of the open elements are held in memory. `out` is a
+    function or a file-like object with a `write` method which is passed
+    each piece of output. `format` may be one of "html" or "xhtml".
+    """
+
+    def __init__(self, out, format='html'):
+        self._write = getattr(out, 'write', out)
+        self.format = format
+        self._open = []  # stack of [tag, parent tag]
+        self._pending = False  # a newline is due before any content
+
+    def _content(self):
+        # Prepare to write content to the current element.
+        if not self._open:
+            raise TreeBuilderError('Missing toplevel element.')
+        tag = self._open[-1][0]
+        if tag is not None and tag.lower() in HTML_EMPTY:
+            raise TreeBuilderError('{0} is an "empty" HTML element and cannot accept any children'.format(tag))
+        if self._pending:
+            self._write('\n')
+            self._pending = False
+
+    def start(self, tag, attrs=None, **kwattrs):
+        if kwattrs:
+            attrs = Attrib(attrs or (), **kwattrs)
+        if self._open:
+            self._content()
+        parent = self._open[-1][0] if self._open else None
+        self._open.append((tag, parent))
+        if tag is None:
+            return
+        start = '<' + tag
+        if attrs:
+            start += _render_attrib(attrs, self.format, True)
+        name = tag.lower()
+        if name in HTML_EMPTY:
+            self._write(start + (' />' if self.format == 'xhtml' else '>'))
+        else:
+            self._write(start + '>')
+            # A newline follows the start tag of a block only if it has content.
+            self._pending = name in HTML_BLOCK and name != 'p'
+
+    def end(self, tag):
+        if not self._open:
+            raise TreeBuilderError('No nodes to close.')
+        current, parent = self._open[-1]
+        if current != tag:
+            raise TreeBuilderError('End tag mismatch (expected {0}, got {1})'.format(current, tag))
+        self._open.pop()
+        self._pending = False
+        if tag is None:
+            return
+        name = tag.lower()
+        if name not in HTML_EMPTY:
+            self._write('</{0}>'.format(tag))
+        if name in HTML_BLOCK or name == 'br' or (
+                name == 'img' and (parent is None or parent not in ['p', 'P'])):
+            self._write('\n')
+
+    def data(self, data, node_type=None):
+        self._content()
+        if node_type is None or node_type is Text:
+            self._write(_escape_cdata(data))
+        elif node_type is Comment:
+            self._write('<!-- {0} -->'.format(_escape_cdata(data)))
+        else:
+            self._write(node_type(data))
+
+    def close(self):
+        if self._open:
+            raise TreeBuilderError('Missing end tags.')
+
+
+# --------------------------------------------------------------------
+# Templates
+
+
+class Slot(Text):
+    """
+    A placeholder for dynamic text in a template (see `compile_template`).
+
+    A Slot may be used as a child node or as the value of an attribute.
+    `name` is the name of the parameter which supplies its text and must be
+    a valid Python identifier which is not a keyword. When the tree is
+    serialized directly, the Slot renders as a Text node containing
+    `default`.
+
+    """
+
+    def __new__(cls, name, default=''):
+        if not _identifier_match(name) or keyword.iskeyword(name) or name in ('None', 'True', 'False'):
+            raise ValueError('{0!r} is not a valid slot name.'.format(name))
+        node = super(Slot, cls).__new__(cls, default)
+        node.name = name
+        return node
+
+    def __getnewargs__(self):
+        return self.name, text_type(self)
+
+
+_identifier_match = re.compile('[A-Za-z_][A-Za-z0-9_]*$').match
+
+_TEMPLATE_VERSION = 1
+
+
+def _render_slot_attrib(name, value, html):
+    # Return an attribute whose value was supplied for a Slot. Matches the
+    # output of `_render_attrib`.
+    value = _escape_attrib(value)
+    if html and name == value:
+        return ' ' + name
+    return ' {0}="{1}"'.format(name, value)
+
+
+def _find_slots(node, dynamic):
+    # Add the id of each element which contains a Slot (as a decendent or an
+    # attribute value) to `dynamic`. Return True if `node` contains a Slot.
+    if not isinstance(node, Element):
+        return isinstance(node, Slot)
+    found = any(isinstance(v, Slot) for v in node.attrib.values())
+    for child in node._children:
+        if _find_slots(child, dynamic):
+            found = True
+    if found:
+        dynamic.add(id(node))
+    return found
+
+
+def _template_parts(node, format, dynamic, parts):
+    # Append the serialized `node` to `parts`, as strings, `(name,)` for a
+    # text slot and `(name, attribute)` for an attribute slot. Subtrees
+    # without slots are serialized by the regular serializer.
+    if isinstance(node, Slot):
+        parts.append((node.name,))
+        return
+    if id(node) not in dynamic:
+        _serialize_node(parts.append, node, format)
+        return
+    tag = node.tag
+    if tag is not None:
+        parts.append('<' + tag)
+        attrib = node.attrib
+        for k, v in (attrib.sorted_items() if isinstance(attrib, Attrib) else sorted(attrib.items())):
+            if isinstance(v, Slot):
+                parts.append((v.name, k))
+            else:
+                parts.append(_render_attrib({k: v}, format, True))
+        end = '\n' if _newline_required(node) else ''
+        if tag.lower() in HTML_EMPTY:
+            parts.append((' />' if format == 'xhtml' else '>') + end)
+            return
+        parts.append('>\n' if _newline_required(node, start=True) else '>')
+    for child in node._children:
+        _template_parts(child, format, dynamic, parts)
+    if tag is not None:
+        parts.append('</' + tag + '>' + end)
+
+
+def template_source(root, format='html', name='render'):
+    """
+    Return the Python source of a module which renders the tree `root`.
+
+    The module defines a function called `name` which takes a parameter for
+    each distinct `Slot` in the tree (in document order) and returns the
+    same string as `root.to_string(format)` would with the text of each
+    Slot replaced by the value passed for it. All markup without a Slot is
+    rendered once, when the source is generated.
+    """
+    dynamic = set()
+    _find_slots(root, dynamic)
+    parts = []
+    _template_parts(root, format, dynamic, parts)
+    params = []
+    for part in parts:
+        if not isinstance(part, text_type) and part[0] not in params:
+            params.append(part[0])
+    # Import the helpers under names which no parameter shadows.
+    escape, render_attrib = '_escape_cdata', '_render_slot_attrib'
+    while escape in params:
+        escape = '_' + escape
+    while render_attrib in params:
+        render_attrib = '_' + render_attrib
+    code = []
+    text = []
+    for part in parts + [None]:
+        if isinstance(part, text_type):
+            text.append(part)
+            continue
+        if text:
+            code.append(repr(''.join(text)))
+            text = []
+        if part is None:
+            break
+        if len(part) == 1:
+            code.append('{0}({1})'.format(escape, part[0]))
+        else:
+            code.append('{0}({1!r}, {2}, {3})'.format(render_attrib, part[1], part[0], format == 'html'))
+    lines = [
+        '# Generated by htree.template_source. Do not edit.',
+        '# htree template version {0}'.format(_TEMPLATE_VERSION),
+        'from __future__ import unicode_literals',
+        'from htree import _escape_cdata as {0}, _render_slot_attrib as {1}'.format(escape, render_attrib),
+        '',
+        '',
+        'def {0}({1}):'.format(name, ', '.join(params)),
+    ]
+    if not code:
+        lines.append("    return ''")
+    elif len(code) == 1:
+        lines.append('    return {0}'.format(code[0]))
+    else:
+        lines.append("    return ''.join((")
+        lines.extend('        {0},'.format(c) for c in code)
+        lines.append('    ))')
+    return '\n'.join(lines) + '\n'
+
+
+def compile_template(root, format='html', cache_dir=None):
+    """
+    Compile the tree `root` to a function which renders it.
+
+    The function takes a parameter for each `Slot` in the tree (see
+    `template_source`) and returns the same string as `to_string` would.
+
+    If `cache_dir` is given, the generated module is saved in that directory
+    under a name derived from its source and imported from there, so that
+    Python's bytecode cache is used and later calls with an identical tree
+    only need to generate the source.
+    """
+    source = template_source(root, format)
+    if cache_dir is None:
+        namespace = {}
+        exec(compile(source, '<htree template>', 'exec'), namespace)
+        return namespace['render']
+    module_name = 'htree_template_' + hashlib.sha1(source.encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, module_name + '.py')
+    if not os.path.exists(path):
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(source)
+        os.rename(tmp, path)
+    module = sys.modules.get(module_name)
+    if module is None:
+        module = sys.modules[module_name] = _load_module(module_name, path)
+    return module.render
+
+
+def _load_module(name, path):
+    # Import a module from a file path.
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:  # pragma: no cover
+        import imp
+        return imp.load_source(name, path)
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# --------------------------------------------------------------------
+# Caching
+
+
+class CacheInfo(namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'entries', 'size', 'max_bytes'])):
+    """
+    The metrics of a `FragmentCache` as returned by `FragmentCache.info()`.
+
+    `size` is the number of bytes held by the cache's `entries`.
+    """
+    __slots__ = ()
+
+
+class FragmentCache(object):
+    """
+    A thread-safe, size-bounded LRU cache of parsed and rendered HTML fragments.
+
+    Entries are keyed by a hash of the source HTML. Once the total size of all
+    entries exceeds `max_bytes`, the least recently used entries are evicted.
+    An entry larger than `max_bytes` is not stored.
+
+    Trees are stored in the wire format (see `to_wire`) and `get` returns a
+    new tree on every call, so callers may modify the tree freely without
+    affecting the cache. Rendered strings are immutable and shared.
+
+    `parse` is the function called with the source to build a tree on a
+    cache miss. It defaults to `from_string`.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, parse=from_string):
+        self.max_bytes = max_bytes
+        self._parse = parse
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+        self.size = self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _digest(source):
+        if isinstance(source, text_type):
+            source = source.encode('utf-8')
+        return hashlib.sha1(source).digest()
+
+    def _lookup(self, key, count=True):
+        # Only lookups made on behalf of the caller are counted as hits or misses.
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries[key] = entry  # Move to the end (most recent).
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def _store(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def get(self, source):
+        """
+        Return a new tree parsed from the HTML string `source`.
+
+        """
+        return from_wire(self._get_wire(source))
+
+    def _get_wire(self, source, count=True):
+        key = ('tree', self._digest(source))
+        buf = self._lookup(key, count)
+        if buf is None:
+            buf = to_wire(self._parse(source))
+            self._store(key, buf, sys.getsizeof(buf))
+        return buf
+
+    def render(self, source, **options):
+        """
+        Return the HTML string `source` parsed and serialized again.
+
+        `options` are passed to `Node.to_string` and are part of the key.
+        """
+        key = ('render', self._digest(source), tuple(sorted(options.items())))
+        text = self._lookup(key)
+        if text is None:
+            text = from_wire(self._get_wire(source, count=False)).to_string(**options)
+            self._store(key, text, sys.getsizeof(text))
+        return text
+
+    def info(self):
+        """Return the cache metrics as a `CacheInfo`."""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, len(self._entries), self.size, self.max_bytes)
+
+    def clear(self):
+        """Remove all entries. The metrics are not reset."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# --------------------------------------------------------------------
+# Instrumentation
+
+
+class Instrument(object):
+    """
+    Opt-in instrumentation of tree building and serialization.
+
+    Use the module level `instrument` instance rather than creating your own.
+    While enabled, the following statistics are collected in `stats`, a flat
+    dictionary suitable for exporting to a metrics system:
+
+    * `nodes_created.<Type>`: the number of nodes created of each type.
+    * `append_calls`: the number of calls to `Element.append`. Children added
+      by a `TreeBuilder` (and therefore by the `Parser`) are not counted.
+    * `escaped_chars.cdata` and `escaped_chars.attrib`: the number of
+      characters passed through text and attribute escaping. Attributes
+      served from the rendered attribute cache are counted as if escaped.
+    * `serialized_chars.<Type>`: the number of characters written by the
+      serializer for each node type, excluding those of its children.
+    * `serialize_seconds.<tag>`: the time spent serializing elements of each
+      tag, excluding the time spent on their children.
+
+    Instrumentation works by swapping instrumented versions of the relevant
+    functions in when enabled and the originals back in when disabled. There
+    is no overhead when disabled. When enabled, counts are not synchronized
+    between threads.
+
+    Callbacks registered with `add_callback` are passed a copy of `stats`
+    each time `report` is called.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._callbacks = []
+        self._originals = None
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        """`True` if instrumentation is enabled."""
+        return self._originals is not None
+
+    def enable(self):
+        """
+        Start collecting statistics.
+        """
+        if self.enabled:
+            return
+        module = globals()
+        self._originals = {
+            '_serialize_node': module['_serialize_node'],
+            '_serialize_node_minified': module['_serialize_node_minified'],
+            '_serialize_node_indented': module['_serialize_node_indented'],
+            '_escape_cdata': module['_escape_cdata'],
+            '_escape_attrib': module['_escape_attrib'],
+            '_render_attrib': module['_render_attrib'],
+            'Element.__init__': Element.__init__,
+            'Element.append': Element.append,
+        }
+        module['_serialize_node'] = self._wrap_serialize(module['_serialize_node'])
+        module['_serialize_node_minified'] = self._wrap_serialize(module['_serialize_node_minified'])
+        module['_serialize_node_indented'] = self._wrap_serialize(module['_serialize_node_indented'])
+        module['_escape_cdata'] = self._wrap_escape(module['_escape_cdata'], 'escaped_chars.cdata')
+        module['_escape_attrib'] = self._wrap_escape(module['_escape_attrib'], 'escaped_chars.attrib')
+        module['_render_attrib'] = self._wrap_render_attrib(module['_render_attrib'])
+        Element.__init__ = self._wrap_init(Element.__init__)
+        Element.append = self._wrap_append(Element.append)
+        BaseTextNode.__new__ = staticmethod(self._wrap_new(text_type.__new__))
+
+    def disable(self):
+        """
+        Stop collecting statistics. Collected statistics are retained.
+        """
+        if not self.enabled:
+            return
+        originals = self._originals
+        self._originals = None
+        module = globals()
+        for name in ['_serialize_node', '_serialize_node_minified', '_serialize_node_indented',
+                     '_escape_cdata', '_escape_attrib', '_render_attrib']:
+            module[name] = originals[name]
+        Element.__init__ = originals['Element.__init__']
+        Element.append = originals['Element.append']
+        del BaseTextNode.__new__
+
+    def reset(self):
+        """
+        Discard all collected statistics.
+        """
+        self.stats = {}
+
+    def add_callback(self, callback):
+        """
+        Register a callable to be passed a copy of the statistics by `report`.
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """
+        Unregister a callable previously passed to `add_callback`.
+        """
+        self._callbacks.remove(callback)
+
+    def report(self):
+        """
+        Pass a copy of the statistics to each callback and return it.
+        """
+        stats = dict(self.stats)
+        for callback in list(self._callbacks):
+            callback(stats)
+        return stats
+
+    @contextmanager
+    def recording(self, reset=True):
+        """
+        Context manager which collects statistics for the enclosed block.
+
+        The statistics are reset first unless `reset` is `False`. On exit,
+        `report` is called and instrumentation is returned to its prior state.
+        """
+        was_enabled = self.enabled
+        if reset:
+            self.reset()
+        self.enable()
+        try:
+            yield self
+        finally:
+            if not was_enabled:
+                self.disable()
+            self.report()
+
+    def _count(self, name, value=1):
+        stats = self.stats
+        stats[name] = stats.get(name, 0) + value
+
+    def _wrap_new(self, new):
+        count = self._count
+
+        def __new__(cls, *args, **kwargs):
+            count('nodes_created.' + cls.__name__)
+            return new(cls, *args, **kwargs)
+        return __new__
+
+    def _wrap_init(self, init):
+        count = self._count
+
+        def __init__(element, *args, **kwargs):
+            count('nodes_created.' + element.__class__.__name__)
+            init(element, *args, **kwargs)
+        return __init__
+
+    def _wrap_append(self, append):
+        count = self._count
+
+        def append_wrapper(element, node):
+            count('append_calls')
+            append(element, node)
+        return append_wrapper
+
+    def _wrap_render_attrib(self, render_attrib):
+        count = self._count
+
+        def render_attrib_wrapper(attrib, *args):
+            cached = getattr(attrib, '_rendered', None)
+            text = render_attrib(attrib, *args)
+            if cached and text is cached:
+                # Served from the cache, so `_escape_attrib` was not called.
+                count('escaped_chars.attrib', sum(len(v) for v in attrib.values() if isinstance(v, text_type)))
+            return text
+        return render_attrib_wrapper
+
+    def _wrap_escape(self, escape, name):
+        count = self._count
+
+        def escape_wrapper(text):
+            if isinstance(text, text_type):
+                count(name, len(text))
+            return escape(text)
+        return escape_wrapper
+
+    def _wrap_serialize(self, serialize):
+        count = self._count
+        local = self._local
+
+        def serialize_wrapper(write, node, *args):
+            # Each frame holds [characters written, seconds spent in children].
+            frames = getattr(local, 'frames', None)
+            if frames is None:
+                frames = local.frames = []
+            if not getattr(write, 'counting', False):
+                outer_write = write
+
+                def write(data):
+                    frames[-1][0] += len(data)
+                    outer_write(data)
+                write.counting = True
+            frame = [0, 0.0]
+            frames.append(frame)
+            start = default_timer()
+            try:
+                serialize(write, node, *args)
+            finally:
+                elapsed = default_timer() - start
+                frames.pop()
+                if frames:
+                    frames[-1][1] += elapsed
+                count('serialized_chars.' + node.__class__.__name__, frame[0])
+                if is_element(node):
+                    count('serialize_seconds.{0}'.format(node.tag), elapsed - frame[1])
+        return serialize_wrapper
+
+
+instrument = Instrument()
+
+
+# --------------------------------------------------------------------
+# Batch Processing
+
+
+class ProcessResult(namedtuple('ProcessResult', ['path', 'data', 'error', 'size', 'seconds'])):
+    """
+    The result of processing one file with `process_files`.
+
+    `data` is the serialized output (`None` if written to a file or on error),
+    `error` is a description of any exception raised (otherwise `None`), `size`
+    is the size of the input file in bytes and `seconds` is the time taken.
+    """
+    __slots__ = ()
+
+
+_worker_options = None
+
+
+def _init_worker(options):
+    global _worker_options
+    _worker_options = options
+
+
+def _process_file(path, options=None):
+    transform, format, encoding, output_dir = options or _worker_options
+    start = default_timer()
+    data = error = None
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        root = parse(path, encoding)
+        if transform is not None:
+            result = transform(root)
+            if result is not None:
+                root = result
+        data = root.to_bytes(format, encoding)
+        if output_dir is not None:
+            with open(os.path.join(output_dir, os.path.basename(path)), 'wb') as f:
+                f.write(data)
+            data = None
+    except Exception as e:
+        error = '{0}: {1}'.format(e.__class__.__name__, e)
+    return ProcessResult(path, data, error, size, default_timer() - start)
+
+
+def process_files(paths, transform=None, workers=None, chunksize=1, ordered=True,
+                  format='html', encoding='utf-8', output_dir=None):
+    """
+    Parse, transform and serialize many HTML files in worker processes.
+
+    Each file in `paths` is parsed with `parse`, passed to `transform` and the
+    tree (or the node returned by `transform`, if not `None`) is serialized
+    with `to_bytes`. All of this happens within the worker process so that
+    no tree crosses a process boundary. `transform` must be picklable (for
+    example, a function defined at the top level of a module).
+
+    Returns an iterator of `ProcessResult`, one per file. Results are in the
+    order of `paths` unless `ordered` is `False`, in which case they are in
+    the order processing finishes. An exception raised by one file is
+    reported in its result and does not stop the others.
+
+    `workers` is the number of worker processes (defaults to the number of
+    CPUs). If `workers` is 1 the files are processed in the current process.
+    `chunksize` is the number of files sent to a worker at a time.
+
+    If `output_dir` is given, each output is written to a file of the same
+    name in that directory instead of being returned in the result. A
+    `ValueError` is raised if two paths share a file name.
+    """
+    options = (transform, format, encoding, output_dir)
+    if output_dir is not None:
+        paths = list(paths)
+        names = set()
+        for path in paths:
+            name = os.path.basename(path)
+            if name in names:
+                raise ValueError('more than one path named {0!r} for output_dir'.format(name))
+            names.add(name)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for path in paths:
+            yield _process_file(path, options)
+        return
+    pool = multiprocessing.Pool(workers, _init_worker, (options,))
+    try:
+        if ordered:
+            results = pool.imap(_process_file, paths, chunksize)
+        else:
+            results = pool.imap_unordered(_process_file, paths, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _import_transform(name):
+    # Import a "module:function" name.
+    module, _, function = name.partition(':')
+    if not function:
+        raise ValueError('expected "module:function", got {0!r}'.format(name))
+    return getattr(importlib.import_module(module), function)
+
+
+def main(argv=None):
+    """
+    Command line interface to `process_files`. Run `python -m htree --help`.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m htree',
+        description='Parse, transform and serialize HTML files in parallel.'
+    )
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='HTML files to process')
+    parser.add_argument('-t', '--transform', metavar='MODULE:FUNCTION',
+                        help='function called with the root of each tree')
+    parser.add_argument('-o', '--output-dir', metavar='DIR',
+                        help='directory to write output to (default: discard output)')
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes')
+    parser.add_argument('-c', '--chunksize', type=int, default=16, help='files sent to a worker at a time')
+    parser.add_argument('-f', '--format', choices=['html', 'xhtml'], default='html')
+    parser.add_argument('-e', '--encoding', default='utf-8')
+    parser.add_argument('-u', '--unordered', action='store_true', help='report files as they finish')
+    args = parser.parse_args(argv)
+
+    transform = _import_transform(args.transform) if args.transform else None
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    start = default_timer()
+    count = errors = total = 0
+    for result in process_files(args.paths, transform, args.workers, args.chunksize, not args.unordered,
+                                args.format, args.encoding, args.output_dir):
+        count += 1
+        total += result.size
+        if result.error:
+            errors += 1
+            sys.stderr.write('{0}: ERROR {1}\n'.format(result.path, result.error))
+        else:
+            sys.stdout.write('{0}: {1} bytes in {2:.1f} ms\n'.format(result.path, result.size, result.seconds * 1000))
+    elapsed = default_timer() - start
+    sys.stdout.write('{0} files ({1} errors), {2:.2f} MB in {3:.2f} s ({4:.1f} files/s, {5:.2f} MB/s)\n'.format(
+        count, errors, total / 1e6, elapsed, count / elapsed if elapsed else 0, total / 1e6 / elapsed if elapsed else 0
+    ))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
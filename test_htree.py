@@ -3,7 +3,16 @@
 from __future__ import unicode_literals
 import unittest
 import textwrap
+import tempfile
+import weakref
+import shutil
 import htree
+import sys
+import gc
+import io
+import os
+
+text_type = htree.text_type
 
 
 def dedent(text):
@@ -88,6 +97,23 @@ class TestTypes(unittest.TestCase):
         self.assertTrue(repr(node).startswith('<Entity("&amp;") at '))
         self.assertEqual(node.parent, None)
 
+    def test_Entity_values(self):
+        self.assertEqual(htree.Entity('amp;'), '&amp;')
+        self.assertEqual(htree.Entity('\xe9'), '&eacute;')
+        self.assertEqual(htree.Entity(0xe9), '&eacute;')
+        self.assertEqual(htree.Entity('#233'), '&eacute;')
+        self.assertEqual(htree.Entity('#xE9;'), '&eacute;')
+        self.assertEqual(htree.Entity('\u2603'), '&#x2603;')
+        self.assertEqual(htree.Entity('#9731'), '&#x2603;')
+        if sys.version_info[0] == 3:
+            # Python 2 only knows the HTML 4 entity names.
+            self.assertEqual(htree.Entity('NotEqualTilde'), '&NotEqualTilde;')
+        self.assertFalse(htree.Entity('amp') is htree.Entity('amp'))
+        for obj in ['bogus', '&amp;', '#xZZ', -1, 0x110000, None]:
+            self.assertRaises(TypeError, htree.Entity, obj)
+        # Equal keys of other types are not served from the cache.
+        self.assertRaises(TypeError, htree.Entity, 233.0)
+
     def test_non_node(self):
         obj = 'not a node'
         self.assertFalse(htree.is_node(obj))
@@ -108,6 +134,16 @@ class TestElement(unittest.TestCase):
         self.assertEqual(list(node.items()), [('id', 'foo')])
         self.assertEqual(node[:], [])
 
+    def test_Element_init_attrib(self):
+        node = htree.Element('p', {'id': 'foo'}, title='bar')
+        self.assertEqual(sorted(node.items()), [('id', 'foo'), ('title', 'bar')])
+        node = htree.Element('p', [('id', 'foo'), ('class', 'bar')])
+        self.assertEqual(list(node.items()), [('id', 'foo'), ('class', 'bar')])
+        attrib = htree.Attrib(id='foo')
+        self.assertTrue(htree.Element('p', attrib).attrib is attrib)
+        mapping = {'id': 'foo'}
+        self.assertFalse(htree.Element('p', mapping).attrib is mapping)
+
     def test_Element_copy(self):
         parent = htree.Element(None)
         node = htree.Element('p', id='foo')
@@ -302,6 +338,184 @@ class TestElement(unittest.TestCase):
         self.assertEqual(node[:], [])
         self.assertEqual(child.parent, None)
 
+    def test_Element_remove_identity(self):
+        node = htree.Element('p')
+        text1 = htree.Text('text')
+        text2 = htree.Text('text')
+        node.extend([text1, text2])
+        node.remove(text2)
+        self.assertTrue(node[0] is text1)
+        self.assertTrue(text1.parent is node)
+        self.assertEqual(text2.parent, None)
+        self.assertRaises(ValueError, node.remove, htree.Text('text'))
+        self.assertTrue(text1.parent is node)
+
+    def test_Element_clear_many(self):
+        node = htree.Element('p')
+        children = [htree.Text('text{0}'.format(i)) for i in range(5)]
+        node.extend(children)
+        node.clear()
+        self.assertEqual(len(node), 0)
+        self.assertTrue(all(child.parent is None for child in children))
+
+    def test_Element_remove_all(self):
+        node = htree.Element('p')
+        text1 = htree.Text('text1')
+        em = htree.Element('em')
+        text2 = htree.Text('text2')
+        node.extend([text1, em, text2])
+        removed = node.remove_all(htree.is_text)
+        self.assertEqual(removed, [text1, text2])
+        self.assertEqual(node[:], [em])
+        self.assertEqual(text1.parent, None)
+        self.assertTrue(em.parent is node)
+
+    def test_Element_retain(self):
+        node = htree.Element('p')
+        text1 = htree.Text('text1')
+        em = htree.Element('em')
+        text2 = htree.Text('text2')
+        node.extend([text1, em, text2])
+        removed = node.retain(htree.is_text)
+        self.assertEqual(removed, [em])
+        self.assertEqual(node[:], [text1, text2])
+        self.assertEqual(em.parent, None)
+
+    def test_Element_detach_range(self):
+        node = htree.Element('p')
+        children = [htree.Text('text{0}'.format(i)) for i in range(5)]
+        node.extend(children)
+        self.assertEqual(node.detach_range(1, 3), children[1:3])
+        self.assertEqual(node[:], [children[0], children[3], children[4]])
+        self.assertEqual(children[1].parent, None)
+        self.assertEqual(node.detach_range(-1), [children[4]])
+        self.assertEqual(node[:], [children[0], children[3]])
+
+    def test_Element_replace_children(self):
+        node = htree.Element('p')
+        old = htree.Text('old')
+        node.append(old)
+        new = [htree.Text('new{0}'.format(i)) for i in range(3)]
+        self.assertEqual(node.replace_children(iter(new)), [old])
+        self.assertEqual(node[:], new)
+        self.assertEqual(old.parent, None)
+        self.assertTrue(all(child.parent is node for child in new))
+        self.assertRaises(TypeError, node.replace_children, [htree.Text('a'), 'b'])
+        self.assertEqual(node[:], new)
+        self.assertRaises(TypeError, htree.Element('br').replace_children, [htree.Text('a')])
+
+    def test_Element_normalize(self):
+        node = htree.Element('p')
+        texts = [htree.Text('a'), htree.Text(''), htree.Text('b')]
+        raws = [htree.RawText('<b>'), htree.RawText('</b>')]
+        entity = htree.Entity('amp')
+        comment = htree.Comment('')
+        em = htree.Element('em')
+        inner = [htree.Text('c'), htree.Text('d')]
+        em.extend(inner)
+        node.extend(texts + raws + [htree.Text('e'), entity, htree.Text(''), comment, em, htree.Text('')])
+        node.normalize()
+        self.assertEqual(node[:], ['ab', '<b></b>', 'e', entity, comment, em])
+        self.assertEqual([n.__class__ for n in node[:3]], [htree.Text, htree.RawText, htree.Text])
+        self.assertTrue(all(n.parent is node for n in node))
+        self.assertTrue(all(n.parent is None for n in texts + raws))
+        self.assertEqual(em[:], ['cd'])
+        self.assertTrue(em[0].parent is em)
+        self.assertEqual(node.to_string(), '<p>ab<b></b>e&amp;<!--  --><em>cd</em></p>\n')
+
+    def test_Element_normalize_not_recursive(self):
+        node = htree.Element('div')
+        em = htree.Element('em')
+        em.extend([htree.Text('a'), htree.Text('b')])
+        node.extend([htree.Text('c'), em, htree.Text('d'), htree.Text('e')])
+        node.normalize(recursive=False)
+        self.assertEqual(node[:], ['c', em, 'de'])
+        self.assertEqual(em[:], ['a', 'b'])
+        node.normalize()
+        self.assertEqual(em[:], ['ab'])
+
+    def test_Element_decompose(self):
+        root = htree.Element('div')
+        node = htree.Element('p', id='a')
+        em = htree.Element('em')
+        text = htree.Text('text')
+        em.append(text)
+        node.extend([htree.Text('lead'), em])
+        root.append(node)
+        node.classes.add('x')
+        node.decompose()
+        self.assertEqual(len(root), 0)
+        self.assertIsNone(node.parent)
+        self.assertEqual(len(node), 0)
+        self.assertEqual(len(em), 0)
+        self.assertIsNone(em.parent)
+        self.assertIsNone(text.parent)
+        self.assertEqual(node.get('id'), 'a')
+
+    def test_Element_decompose_deep(self):
+        root = node = htree.Element('div')
+        for _ in range(10000):
+            child = htree.Element('div')
+            node.append(child)
+            node = child
+        root.decompose()
+        self.assertIsNone(node.parent)
+
+    def test_weaken_parents(self):
+        root = htree.Element('div')
+        p = htree.Element('p')
+        text = htree.Text('text')
+        p.append(text)
+        root.append(p)
+        self.assertIs(htree.weaken_parents(root), root)
+        self.assertIs(p.parent, root)
+        self.assertIs(text.parent, p)
+        self.assertIs(htree.weaken_parents(root), root)
+        self.assertIs(text.parent, p)
+        # Changes after weakening still work.
+        root.remove(p)
+        self.assertIsNone(p.parent)
+        root.append(p)
+        self.assertIs(p.parent, root)
+        root.add_class('x')
+        htree.weaken_parents(root)
+        # The tree is freed by reference counting alone.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            ref = weakref.ref(root)
+            del root
+            self.assertIsNone(ref())
+            self.assertIsNone(p.parent)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def test_weaken_parents_copy(self):
+        import copy
+        import pickle
+        root = CustomElement('div')
+        p = CustomElement('p')
+        p.append(htree.Slot('name'))
+        root.extend([p, htree.Element('p')])
+        htree.weaken_parents(root)
+        for clone_tree in [copy.deepcopy, lambda node: pickle.loads(pickle.dumps(node, 2))]:
+            clone = clone_tree(root)
+            self.assertEqual(clone.to_string(), root.to_string())
+            self.assertIs(clone[0].parent, clone)
+            self.assertIs(clone[1].parent, clone)
+            self.assertIs(clone[0][0].parent, clone[0])
+            self.assertNotIn('parent', clone[0].__dict__)
+            enabled = gc.isenabled()
+            gc.disable()
+            try:
+                ref = weakref.ref(clone[0])
+                del clone
+                self.assertIsNone(ref())
+            finally:
+                if enabled:
+                    gc.enable()
+
     def test_Element_next_sibling(self):
         node = htree.Element('p')
         text1 = htree.Text('text1')
@@ -374,6 +588,28 @@ class TestElement(unittest.TestCase):
         node = htree.Element('p', **{'id': 'foo', 'class': 'baz'})
         self.assertEqual(sorted(node.items()), [('class', 'baz'), ('id', 'foo')])
 
+    def test_Element_attrib_container(self):
+        node = htree.Element('p', id='foo', title='bar')
+        self.assertTrue(isinstance(node.attrib, htree.Attrib))
+        self.assertEqual(node.attrib.sorted_items(), (('id', 'foo'), ('title', 'bar')))
+        node.set('class', 'baz')
+        self.assertEqual(node.attrib.sorted_items()[0], ('class', 'baz'))
+        node.attrib.update(align='left')
+        self.assertEqual(node.attrib.sorted_items()[0], ('align', 'left'))
+        del node.attrib['align']
+        node.attrib.pop('class')
+        self.assertEqual(node.attrib.sorted_items(), (('id', 'foo'), ('title', 'bar')))
+        node.attrib.setdefault('lang', 'en')
+        self.assertEqual(len(node.attrib.sorted_items()), 3)
+        node.attrib.clear()
+        self.assertEqual(node.attrib.sorted_items(), ())
+        # The serializer shares the cache.
+        node.set('id', 'x')
+        node.to_string()
+        self.assertEqual(node.attrib._sorted, (('id', 'x'),))
+        copied = node.attrib.copy()
+        self.assertTrue(isinstance(copied, htree.Attrib))
+
     def test_Element_attrib_class(self):
         node = htree.Element('p')
         self.assertEqual(node.get('class'), None)
@@ -387,6 +623,73 @@ class TestElement(unittest.TestCase):
         self.assertEqual(node.get('class'), 'foo baz')
         node.remove_class('missing')
         self.assertEqual(node.get('class'), 'foo baz')
+        node.add_class('foo')
+        self.assertEqual(node.get('class'), 'foo baz')
+        node.remove_class('foo baz')
+        self.assertEqual(node.get('class'), None)
+
+    def test_Element_classes(self):
+        node = htree.Element('p', **{'class': 'foo  bar foo'})
+        classes = node.classes
+        self.assertTrue(node.classes is classes)
+        self.assertEqual(list(classes), ['foo', 'bar'])
+        self.assertEqual(len(classes), 2)
+        self.assertTrue(classes.contains('foo'))
+        self.assertTrue('bar' in classes)
+        self.assertFalse('baz' in classes)
+        classes.add('baz', 'foo')
+        self.assertTrue(classes.toggle('qux'))
+        self.assertFalse(classes.toggle('bar'))
+        self.assertTrue(classes.toggle('foo', force=True))
+        self.assertFalse(classes.toggle('missing', force=False))
+        self.assertEqual(node.to_string(), '<p class="foo baz qux"></p>\n')
+        classes.remove('baz', 'missing')
+        self.assertEqual(node.get('class'), 'foo qux')
+        self.assertEqual(node.attrib['class'], 'foo qux')
+        classes.remove('foo', 'qux')
+        self.assertEqual(node.to_string(), '<p></p>\n')
+        self.assertFalse('class' in node.attrib)
+
+    def test_Element_classes_no_cycle(self):
+        node = htree.Element('p')
+        node.add_class('a')
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            ref = weakref.ref(node)
+            del node
+            self.assertIsNone(ref())
+        finally:
+            if enabled:
+                gc.enable()
+
+    def test_Element_classes_copy(self):
+        import copy
+        import pickle
+        node = htree.Element('p')
+        node.append(htree.Slot('name'))
+        node.classes.add('a')
+        for clone in [copy.deepcopy(node), pickle.loads(pickle.dumps(node, 2))]:
+            self.assertEqual(clone.get('class'), 'a')
+            clone.classes.add('b')
+            self.assertEqual(clone.get('class'), 'a b')
+            self.assertEqual(node.get('class'), 'a')
+
+    def test_Element_classes_attribute_changed(self):
+        node = htree.Element('p', **{'class': 'foo'})
+        classes = node.classes
+        self.assertEqual(list(classes), ['foo'])
+        node.set('class', 'bar baz')
+        self.assertEqual(list(classes), ['bar', 'baz'])
+        classes.add('foo')
+        node.set('class', 'qux')
+        self.assertEqual(list(classes), ['qux'])
+        node.attrib = {'class': 'a'}
+        self.assertEqual(list(node.classes), ['a'])
+        self.assertTrue(node.classes is classes)
+        node.attrib = htree.Attrib()
+        classes.add('b')
+        self.assertEqual(node.get('class'), 'b')
 
     def test_Element_iter_decendents(self):
         p = htree.Element('p')
@@ -435,6 +738,51 @@ class TestElement(unittest.TestCase):
             [emtext, strongtext, a1text, a2text]
         )
 
+    def test_Element_itertext_nested_args(self):
+        p = htree.Element('p')
+        em = htree.Element('em')
+        raw = htree.RawText('raw')
+        entity = htree.Entity('&')
+        p.append(em)
+        em.append(raw)
+        em.append(entity)
+        self.assertEqual(list(p.iter_text()), [entity])
+        self.assertEqual(list(p.iter_text(entities=False, raw=True)), [raw])
+
+    def test_Element_text_content(self):
+        div = htree.Element('div')
+        div.append(htree.Text('  lead '))
+        p = htree.Element('p')
+        p.append(htree.Text('one'))
+        p.append(htree.Entity('&'))
+        em = htree.Element('em')
+        em.append(htree.Text('  two'))
+        p.append(em)
+        div.append(p)
+        div.append(htree.Comment('comment'))
+        script = htree.Element('script')
+        script.append(htree.RawText('code'))
+        div.append(script)
+        div.append(htree.Text('tail'))
+        self.assertEqual(div.text_content(), '  lead \none&  two\ntail')
+        self.assertEqual(div.text_content(entities=False, raw=True), '  lead \none  two\ncode\ntail')
+        self.assertEqual(div.text_content(normalize_whitespace=True), 'lead\none& two\ntail')
+        self.assertEqual(div.text_content(block_separator=' | ', normalize_whitespace=True), 'lead | one& two | tail')
+        self.assertEqual(div.text_content(block_separator=None), '  lead one&  twotail')
+        self.assertEqual(htree.Element('p').text_content(), '')
+        div = htree.Element('div')
+        div.extend([htree.Text('a'), htree.Element('P'), htree.Text('b')])
+        div[1].append(htree.Text('upper'))
+        self.assertEqual(div.text_content(), 'a\nupper\nb')
+        p = htree.Element('p')
+        p.extend([htree.Entity('eacute'), htree.Entity('\u2603')])
+        self.assertEqual(p.text_content(), '\xe9\u2603')
+        if sys.version_info[0] == 3:
+            # A multi-character HTML5 entity.
+            p = htree.Element('p')
+            p.append(htree.Entity('NotEqualTilde'))
+            self.assertEqual(p.text_content(), '\u2242\u0338')
+
     def test_Element_iter_ancestors(self):
         p = htree.Element('p')
         em = htree.Element('em')
@@ -448,6 +796,279 @@ class TestElement(unittest.TestCase):
         self.assertEqual(list(a1.iter_ancestors()), [strong, em, p])
         self.assertEqual(list(a2.iter_ancestors()), [p])
         self.assertEqual(list(strong.iter_ancestors()), [em, p])
+        self.assertEqual(list(p.iter_ancestors()), [])
+
+    def test_Element_iter_ancestors_deep(self):
+        root = node = htree.Element('div')
+        for _ in range(5000):
+            child = htree.Element('div')
+            node.append(child)
+            node = child
+        self.assertEqual(len(list(node.iter_ancestors())), 5000)
+        self.assertEqual(node.depth, 5000)
+        self.assertTrue(htree.is_ancestor(root, node))
+
+    def test_depth(self):
+        p = htree.Element('p')
+        em = htree.Element('em')
+        text = htree.Text('text')
+        em.append(text)
+        p.append(em)
+        self.assertEqual([p.depth, em.depth, text.depth], [0, 1, 2])
+        htree.is_ancestor(p, text)  # Builds the index.
+        self.assertEqual([p.depth, em.depth, text.depth], [0, 1, 2])
+        p.remove(em)
+        self.assertEqual([em.depth, text.depth], [0, 1])
+
+    def test_is_ancestor(self):
+        p = htree.Element('p')
+        em = htree.Element('em')
+        text = htree.Text('text')
+        tail = htree.Text('tail')
+        em.append(text)
+        p.extend([em, tail])
+        self.assertTrue(htree.is_ancestor(p, text))
+        self.assertTrue(htree.is_ancestor(em, text))
+        self.assertFalse(htree.is_ancestor(em, tail))
+        self.assertFalse(htree.is_ancestor(text, em))
+        self.assertFalse(htree.is_ancestor(p, p))
+        self.assertFalse(htree.is_ancestor(htree.Element('p'), text))
+        # The index follows changes to the tree.
+        p.remove(tail)
+        em.append(tail)
+        self.assertTrue(htree.is_ancestor(em, tail))
+        em.remove(text)
+        self.assertFalse(htree.is_ancestor(p, text))
+
+    def test_index_per_tree(self):
+        p = htree.Element('p')
+        em = htree.Element('em')
+        p.append(em)
+        self.assertTrue(htree.is_ancestor(p, em))
+        order = em._order
+        # Changes to other trees leave the index current.
+        other = htree.Element('div')
+        other.append(htree.Element('p'))
+        htree.TreeBuilder().start('div')
+        self.assertTrue(htree.is_ancestor(p, em))
+        self.assertIs(em._order, order)
+        # Moving a node out of an indexed tree makes its index stale.
+        p.remove(em)
+        other.append(em)
+        self.assertTrue(htree.is_ancestor(other, em))
+        self.assertIsNot(p._order[0], em._order[0])
+        self.assertFalse(htree.is_ancestor(p, em))
+
+    def test_document_position(self):
+        tree = htree.from_string('<div><p>One <em>two</em></p><p>three</p></div>')
+        nodes = tree.xpath('//node()')
+        self.assertEqual([htree.document_position(n) for n in nodes], list(range(1, len(nodes) + 1)))
+        self.assertEqual(htree.document_position(tree), 0)
+        tree[0].insert(0, htree.Comment('first'))
+        self.assertEqual(htree.document_position(nodes[1]), 3)
+
+    def test_sort_document_order(self):
+        tree = htree.from_string('<div><p>One <em>two</em></p><p>three</p></div>')
+        nodes = tree.xpath('//node()')
+        shuffled = nodes[::-1] + nodes[:2]
+        self.assertEqual(htree.sort_document_order(shuffled), [nodes[0], nodes[0], nodes[1], nodes[1]] + nodes[2:])
+        other = htree.Element('p')
+        self.assertEqual(htree.sort_document_order([nodes[1], other, nodes[0]]), [nodes[0], nodes[1], other])
+        self.assertEqual(htree.sort_document_order(iter([])), [])
+
+    def test_unique(self):
+        tree = htree.from_string('<p>a<em>a</em>a</p>')
+        nodes = tree.xpath('//text()')
+        self.assertEqual(len(nodes), 3)
+        result = htree.unique(nodes[::-1] + nodes + [nodes[1]])
+        self.assertEqual(list(map(id, result)), list(map(id, nodes)))
+
+
+class TestXPath(unittest.TestCase):
+
+    def setUp(self):
+        self.root = htree.Element(None)
+        self.html = htree.Element('html')
+        self.root.append(self.html)
+        body = htree.Element('body')
+        self.html.append(body)
+        self.table = htree.Element('table', **{'class': 'data'})
+        for i in range(3):
+            tr = htree.Element('tr')
+            for j in range(3):
+                td = htree.Element('td')
+                td.append(htree.Text('r{0}c{1}'.format(i, j)))
+                tr.append(td)
+            self.table.append(tr)
+        self.link = htree.Element('a', href='/foo', title='Foo')
+        self.link.append(htree.Text('link'))
+        self.comment = htree.Comment('note')
+        body.extend([self.table, htree.Element('TABLE'), self.link, self.comment])
+
+    def texts(self, expr, node=None):
+        return [text_type(n) for n in (node or self.root).xpath(expr)]
+
+    def test_descendant_and_child(self):
+        self.assertEqual(self.texts("//table[@class='data']/tr[position()>1]/td[2]/text()"), ['r1c1', 'r2c1'])
+        self.assertEqual(self.root.xpath('/html/body/a'), [self.link])
+        self.assertEqual(self.root.xpath('//body/*'), [self.table, self.html[0][1], self.link])
+        self.assertEqual(self.root.xpath('count(//td)'), 9)
+
+    def test_case_insensitive(self):
+        self.assertEqual(len(self.root.xpath('//table')), 2)
+        self.assertEqual(self.root.xpath('//A/@HREF'), ['/foo'])
+
+    def test_positions(self):
+        self.assertEqual(self.texts('//tr[1]/td[last()]/text()'), ['r0c2'])
+        self.assertEqual(self.texts('//tr[2]/td[last() - 1]/text()'), ['r1c1'])
+        self.assertEqual(self.texts('(//td)[4]/text()'), ['r1c0'])
+        self.assertEqual(self.texts('//td[position() mod 3 = 0]/text()'), ['r0c2', 'r1c2', 'r2c2'])
+        self.assertEqual(len(self.root.xpath('//td[2]')), 3)
+        self.assertEqual(self.root.xpath('//td[5]'), [])
+
+    def test_axes(self):
+        td = self.table[1][1]
+        self.assertEqual(self.texts('following-sibling::td/text()', td), ['r1c2'])
+        self.assertEqual(self.texts('preceding-sibling::td/text()', td), ['r1c0'])
+        self.assertEqual(self.texts('preceding-sibling::td/text()', self.table[1][0]), [])
+        self.assertEqual(td.xpath('ancestor::*'), [self.html, self.html[0], self.table, self.table[1]])
+        self.assertEqual(td.xpath('ancestor::*[1]'), [self.table[1]])
+        self.assertEqual(td.xpath('..'), [self.table[1]])
+        self.assertEqual(td.xpath('parent::tr/parent::table'), [self.table])
+        self.assertEqual(td.xpath('.'), [td])
+        self.assertEqual(td.xpath('self::td'), [td])
+        self.assertEqual(td.xpath('descendant-or-self::node()'), [td, td[0]])
+        self.assertEqual(td.xpath('ancestor-or-self::tr'), [self.table[1]])
+
+    def test_predicates(self):
+        self.assertEqual(self.root.xpath("//tr[td='r2c0']"), [self.table[2]])
+        self.assertEqual(self.root.xpath("//table[not(@class)]"), [self.html[0][1]])
+        self.assertEqual(self.root.xpath("//*[contains(@href, 'fo')]"), [self.link])
+        self.assertEqual(self.root.xpath("//*[starts-with(@title, 'F') and @href != '/bar']"), [self.link])
+        self.assertEqual(self.root.xpath("//a[@title='Bar' or @href='/foo']"), [self.link])
+        self.assertEqual(self.root.xpath('//tr[count(td) >= 3][2]'), [self.table[1]])
+
+    def test_attributes(self):
+        self.assertEqual(self.root.xpath('//a/@href'), ['/foo'])
+        self.assertEqual(self.root.xpath('//a/@*'), ['/foo', 'Foo'])
+
+    def test_node_types(self):
+        self.assertEqual(self.root.xpath('//comment()'), [self.comment])
+        self.assertEqual(self.texts('//a/text()'), ['link'])
+        self.assertEqual(self.root.xpath('//a/node()'), [self.link[0]])
+
+    def test_union(self):
+        self.assertEqual(self.root.xpath('//a | //table[@class]'), [self.table, self.link])
+        # Document order follows changes to the tree.
+        self.table.parent.remove(self.table)
+        self.root.append(self.table)
+        self.assertEqual(self.root.xpath('//a | //table[@class]'), [self.link, self.table])
+
+    def test_values(self):
+        self.assertEqual(self.root.xpath('string(//a)'), 'link')
+        self.assertEqual(self.root.xpath('normalize-space("  a  b ")'), 'a b')
+        self.assertEqual(self.root.xpath('concat("a", 1, true())'), 'a1true')
+        self.assertEqual(self.root.xpath('name(//td)'), 'td')
+        self.assertEqual(self.root.xpath('string-length("four")'), 4)
+        self.assertEqual(self.root.xpath('1 + 2 * 3 - 4 div 2'), 5)
+        self.assertEqual(self.root.xpath('-(7 mod 4)'), -3)
+        self.assertEqual(self.root.xpath('number("x") = number("x")'), False)
+        self.assertEqual(self.root.xpath('1 < 2 and 2 > 1 and 2 <= 2 and 2 >= 3'), False)
+        self.assertEqual(self.root.xpath('boolean(//a) and not(false())'), True)
+
+    def test_entities(self):
+        p = htree.Element('p')
+        p.extend([htree.Text('a'), htree.Entity('amp'), htree.Text('b'), htree.Comment('c')])
+        self.assertEqual(p.xpath("self::p[. = 'a&b']"), [p])
+        self.assertEqual(p.xpath('string(.)'), 'a&b')
+
+    def test_implied_document(self):
+        div = htree.Element('div')
+        p = htree.Element('p')
+        div.append(p)
+        self.assertEqual(p.xpath('/div/p'), [p])
+        self.assertEqual(div.xpath('//p'), [p])
+        self.assertIs(p.parent, div)
+        self.assertIsNone(div.parent)
+
+    def test_compiled(self):
+        expr = htree.XPath('//td[1]/text()')
+        self.assertEqual([text_type(n) for n in expr(self.root)], ['r0c0', 'r1c0', 'r2c0'])
+        self.assertTrue(repr(expr).startswith('<XPath({0!r}) at '.format('//td[1]/text()')))
+        self.root.xpath('//td')
+        self.assertIs(htree._compile_xpath('//td'), htree._compile_xpath('//td'))
+
+    def test_errors(self):
+        for expr in ['', '//', 'foo(', '//td[', 'following::td', 'frob()', 'count()', '1 |', '"a" | //td', 'td]']:
+            self.assertRaises(htree.XPathError, self.root.xpath, expr)
+
+
+class TestSanitize(unittest.TestCase):
+    def test_default_policy(self):
+        doc = htree.from_string(
+            '<!DOCTYPE html><div class="x"><p onclick="x()" title="t">Hi <font>there</font>'
+            '<script>evil()</script><!-- c --><img src="a.png" alt="a" style="x"></p></div>'
+        )
+        self.assertTrue(htree.sanitize(doc) is doc)
+        self.assertEqual(doc.to_string(), '<p title="t">Hi there<img alt="a" src="a.png"></p>\n')
+        p = doc[0]
+        self.assertTrue(p.parent is doc)
+        self.assertTrue(all(child.parent is p for child in p))
+
+    def test_unwrap_nested(self):
+        root = htree.Element('div')
+        outer = htree.Element('span')
+        inner = htree.Element('font')
+        em = htree.Element('em')
+        text = htree.Text('text')
+        root.append(outer)
+        outer.append(htree.Text('a'))
+        outer.append(inner)
+        inner.append(em)
+        em.append(text)
+        outer.append(htree.Text('b'))
+        htree.sanitize(root)
+        self.assertEqual(root.to_string(), '<div>\na<em>text</em>b</div>\n')
+        self.assertTrue(em.parent is root)
+        self.assertEqual(outer.parent, None)
+        self.assertEqual(len(outer), 0)
+
+    def test_drop(self):
+        root = htree.Element('div')
+        style = htree.Element('style')
+        style.append(htree.RawText('p {}'))
+        root.append(style)
+        root.append(htree.RawText('<b>raw</b>'))
+        htree.sanitize(root)
+        self.assertEqual(len(root), 0)
+        self.assertEqual(style.parent, None)
+
+    def test_urls(self):
+        doc = htree.from_string(
+            '<a href="/rel">1</a><a href="https://x.com/a:b">2</a><a href=" JaVa\tscript:alert(1)">3</a>'
+            '<a href="data:text/html,x">4</a><a href="mailto:a@b.c">5</a><a href="?q=a:b">6</a>'
+        )
+        htree.sanitize(doc)
+        self.assertEqual(
+            doc.to_string(),
+            '<a href="/rel">1</a><a href="https://x.com/a:b">2</a><a>3</a><a>4</a>'
+            '<a href="mailto:a@b.c">5</a><a href="?q=a:b">6</a>'
+        )
+
+    def test_custom_policy(self):
+        policy = htree.Policy(
+            tags=['div', 'a'], attributes={'*': ['class'], 'a': ['href']},
+            protocols=['ftp'], drop=[], comments=True
+        )
+        doc = htree.from_string(
+            '<div class="c" id="d"><a href="ftp://x" class="e">x</a><a href="http://x">y</a>'
+            '<script>z</script><!-- c --></div>'
+        )
+        htree.sanitize(doc, policy)
+        self.assertEqual(
+            doc.to_string(),
+            '<div class="c">\n<a class="e" href="ftp://x">x</a><a>y</a><!-- c --></div>\n'
+        )
 
 
 class TestSerializer(unittest.TestCase):
@@ -520,6 +1141,21 @@ class TestSerializer(unittest.TestCase):
         self.assertEqual(node.to_string(), '&amp;')
         self.assertEqual(node.to_string(format='xhtml'), '&amp;')
 
+    def test_encode_entities_to_string(self):
+        p = htree.Element('p', title='caf\xe9')
+        p.append(htree.Text('na\xefve \u2013 \u2603 & text'))
+        p.append(htree.RawText('\xe9'))
+        p.append(htree.Entity('\xe9'))
+        self.assertEqual(p.to_string(), '<p title="caf\xe9">na\xefve \u2013 \u2603 &amp; text\xe9&eacute;</p>\n')
+        self.assertEqual(
+            p.to_string(encode_entities=True),
+            '<p title="caf&eacute;">na&iuml;ve &ndash; &#x2603; &amp; text\xe9&eacute;</p>\n'
+        )
+        self.assertEqual(
+            p.to_bytes(encoding='ascii', encode_entities=True),
+            b'<p title="caf&eacute;">na&iuml;ve &ndash; &#x2603; &amp; text&#233;&eacute;</p>\n'
+        )
+
     def test_Element_empty_tag_is_None_to_string(self):
         node = htree.Element()
         self.assertEqual(node.to_string(), '')
@@ -676,6 +1312,29 @@ class TestSerializer(unittest.TestCase):
             '''
         ))
 
+    def test_Element_attr_changes_to_string(self):
+        p = htree.Element('p', id='foo')
+        self.assertEqual(p.to_string(), '<p id="foo"></p>\n')
+        p.set('class', 'bar')
+        self.assertEqual(p.to_string(), '<p class="bar" id="foo"></p>\n')
+        self.assertEqual(p.to_string(minify=True), '<p class=bar id=foo></p>')
+        p.attrib.pop('class')
+        self.assertEqual(p.to_string(format='xhtml'), '<p id="foo"></p>\n')
+        p.attrib = {'title': 'a', 'id': 'b'}
+        self.assertEqual(p.to_string(), '<p id="b" title="a"></p>\n')
+
+    def test_Element_attr_insertion_order_to_string(self):
+        p = htree.Element('p')
+        p.set('title', 'a')
+        p.set('id', 'b')
+        self.assertEqual(p.to_string(), '<p id="b" title="a"></p>\n')
+        if sys.version_info[0] == 3:
+            # Dictionaries do not keep insertion order on Python 2.
+            self.assertEqual(p.to_string(sort_attributes=False), '<p title="a" id="b"></p>\n')
+            self.assertEqual(p.to_string(sort_attributes=False, minify=True), '<p title=a id=b></p>')
+            self.assertEqual(p.to_string(sort_attributes=False, indent=2), '<p title="a" id="b"></p>\n')
+            self.assertEqual(p.to_bytes(sort_attributes=False), b'<p title="a" id="b"></p>\n')
+
     def test_Element_with_invalid_attr_to_string(self):
         p = htree.Element('p', id=None)
         self.assertRaises(TypeError, p.to_string)
@@ -687,6 +1346,270 @@ class TestSerializer(unittest.TestCase):
         node = htree.Text('some text')
         self.assertEqual(node.to_bytes(), 'some text'.encode(encoding='utf-8'))
 
+    def test_to_bytes_large(self):
+        div = htree.Element('div')
+        for i in range(500):
+            p = htree.Element('p', title='\xe9')
+            p.append(htree.Text('caf\xe9 \u2603 & {0}'.format(i)))
+            p.append(htree.RawText('\xe9'))
+            div.append(p)
+        text = div.to_string()
+        self.assertEqual(div.to_bytes(), text.encode('utf-8'))
+        self.assertEqual(div.to_bytes(encoding='ascii'), text.encode('ascii', 'xmlcharrefreplace'))
+        self.assertEqual(div.to_bytes(encoding='utf-16'), text.encode('utf-16'))
+        self.assertEqual(
+            div.to_bytes(encoding='ascii', encode_entities=True),
+            div.to_string(encode_entities=True).encode('ascii', 'xmlcharrefreplace')
+        )
+
+    def build_table(self):
+        tbody = htree.Element('tbody')
+        for i in range(10):
+            tr = htree.Element('tr', id='r{0}'.format(i))
+            td = htree.Element('td')
+            td.append(htree.Text('caf\xe9 {0}'.format(i)))
+            tr.extend([td, htree.Text('\n')])
+            tbody.append(tr)
+        tbody.append(htree.Comment('end'))
+        return tbody
+
+    def test_serialize_range(self):
+        tbody = self.build_table()
+        self.assertEqual(tbody.serialize_range(0, 1), '<tbody>\n<tr id="r0">\n<td>\ncaf\xe9 0</td>\n\n</tr>\n')
+        self.assertEqual(tbody.serialize_range(1, 2), '<tr id="r1">\n<td>\ncaf\xe9 1</td>\n\n</tr>\n')
+        self.assertEqual(tbody.serialize_range(-1), '<!-- end --></tbody>\n')
+        self.assertEqual(tbody.serialize_range(5, 2), '')
+        self.assertEqual(tbody.serialize_range(0, 0), '')
+        count = len(tbody)
+        self.assertEqual(tbody.serialize_range(count, count), '')
+        text = tbody.to_string()
+        self.assertEqual(tbody.serialize_range(0, 0) + tbody.serialize_range(0, count), text)
+        self.assertEqual(tbody.serialize_range(0, count) + tbody.serialize_range(count, count), text)
+        for options in ({}, {'minify': True}, {'indent': 2}, {'format': 'xhtml', 'encode_entities': True}):
+            parts = [tbody.serialize_range(i, i + 3, **options) for i in range(0, len(tbody), 3)]
+            self.assertEqual(''.join(parts), tbody.to_string(**options))
+
+    def test_serialize_range_empty(self):
+        br = htree.Element('br')
+        self.assertEqual(br.serialize_range(), '<br>\n')
+        self.assertEqual(br.serialize_range(format='xhtml'), '<br />\n')
+        self.assertEqual(htree.Element('div').serialize_range(), '<div></div>\n')
+
+    def test_iter_rendered_children(self):
+        tbody = self.build_table()
+        for options in ({}, {'minify': True}, {'indent': 2}, {'indent': '\t', 'format': 'xhtml'}):
+            for batch in (1, 4, 11, 100):
+                parts = list(tbody.iter_rendered_children(batch, **options))
+                self.assertEqual(len(parts), (len(tbody) + batch - 1) // batch)
+                self.assertEqual(''.join(parts), tbody.to_string(**options))
+        self.assertEqual(list(htree.Element('p').iter_rendered_children()), ['<p></p>\n'])
+        self.assertRaises(ValueError, list, tbody.iter_rendered_children(0))
+        self.assertRaises(ValueError, list, tbody.iter_rendered_children(minify=True, indent=2))
+
+    def test_serialize_range_minify_optional_end(self):
+        ul = htree.Element('ul')
+        for i in range(3):
+            li = htree.Element('li')
+            li.append(htree.Text(text_type(i)))
+            ul.append(li)
+        self.assertEqual(ul.serialize_range(0, 1, minify=True), '<ul><li>0')
+        self.assertEqual(ul.serialize_range(2, minify=True), '<li>2</ul>')
+
+
+class TestMinify(unittest.TestCase):
+
+    def test_text_whitespace(self):
+        node = htree.Element('div')
+        node.append(htree.Text('  some\n\ttext &  more\xa0 '))
+        self.assertEqual(node.to_string(minify=True), '<div> some text &amp; more\xa0 </div>')
+
+    def test_preserve_whitespace(self):
+        node = htree.Element('div')
+        pre = htree.Element('pre')
+        code = htree.Element('code')
+        code.append(htree.Text('a  =\n  b'))
+        pre.append(code)
+        textarea = htree.Element('textarea')
+        textarea.append(htree.Text('  x  '))
+        node.extend([pre, textarea])
+        self.assertEqual(
+            node.to_string(minify=True),
+            '<div><pre><code>a  =\n  b</code></pre><textarea>  x  </textarea></div>'
+        )
+
+    def test_raw_text_and_entities(self):
+        node = htree.Element('script')
+        node.append(htree.RawText('var  a = 1;\n'))
+        self.assertEqual(node.to_string(minify=True), '<script>var  a = 1;\n</script>')
+        node = htree.Element('span')
+        node.append(htree.Entity('amp'))
+        self.assertEqual(node.to_string(minify=True), '<span>&amp;</span>')
+
+    def test_comments_stripped(self):
+        node = htree.Element('div')
+        node.extend([htree.Comment('foo'), htree.Text('bar'), htree.Comment('baz')])
+        self.assertEqual(node.to_string(minify=True), '<div>bar</div>')
+
+    def test_attributes(self):
+        node = htree.Element('input', **{
+            'type': 'text', 'value': 'a b', 'class': '', 'disabled': 'disabled', 'title': 'a=b', 'name': 'x&y'
+        })
+        self.assertEqual(
+            node.to_string(minify=True),
+            '<input class disabled name=x&amp;y title="a=b" type=text value="a b">'
+        )
+        self.assertEqual(
+            node.to_string('xhtml', minify=True),
+            '<input class="" disabled="disabled" name="x&amp;y" title="a=b" type="text" value="a b" />'
+        )
+
+    def test_optional_end_tags(self):
+        ul = htree.Element('ul')
+        for text in ['one', 'two']:
+            li = htree.Element('li')
+            li.append(htree.Text(text))
+            ul.append(li)
+            ul.append(htree.Comment('sep'))
+        self.assertEqual(ul.to_string(minify=True), '<ul><li>one<li>two</ul>')
+        self.assertEqual(ul.to_string('xhtml', minify=True), '<ul><li>one</li><li>two</li></ul>')
+
+    def test_optional_end_tags_followers(self):
+        div = htree.Element('div')
+        div.extend([htree.Element('p'), htree.Element('div'), htree.Element('p'), htree.Element('span')])
+        self.assertEqual(div.to_string(minify=True), '<div><p><div></div><p></p><span></span></div>')
+        dl = htree.Element('dl')
+        dl.extend([htree.Element('dt'), htree.Element('dd'), htree.Element('dt')])
+        self.assertEqual(dl.to_string(minify=True), '<dl><dt><dd><dt></dt></dl>')
+
+    def test_optional_end_tags_whitespace(self):
+        ul = htree.Element('ul')
+        ul.extend([htree.Element('li'), htree.Text(' '), htree.Element('li')])
+        self.assertEqual(ul.to_string(minify=True), '<ul><li></li> <li></ul>')
+
+    def test_optional_end_tags_p_parent(self):
+        a = htree.Element('a')
+        a.append(htree.Element('p'))
+        self.assertEqual(a.to_string(minify=True), '<a><p></p></a>')
+        div = htree.Element('div')
+        div.append(htree.Element('p'))
+        self.assertEqual(div.to_string(minify=True), '<div><p></div>')
+
+    def test_optional_end_tags_no_parent(self):
+        self.assertEqual(htree.Element('li').to_string(minify=True), '<li></li>')
+        root = htree.Element(None)
+        root.append(htree.Element('li'))
+        self.assertEqual(root.to_string(minify=True), '<li></li>')
+
+    def test_no_newlines(self):
+        root = htree.Element(None)
+        div = htree.Element('div')
+        div.extend([htree.Element('p'), htree.Element('br'), htree.Element('img', src='a.png')])
+        root.extend([div, htree.Element('table')])
+        self.assertEqual(root.to_string(minify=True), '<div><p></p><br><img src=a.png></div><table></table>')
+
+    def test_to_bytes(self):
+        node = htree.Element('p')
+        node.append(htree.Text(' caf\xe9  '))
+        self.assertEqual(node.to_bytes(minify=True), '<p> caf\xe9 </p>'.encode('utf-8'))
+
+    def test_invalid(self):
+        node = htree.Element('p')
+        node._children.append('not a node')
+        self.assertRaises(TypeError, node.to_string, minify=True)
+        self.assertRaises(TypeError, htree._serialize_node_minified, [].append, None, 'html')
+
+
+class TestIndent(unittest.TestCase):
+
+    def test_nested_blocks(self):
+        div = htree.Element('div', id='main')
+        ul = htree.Element('ul')
+        for text in ['one', 'two']:
+            li = htree.Element('li')
+            li.append(htree.Text(text))
+            ul.append(li)
+        p = htree.Element('p')
+        em = htree.Element('em')
+        em.append(htree.Text('big'))
+        p.extend([htree.Text('Hello '), em, htree.Text(' world')])
+        div.extend([htree.Text('\n  '), ul, p, htree.Comment('note'), htree.Element('hr')])
+        self.assertEqual(
+            div.to_string(indent=2),
+            dedent(
+                """
+                <div id="main">
+                  <ul>
+                    <li>one</li>
+                    <li>two</li>
+                  </ul>
+                  <p>Hello <em>big</em> world</p>
+                  <!-- note --><hr>
+                </div>
+                """
+            )
+        )
+
+    def test_indent_string(self):
+        div = htree.Element('div')
+        div.append(htree.Element('div'))
+        div[0].append(htree.Element('p'))
+        self.assertEqual(div.to_string(indent='\t'), '<div>\n\t<div>\n\t\t<p></p>\n\t</div>\n</div>\n')
+
+    def test_mixed_content(self):
+        div = htree.Element('div')
+        div.extend([htree.Text('text'), htree.Element('p'), htree.Text('more')])
+        self.assertEqual(div.to_string(indent=2), '<div>\n  text<p></p>\n  more\n</div>\n')
+
+    def test_leading_whitespace(self):
+        div = htree.Element('div')
+        div.extend([htree.Element('p'), htree.Text('  lead'), htree.Comment('note\n'), htree.Text('after')])
+        self.assertEqual(div.to_string(indent=2), '<div>\n  <p></p>\n  lead<!-- note\n -->after\n</div>\n')
+        parts = [div.serialize_range(i, i + 1, indent=2) for i in range(len(div))]
+        self.assertEqual(''.join(parts), div.to_string(indent=2))
+
+    def test_inline_content(self):
+        div = htree.Element('div')
+        div.extend([htree.Text('text'), htree.Element('br'), htree.Text('more')])
+        self.assertEqual(div.to_string(indent=2), '<div>text<br>\nmore</div>\n')
+
+    def test_preserve_whitespace(self):
+        div = htree.Element('div')
+        pre = htree.Element('pre')
+        pre.append(htree.Element('div'))
+        pre[0].append(htree.Text('  x\n y'))
+        textarea = htree.Element('textarea')
+        textarea.append(htree.Text('  a\n b'))
+        div.extend([pre, textarea])
+        self.assertEqual(
+            div.to_string(indent=2),
+            '<div>\n  {0}  {1}\n</div>\n'.format(pre.to_string(), textarea.to_string())
+        )
+
+    def test_raw_text(self):
+        div = htree.Element('div')
+        script = htree.Element('script')
+        script.append(htree.RawText('var a;\nvar b;'))
+        div.extend([script, htree.Element('p')])
+        self.assertEqual(div.to_string(indent=4), '<div>\n    <script>var a;\nvar b;</script>\n    <p></p>\n</div>\n')
+
+    def test_xhtml(self):
+        div = htree.Element('div')
+        div.extend([htree.Element('p'), htree.Element('hr', id='x')])
+        self.assertEqual(div.to_string('xhtml', indent=1), '<div>\n <p></p>\n <hr id="x" />\n</div>\n')
+
+    def test_fragment_and_leaves(self):
+        root = htree.Element(None)
+        root.extend([htree.Element('p'), htree.Element('p')])
+        self.assertEqual(root.to_string(indent=2), '<p></p>\n<p></p>\n')
+        self.assertEqual(htree.Text('a < b').to_string(indent=2), 'a &lt; b')
+        self.assertEqual(htree.Entity('amp').to_bytes(indent=2), b'&amp;')
+
+    def test_invalid(self):
+        node = htree.Element('p')
+        self.assertRaises(ValueError, node.to_string, minify=True, indent=2)
+        node._children.append('not a node')
+        self.assertRaises(TypeError, node.to_string, indent=2)
+
 
 class TestTreeBuilder(unittest.TestCase):
     def test_builder_Text(self):
@@ -853,5 +1776,790 @@ class TestTreeBuilder(unittest.TestCase):
         doc = builder.close()
         self.assertEqual(doc.to_string(), '<div></div>\n<p></p>\n')
 
+    def test_builder_attribute_mapping(self):
+        builder = htree.TreeBuilder()
+        builder.start('p', {'id': 'foo'})
+        builder.start('a', [('href', '/'), ('title', 'x')], id='bar')
+        builder.end('a')
+        builder.end('p')
+        doc = builder.close()
+        self.assertEqual(doc.to_string(), '<p id="foo"><a href="/" id="bar" title="x"></a></p>\n')
+
+    def test_builder_coalesce(self):
+        builder = htree.TreeBuilder(coalesce=True)
+        builder.start('p')
+        builder.data('one ')
+        builder.data('two')
+        builder.data('amp', node_type=htree.Entity)
+        builder.data('three')
+        builder.data(' four', node_type=htree.Text)
+        builder.data('<b>', node_type=htree.RawText)
+        builder.data('<i>', node_type=htree.RawText)
+        builder.data('a', node_type=htree.Comment)
+        builder.data('b', node_type=htree.Comment)
+        builder.start('br')
+        builder.end('br')
+        builder.data('five')
+        builder.end('p')
+        doc = builder.close()
+        self.assertEqual(doc[:], ['one two', '&amp;', 'three four', '<b><i>', 'a', 'b', doc[6], 'five'])
+        self.assertEqual([type(n) for n in doc[:6]], [
+            htree.Text, htree.Entity, htree.Text, htree.RawText, htree.Comment, htree.Comment
+        ])
+        self.assertTrue(all(n.parent is doc for n in doc))
+        self.assertEqual(doc.to_string(), '<p>one two&amp;three four<b><i><!-- a --><!-- b --><br>\nfive</p>\n')
+
+    def test_builder_coalesce_empty_element(self):
+        builder = htree.TreeBuilder(coalesce=True)
+        builder.start('br')
+        self.assertRaises(TypeError, builder.data, 'text')
+
+    def test_builder_intern(self):
+        builder = htree.TreeBuilder(intern=True)
+        builder.start(None)
+        for i in range(2):
+            builder.start(''.join(['d', 'iv']), **{''.join(['cl', 'ass']): ''.join(['fo', 'o'])})
+            builder.end('div')
+        builder.end(None)
+        doc = builder.close()
+        self.assertIs(doc[0].tag, doc[1].tag)
+        self.assertIs(list(doc[0].keys())[0], list(doc[1].keys())[0])
+        self.assertIs(doc[0].get('class'), doc[1].get('class'))
+        self.assertEqual(doc.to_string(), '<div class="foo"></div>\n<div class="foo"></div>\n')
+
+    def test_builder_intern_shared_pool(self):
+        pool = {}
+        docs = []
+        for i in range(2):
+            builder = htree.TreeBuilder(intern=pool)
+            builder.start(''.join(['s', 'pan']), id=''.join(['x', 'y']))
+            builder.end('span')
+            docs.append(builder.close())
+        self.assertIs(docs[0].tag, docs[1].tag)
+        self.assertIs(docs[0].get('id'), docs[1].get('id'))
+        self.assertEqual(pool['span'], 'span')
+
+    def test_intern_tree(self):
+        root = htree.Element(None)
+        a = htree.Element(''.join(['a', 'bbr']), title=''.join(['t', 'ip']))
+        b = htree.Element(''.join(['ab', 'br']), title=''.join(['ti', 'p']))
+        root.extend([a, b, htree.Text('text')])
+        self.assertIsNot(a.tag, b.tag)
+        pool = htree.intern_tree(root)
+        self.assertIs(a.tag, b.tag)
+        self.assertIs(a.get('title'), b.get('title'))
+        self.assertIs(pool, htree.intern_tree(root, pool))
+        self.assertEqual(root.to_string(), '<abbr title="tip"></abbr><abbr title="tip"></abbr>text')
+
+    def test_intern_tree_classes(self):
+        p = htree.Element('p', **{'class': 'a'})
+        classes = p.classes
+        classes.add('b')
+        htree.intern_tree(p)
+        classes.add('c')
+        self.assertEqual(p.get('class'), 'a b c')
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_simple(self):
+        doc = htree.from_string('<p id="foo">Some <em>text</em>.</p>')
+        self.assertEqual(doc.tag, None)
+        self.assertEqual(doc.to_string(), '<p id="foo">Some <em>text</em>.</p>\n')
+        self.assertTrue(doc[0].parent is doc)
+
+    def test_parse_node_types(self):
+        doc = htree.from_string(
+            '<!DOCTYPE html><!-- a comment --><script>if (a < b) {}</script><p>a &amp; b</p>'
+        )
+        self.assertTrue(isinstance(doc[0], htree.RawText))
+        self.assertEqual(doc[0], '<!DOCTYPE html>')
+        self.assertTrue(isinstance(doc[1], htree.Comment))
+        self.assertEqual(doc[1], 'a comment')
+        self.assertTrue(isinstance(doc[2][0], htree.RawText))
+        self.assertEqual(doc[3][0], 'a & b')
+        self.assertEqual(
+            doc.to_string(),
+            '<!DOCTYPE html><!-- a comment --><script>\nif (a < b) {}</script>\n<p>a &amp; b</p>\n'
+        )
+
+    def test_parse_attributes(self):
+        doc = htree.from_string('<input type="checkbox" checked type="radio">')
+        self.assertEqual(doc[0].attrib, {'type': 'checkbox', 'checked': 'checked'})
+        self.assertEqual(len(doc[0]), 0)
+
+    def test_parse_implied_end_tags(self):
+        doc = htree.from_string('<ul><li>one<li>two</ul><p>three<div>four</span></div>')
+        self.assertEqual(
+            doc.to_string(),
+            dedent(
+                '''
+                <ul>
+                <li>
+                one</li>
+                <li>
+                two</li>
+                </ul>
+                <p>three</p>
+                <div>
+                four</div>
+                '''
+            )
+        )
+
+    def test_parse_empty_elements(self):
+        doc = htree.from_string(
+            '<head><meta charset="utf-8"><title>T</title></head>'
+            '<object><param name="a"><embed src="b"></object><video><source src="c"><track src="d"></video>'
+            '<p>a<wbr>b</p>'
+        )
+        head, obj, video, p = doc
+        self.assertEqual([n.tag for n in head], ['meta', 'title'])
+        self.assertEqual([n.tag for n in obj], ['param', 'embed'])
+        self.assertEqual([n.tag for n in video], ['source', 'track'])
+        self.assertEqual(p[:], ['a', p[1], 'b'])
+        self.assertTrue(all(len(n) == 0 for n in [head[0], obj[0], obj[1], video[0], video[1], p[1]]))
+        self.assertNotIn('</meta>', doc.to_string())
+
+    def test_parse_implied_table_end_tags(self):
+        doc = htree.from_string('<table><thead><tr><th>a<th>b<tbody><tr><td>1<tr><td>2<td><p>3</table><p>4')
+        table = doc[0]
+        self.assertEqual([n.tag for n in table], ['thead', 'tbody'])
+        self.assertEqual([n.tag for n in table[0][0]], ['th', 'th'])
+        rows = table[1]
+        self.assertEqual([n.tag for n in rows], ['tr', 'tr'])
+        self.assertEqual([n.tag for n in rows[1]], ['td', 'td'])
+        self.assertEqual(rows[1][1][0].tag, 'p')
+        self.assertEqual(doc[1].tag, 'p')
+
+    def test_parse_nested_table(self):
+        doc = htree.from_string('<table><tr><td><table><tr><td>a</table><td>b</table>')
+        row = doc[0][0]
+        self.assertEqual([n.tag for n in row], ['td', 'td'])
+        self.assertEqual(row[0][0].tag, 'table')
+
+    def test_parse_unclosed(self):
+        doc = htree.from_string('<div><p>one<br>two')
+        self.assertEqual(doc.to_string(), '<div>\n<p>one<br>\ntwo</p>\n</div>\n')
+
+    def test_parse_chunks(self):
+        parser = htree.Parser()
+        for char in '<p>Some <em>text</em> here.</p>':
+            parser.feed(char)
+        doc = parser.close()
+        self.assertEqual(doc[0][:], ['Some ', doc[0][1], ' here.'])
+        self.assertEqual(doc[0][1][:], ['text'])
+
+    def test_parse_file(self):
+        doc = htree.parse(io.BytesIO('<p>caf\xe9</p>'.encode('utf-8')))
+        self.assertEqual(doc[0][0], 'caf\xe9')
+
+
+class DropScripts(htree.Filter):
+    depth = 0
+
+    def start(self, tag, attrs=None):
+        if self.depth or tag == 'script':
+            self.depth += 1
+        else:
+            htree.Filter.start(self, tag, attrs)
+
+    def end(self, tag):
+        if self.depth:
+            self.depth -= 1
+        else:
+            htree.Filter.end(self, tag)
+
+    def data(self, data, node_type=None):
+        if not self.depth:
+            htree.Filter.data(self, data, node_type)
+
+
+class SecureLinks(htree.Filter):
+    def start(self, tag, attrs=None):
+        if tag == 'a' and attrs and attrs.get('href', '').startswith('http:'):
+            attrs['href'] = 'https:' + attrs['href'][5:]
+        htree.Filter.start(self, tag, attrs)
+
+
+class TestStreaming(unittest.TestCase):
+    source = (
+        '<!DOCTYPE html><html><head><title>T &amp; x</title><script>if (a < b) {}</script></head>'
+        '<body><p>one<img src="a.png"><p>two<ul><li>a<li>b</ul><br><img src="b.png"><input disabled>'
+        '<!-- c --><div></div><div>x</div>&eacute;<pre>  a\n b</pre><table><tr><td>1<td>2</table>'
+        '<a href="http://example.com">link</a></body></html>'
+    )
+
+    def stream(self, target, format='html'):
+        out = []
+        htree.from_string(self.source, target(htree.StreamWriter(out.append, format)))
+        return ''.join(out)
+
+    def test_identical_output(self):
+        doc = htree.from_string(self.source)
+        self.assertEqual(self.stream(htree.Filter), doc.to_string())
+        self.assertEqual(self.stream(htree.Filter, 'xhtml'), doc.to_string('xhtml'))
+
+    def test_filters(self):
+        doc = htree.from_string(self.source, DropScripts(SecureLinks(htree.TreeBuilder())))
+        self.assertEqual(doc.xpath('//script'), [])
+        self.assertEqual(doc.xpath('string(//a/@href)'), 'https://example.com')
+        self.assertEqual(self.stream(lambda target: DropScripts(SecureLinks(target))), doc.to_string())
+
+    def test_file_output(self):
+        out = io.StringIO()
+        writer = htree.StreamWriter(out)
+        writer.start('p', id='a')
+        writer.data('x & y')
+        writer.data('a comment', htree.Comment)
+        writer.data('<b>', htree.RawText)
+        writer.data('amp', htree.Entity)
+        writer.end('p')
+        writer.close()
+        self.assertEqual(out.getvalue(), '<p id="a">x &amp; y<!-- a comment --><b>&amp;</p>\n')
+
+    def test_reserved_attribute_names(self):
+        source = '<div tag="x" self="y" attrs="z">a</div>'
+        out = io.StringIO()
+        parser = htree.Parser(htree.Filter(htree.StreamWriter(out)))
+        parser.feed(source)
+        parser.close()
+        self.assertEqual(out.getvalue(), htree.from_string(source).to_string())
+        self.assertEqual(out.getvalue(), '<div attrs="z" self="y" tag="x">\na</div>\n')
+
+    def test_errors(self):
+        writer = htree.StreamWriter([].append)
+        self.assertRaises(htree.TreeBuilderError, writer.data, 'x')
+        self.assertRaises(htree.TreeBuilderError, writer.end, 'p')
+        writer.start('div')
+        self.assertRaises(htree.TreeBuilderError, writer.end, 'p')
+        self.assertRaises(htree.TreeBuilderError, writer.close)
+        writer.start('br')
+        self.assertRaises(htree.TreeBuilderError, writer.data, 'x')
+
+
+class TestTemplates(unittest.TestCase):
+    source = (
+        '<div class="card"><h2>Title</h2><p>Static <em>text</em> &amp; more.</p><ul><li>a<li>b</ul>'
+        '<a href="/">link</a><img alt="a" src="x.png"><input type="checkbox" checked><br></div>'
+    )
+
+    def build(self):
+        doc = htree.from_string(self.source)
+        title = doc.xpath('//h2')[0]
+        title[:] = [htree.Text('Heading: '), htree.Slot('title')]
+        doc.xpath('//a')[0].set('href', htree.Slot('url'))
+        doc.xpath('//input')[0].set('checked', htree.Slot('checked'))
+        doc.xpath('//li')[1][:] = [htree.Slot('title')]
+        return doc
+
+    def fill(self, doc, values):
+        # Replace each slot in `doc` with its value.
+        for node in doc.xpath('//*'):
+            for k, v in list(node.items()):
+                if isinstance(v, htree.Slot):
+                    node.set(k, values[v.name])
+            for i, child in enumerate(node):
+                if isinstance(child, htree.Slot):
+                    node[i] = htree.Text(values[child.name])
+        return doc
+
+    def test_identical_output(self):
+        for format in ['html', 'xhtml']:
+            render = htree.compile_template(self.build(), format)
+            for values in [
+                {'title': 'A & <b>', 'url': '/a?b&c', 'checked': 'checked'},
+                {'title': '', 'url': '"quoted"', 'checked': ''},
+            ]:
+                expected = self.fill(self.build(), values).to_string(format)
+                self.assertEqual(render(**values), expected)
+
+    def test_source(self):
+        source = htree.template_source(self.build())
+        self.assertIn('def render(title, url, checked):', source)
+        self.assertIn('<p>Static <em>text</em> &amp; more.</p>', source)
+        self.assertEqual(htree.compile_template(htree.from_string('<p>a</p>'))(), '<p>a</p>\n')
+        self.assertEqual(htree.compile_template(htree.Element(None))(), '')
+
+    def test_slot(self):
+        slot = htree.Slot('name', 'default')
+        self.assertEqual(slot.name, 'name')
+        self.assertTrue(htree.is_text(slot))
+        p = htree.Element('p', title=htree.Slot('title', 'x'))
+        p.append(slot)
+        self.assertEqual(p.to_string(), '<p title="x">default</p>\n')
+        self.assertRaises(ValueError, htree.Slot, 'not valid')
+        self.assertRaises(ValueError, htree.Slot, 'None')
+        self.assertRaises(ValueError, htree.Slot, 'class')
+        self.assertRaises(ValueError, htree.Slot, 'for')
+
+    def test_slot_names_shadowing_helpers(self):
+        p = htree.Element('p', title=htree.Slot('_render_slot_attrib'))
+        p.append(htree.Slot('_escape_cdata'))
+        render = htree.compile_template(p)
+        self.assertEqual(render(_escape_cdata='a<b', _render_slot_attrib='"t"'),
+                         '<p title="&quot;t&quot;">a&lt;b</p>\n')
+
+    def test_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            render = htree.compile_template(self.build(), cache_dir=cache_dir)
+            files = os.listdir(cache_dir)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].startswith('htree_template_'))
+            self.assertTrue(htree.compile_template(self.build(), cache_dir=cache_dir) is render)
+            self.assertEqual(render('t', '/', 'checked'), htree.compile_template(self.build())('t', '/', 'checked'))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+def add_class(root):
+    for node in root.xpath('//p'):
+        node.set('class', 'x')
+
+
+def fail_on_error(root):
+    if root.xpath('//error'):
+        raise ValueError('found error')
+
+
+class TestProcessFiles(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(5):
+            path = os.path.join(self.dir, '{0}.html'.format(i))
+            with open(path, 'w') as f:
+                f.write('<p>{0}</p>'.format(i) if i != 3 else '<error>')
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_in_process(self):
+        results = list(htree.process_files(self.paths, add_class, workers=1))
+        self.assertEqual([r.path for r in results], self.paths)
+        self.assertEqual(results[0].data, b'<p class="x">0</p>\n')
+        self.assertEqual(results[0].size, 8)
+        self.assertEqual(results[0].error, None)
+
+    def test_errors(self):
+        paths = self.paths + [os.path.join(self.dir, 'missing.html')]
+        results = list(htree.process_files(paths, fail_on_error, workers=1))
+        errors = [r for r in results if r.error]
+        self.assertEqual([r.path for r in errors], [self.paths[3], paths[-1]])
+        self.assertEqual(errors[0].error, 'ValueError: found error')
+        self.assertEqual(results[4].data, b'<p>4</p>\n')
+
+    def test_workers(self):
+        results = list(htree.process_files(self.paths, add_class, workers=2, chunksize=2))
+        self.assertEqual([r.path for r in results], self.paths)
+        self.assertEqual(results[4].data, b'<p class="x">4</p>\n')
+        results = htree.process_files(self.paths, add_class, workers=2, ordered=False)
+        self.assertEqual(sorted(r.path for r in results), sorted(self.paths))
+
+    def test_output_dir(self):
+        out = os.path.join(self.dir, 'out')
+        os.mkdir(out)
+        results = list(htree.process_files(self.paths[:1], workers=1, format='xhtml', output_dir=out))
+        self.assertEqual(results[0].data, None)
+        with open(os.path.join(out, '0.html'), 'rb') as f:
+            self.assertEqual(f.read(), b'<p>0</p>\n')
+
+    def test_output_dir_duplicate_names(self):
+        out = os.path.join(self.dir, 'out')
+        os.mkdir(out)
+        other = os.path.join(self.dir, 'other')
+        os.mkdir(other)
+        paths = [self.paths[0], os.path.join(other, '0.html')]
+        self.assertRaises(ValueError, list, htree.process_files(paths, workers=1, output_dir=out))
+        self.assertEqual(os.listdir(out), [])
+
+    def test_interleaved(self):
+        plain = htree.process_files(self.paths, workers=1)
+        classed = htree.process_files(self.paths, add_class, workers=1)
+        self.assertEqual(next(plain).data, b'<p>0</p>\n')
+        self.assertEqual(next(classed).data, b'<p class="x">0</p>\n')
+        self.assertEqual(next(plain).data, b'<p>1</p>\n')
+
+
+class CustomElement(htree.Element):
+    pass
+
+
+class TestWire(unittest.TestCase):
+
+    def build_tree(self):
+        root = htree.Element(None)
+        div = htree.Element('div', **{'class': 'foo', 'id': 'b\xe4r'})
+        div.extend([
+            htree.Text('Some text'),
+            htree.Entity('amp'),
+            htree.Comment('a comment'),
+            htree.RawText('<b>raw</b>'),
+            htree.Element('br')
+        ])
+        root.extend([div, htree.Element('p')])
+        return root
+
+    def test_roundtrip(self):
+        root = self.build_tree()
+        copy = htree.from_wire(htree.to_wire(root))
+        self.assertEqual(copy.to_string(), root.to_string())
+        self.assertIsNone(copy.tag)
+        self.assertIsNone(copy.parent)
+        div = copy[0]
+        self.assertIs(div.parent, copy)
+        self.assertEqual(div.attrib, {'class': 'foo', 'id': 'b\xe4r'})
+        self.assertEqual([type(n) for n in div],
+                         [htree.Text, htree.Entity, htree.Comment, htree.RawText, htree.Element])
+        self.assertTrue(all(n.parent is div for n in div))
+
+    def test_roundtrip_text(self):
+        node = htree.from_wire(htree.to_wire(htree.Text('foo')))
+        self.assertTrue(htree.is_text(node, strict=True))
+        self.assertEqual(node, 'foo')
+
+    def test_subtree_excludes_parent(self):
+        root = self.build_tree()
+        copy = htree.from_wire(htree.to_wire(root[0]))
+        self.assertEqual(copy.tag, 'div')
+        self.assertIsNone(copy.parent)
+
+    def test_large_string_table(self):
+        root = htree.Element('ul')
+        for i in range(300):
+            li = htree.Element('li', id='item-{0}'.format(i))
+            li.append(htree.Text('x' * i))
+            root.append(li)
+        self.assertEqual(htree.from_wire(htree.to_wire(root)).to_string(), root.to_string())
+
+    def test_deep_tree(self):
+        root = node = htree.Element('div')
+        for i in range(5000):
+            child = htree.Element('div')
+            node.append(child)
+            node = child
+        copy = htree.from_wire(htree.to_wire(root))
+        depth = 0
+        while len(copy):
+            copy = copy[0]
+            depth += 1
+        self.assertEqual(depth, 5000)
+
+    def test_pickle(self):
+        import pickle
+        root = self.build_tree()
+        copy = pickle.loads(pickle.dumps(root[0], 2))
+        self.assertEqual(copy.to_string(), root[0].to_string())
+        self.assertIsNone(copy.parent)
+        entity = pickle.loads(pickle.dumps(htree.Entity('amp')))
+        self.assertTrue(htree.is_entity(entity))
+        self.assertEqual(entity, '&amp;')
+
+    def test_copy(self):
+        import copy
+        root = self.build_tree()
+        div = root[0]
+        shallow = copy.copy(div)
+        self.assertIsNot(shallow, div)
+        self.assertEqual(shallow[:], div[:])
+        self.assertIs(shallow[0], div[0])
+        shallow.append(htree.Text('more'))
+        shallow.set('id', 'other')
+        self.assertNotEqual(len(shallow), len(div))
+        self.assertNotEqual(div.get('id'), 'other')
+        text = copy.copy(htree.Text('text'))
+        self.assertEqual(text.__class__, htree.Text)
+        self.assertEqual(text, 'text')
+        deep = copy.deepcopy(div)
+        self.assertIsNot(deep[0], div[0])
+        self.assertEqual(deep.to_string(), div.to_string())
+
+    def test_copy_subclasses(self):
+        import copy
+        import pickle
+        node = CustomElement('div', id='a')
+        node.append(htree.Slot('name', 'default'))
+        for clone in [copy.deepcopy(node), pickle.loads(pickle.dumps(node, 2))]:
+            self.assertEqual(clone.__class__, CustomElement)
+            self.assertEqual(clone[0].__class__, htree.Slot)
+            self.assertEqual(clone[0].name, 'name')
+            self.assertEqual(clone[0], 'default')
+            self.assertIs(clone[0].parent, clone)
+        template = htree.compile_template(copy.deepcopy(node))
+        self.assertEqual(template(name='x'), '<div id="a">\nx</div>\n')
+
+    def test_copy_mixed(self):
+        import copy
+        import pickle
+        node = htree.Element('div')
+        p1 = htree.Element('p')
+        p1.append(htree.Text('text'))
+        p2 = htree.Element('p')
+        p2.append(htree.Slot('name'))
+        node.extend([p1, p2])
+        for clone in [copy.deepcopy(node), pickle.loads(pickle.dumps(node, 2))]:
+            self.assertEqual(clone.to_string(), node.to_string())
+            for p in clone:
+                self.assertIs(p.parent, clone)
+                self.assertIs(p[0].parent, p)
+        self.assertIsNone(copy.deepcopy(p2).parent)
+
+    def test_copy_non_string_attribute(self):
+        import copy
+        node = htree.Element('div', **{'data-n': 5})
+        clone = copy.deepcopy(node)
+        self.assertEqual(clone.get('data-n'), 5)
+        self.assertRaises(TypeError, htree.to_wire, node)
+
+    def test_native_strings(self):
+        import copy
+        node = htree.Element(str('p'), {str('id'): str('x')})
+        self.assertEqual(copy.deepcopy(node).to_string(), '<p id="x"></p>\n')
+        self.assertEqual(htree.from_wire(htree.to_wire(node)).to_string(), '<p id="x"></p>\n')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, htree.from_wire, b'')
+        self.assertRaises(ValueError, htree.from_wire, b'nonsense')
+        buf = htree.to_wire(self.build_tree())
+        self.assertRaises(ValueError, htree.from_wire, buf[:-1])
+        self.assertRaises(ValueError, htree.from_wire, buf + b'\x01')
+
+    def test_invalid_attribute(self):
+        node = htree.Element('p', id=1)
+        self.assertRaises(TypeError, htree.to_wire, node)
+
+
+class TestStats(unittest.TestCase):
+    def build_tree(self):
+        root = htree.Element('div', id='a')
+        p = htree.Element('p', klass='x')
+        p.append(htree.Text('caf\xe9'))
+        p.append(htree.Entity('amp'))
+        root.append(p)
+        root.append(htree.Comment('note'))
+        root.append(htree.Element('br'))
+        return root
+
+    def test_stats(self):
+        stats = htree.stats(self.build_tree())
+        self.assertEqual(stats['nodes'], 6)
+        self.assertEqual(stats['Element'], 3)
+        self.assertEqual(stats['Text'], 1)
+        self.assertEqual(stats['Entity'], 1)
+        self.assertEqual(stats['Comment'], 1)
+        self.assertEqual(stats['RawText'], 0)
+        self.assertEqual(stats['max_depth'], 2)
+        self.assertEqual(stats['max_fanout'], 3)
+        self.assertEqual(stats['text_bytes'], 5 + len('&amp;') + 4)
+
+    def test_stats_leaf(self):
+        stats = htree.stats(htree.Element('br'))
+        self.assertEqual(stats['nodes'], 1)
+        self.assertEqual(stats['max_depth'], 0)
+        self.assertEqual(stats['max_fanout'], 0)
+
+    def test_deep_sizeof(self):
+        root = self.build_tree()
+        size = htree.deep_sizeof(root)
+        self.assertGreater(size, htree.deep_sizeof(root[0]))
+        root.append(htree.Text('x' * 1000))
+        self.assertGreater(htree.deep_sizeof(root), size + 1000)
+
+    def test_deep_sizeof_shared_strings(self):
+        seen = set()
+        first = htree.deep_sizeof(self.build_tree(), seen)
+        second = htree.deep_sizeof(self.build_tree(), seen)
+        self.assertLess(second, first)
+
+
+class TestCompare(unittest.TestCase):
+    def build_tree(self):
+        return htree.from_string('<div id="a" class="b"><p>One <em>two</em></p>\n<p>Three</p><!-- four --></div>')
+
+    def test_equal(self):
+        self.assertTrue(htree.tree_equal(self.build_tree(), self.build_tree()))
+        self.assertIsNone(htree.tree_diff(self.build_tree(), self.build_tree()))
+        tree = self.build_tree()
+        self.assertTrue(htree.tree_equal(tree, tree))
+
+    def test_text(self):
+        a, b = self.build_tree(), self.build_tree()
+        b[0][0][1][0] = htree.Text('TWO')
+        self.assertFalse(htree.tree_equal(a, b))
+        self.assertEqual(
+            htree.tree_diff(a, b),
+            '/#fragment/div[0]/p[0]/em[1]/#text[0]: {0!r} != {1!r}'.format('two', 'TWO')
+        )
+
+    def test_node_type(self):
+        a, b = self.build_tree(), self.build_tree()
+        b[0][2][0] = htree.RawText('Three')
+        self.assertEqual(htree.tree_diff(a, b), '/#fragment/div[0]/p[2]/#text[0]: Text != RawText')
+
+    def test_tag_and_attributes(self):
+        a, b = self.build_tree(), self.build_tree()
+        b[0][2].tag = 'div'
+        self.assertEqual(htree.tree_diff(a, b), '/#fragment/div[0]/p[2]: tag {0!r} != {1!r}'.format('p', 'div'))
+        b = self.build_tree()
+        b[0].set('id', 'z')
+        self.assertTrue(htree.tree_diff(a, b).startswith('/#fragment/div[0]: attributes'))
+
+    def test_attribute_order(self):
+        a = htree.Element('p', [('a', '1'), ('b', '2')])
+        b = htree.Element('p', [('b', '2'), ('a', '1')])
+        self.assertTrue(htree.tree_equal(a, b))
+        if sys.version_info[0] == 3:
+            # Dictionaries do not keep insertion order on Python 2.
+            self.assertFalse(htree.tree_equal(a, b, ignore_attr_order=False))
+
+    def test_child_count(self):
+        a, b = self.build_tree(), self.build_tree()
+        b[0].append(htree.Text('five'))
+        self.assertEqual(htree.tree_diff(a, b), '/#fragment/div[0]: 4 children != 5')
+        # Differences in shared children are reported first.
+        b[0][2][0] = htree.Text('3')
+        self.assertEqual(htree.tree_diff(a, b), '/#fragment/div[0]/p[2]/#text[0]: {0!r} != {1!r}'.format('Three', '3'))
+
+    def test_ignore_whitespace(self):
+        a = htree.from_string('<div>\n  <p>One   two </p>\n</div>')
+        b = htree.from_string('<div><p>One two</p></div>')
+        self.assertFalse(htree.tree_equal(a, b))
+        self.assertTrue(htree.tree_equal(a, b, ignore_whitespace=True))
+        b[0][0].append(htree.RawText(' '))
+        self.assertFalse(htree.tree_equal(a, b, ignore_whitespace=True))
+
+    def test_deep(self):
+        def build():
+            root = node = htree.Element('div')
+            for _ in range(10000):
+                child = htree.Element('div')
+                node.append(child)
+                node = child
+            return root
+        self.assertTrue(htree.tree_equal(build(), build()))
+
+
+class TestFragmentCache(unittest.TestCase):
+    def test_get(self):
+        cache = htree.FragmentCache()
+        first = cache.get('<p class="x">Hello</p>')
+        second = cache.get('<p class="x">Hello</p>')
+        self.assertIsNot(first, second)
+        self.assertEqual(first.to_string(), second.to_string())
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.entries), (1, 1, 1))
+
+    def test_copy_on_access(self):
+        cache = htree.FragmentCache()
+        tree = cache.get('<p>Hello</p>')
+        tree[0].set('id', 'changed')
+        tree[0].append(htree.Text('!'))
+        self.assertEqual(cache.get('<p>Hello</p>').to_string(), '<p>Hello</p>\n')
+
+    def test_render(self):
+        cache = htree.FragmentCache()
+        self.assertEqual(cache.render('<p>Hi</p>'), '<p>Hi</p>\n')
+        self.assertEqual(cache.render('<p>Hi</p>'), '<p>Hi</p>\n')
+        self.assertEqual(cache.render('<p>Hi</p>', minify=True), '<p>Hi</p>')
+        self.assertEqual(len(cache), 3)  # One tree and two renderings.
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+
+    def test_eviction(self):
+        cache = htree.FragmentCache(max_bytes=200)
+        for i in range(10):
+            cache.get('<p>{0}</p>'.format(i))
+        info = cache.info()
+        self.assertLessEqual(info.size, 200)
+        self.assertGreater(info.evictions, 0)
+        self.assertEqual(info.entries + info.evictions, 10)
+        # The most recently used entry is kept.
+        cache.get('<p>9</p>')
+        self.assertEqual(cache.info().hits, 1)
+
+    def test_oversized(self):
+        cache = htree.FragmentCache(max_bytes=10)
+        cache.get('<p>Too big to cache</p>')
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = htree.FragmentCache()
+        cache.get('<p>Hello</p>')
+        cache.clear()
+        info = cache.info()
+        self.assertEqual((info.entries, info.size, info.misses), (0, 0, 1))
+
+
+class TestInstrument(unittest.TestCase):
+
+    def tearDown(self):
+        htree.instrument.disable()
+        htree.instrument.reset()
+
+    def test_disabled(self):
+        self.assertFalse(htree.instrument.enabled)
+        node = htree.Element('p')
+        node.append(htree.Text('foo'))
+        self.assertEqual(node.to_string(), '<p>foo</p>\n')
+        self.assertEqual(htree.instrument.stats, {})
+
+    def test_enable_disable(self):
+        serialize = htree._serialize_node
+        append = htree.Element.append
+        htree.instrument.enable()
+        self.assertTrue(htree.instrument.enabled)
+        self.assertIsNot(htree._serialize_node, serialize)
+        htree.instrument.enable()
+        htree.instrument.disable()
+        self.assertFalse(htree.instrument.enabled)
+        self.assertIs(htree._serialize_node, serialize)
+        self.assertEqual(htree.Element.append, append)
+        self.assertEqual(htree.Text('foo'), 'foo')
+        self.assertEqual(htree.Entity('amp'), '&amp;')
+
+    def test_recording(self):
+        reports = []
+        htree.instrument.add_callback(reports.append)
+        with htree.instrument.recording() as inst:
+            node = htree.Element('p', id='a&b')
+            node.append(htree.Text('x < y'))
+            node.append(htree.Entity('amp'))
+            em = htree.Element('em')
+            node.append(em)
+            output = node.to_string()
+        htree.instrument.remove_callback(reports.append)
+        self.assertEqual(output, '<p id="a&amp;b">x &lt; y&amp;<em></em></p>\n')
+        self.assertFalse(inst.enabled)
+        self.assertEqual(len(reports), 1)
+        stats = reports[0]
+        self.assertEqual(stats['nodes_created.Element'], 2)
+        self.assertEqual(stats['nodes_created.Text'], 1)
+        self.assertEqual(stats['nodes_created.Entity'], 1)
+        self.assertEqual(stats['append_calls'], 3)
+        self.assertEqual(stats['escaped_chars.cdata'], 5)
+        self.assertEqual(stats['escaped_chars.attrib'], 3)
+        self.assertEqual(stats['serialized_chars.Text'], len('x &lt; y'))
+        self.assertEqual(stats['serialized_chars.Entity'], len('&amp;'))
+        self.assertEqual(stats['serialized_chars.Element'], len(output) - len('x &lt; y&amp;'))
+        self.assertIn('serialize_seconds.p', stats)
+        self.assertIn('serialize_seconds.em', stats)
+
+    def test_recording_keeps_enabled(self):
+        htree.instrument.enable()
+        with htree.instrument.recording():
+            htree.Element('p')
+        self.assertTrue(htree.instrument.enabled)
+        self.assertEqual(htree.instrument.stats['nodes_created.Element'], 1)
+
+    def test_cached_attributes(self):
+        node = htree.Element('p', id='a&b')
+        node.to_string()
+        with htree.instrument.recording() as inst:
+            node.to_string()
+            node.to_string()
+        self.assertEqual(inst.stats['escaped_chars.attrib'], 6)
+
+
 if __name__ == '__main__':
     unittest.main()